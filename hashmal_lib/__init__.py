@@ -3,15 +3,24 @@ import sys
 from PyQt4.QtGui import QApplication
 
 from main_window import HashmalMain
+from core import my_config, verify
 
 
 class HashmalGui(object):
     def __init__(self):
         super(HashmalGui, self).__init__()
+        # Worker processes must be forked before the GUI and its threads exist.
+        config = my_config.Config()
+        config.load()
+        processes = config.get_option('verification_processes', None)
+        if processes != 0:
+            verify.start_pool(processes)
         self.app = QApplication(sys.argv)
 
     def main(self):
         self.main_window = HashmalMain(self.app)
         self.main_window.show()
-        sys.exit(self.app.exec_())
+        status = self.app.exec_()
+        verify.stop_pool()
+        sys.exit(status)
 
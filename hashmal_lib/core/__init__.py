@@ -6,6 +6,7 @@ import block
 import transaction
 import utils
 import opcodes
+import verify
 
 from script import Script
 from stack import Stack
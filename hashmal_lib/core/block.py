@@ -1,9 +1,12 @@
+from io import BytesIO
 import struct
 
-from bitcoin.core import __make_mutable, b2x, CBlockHeader
-from bitcoin.core.serialize import ser_read, Hash, BytesSerializer, VectorSerializer
+from bitcoin.core import b2x, b2lx, CBlockHeader
+from bitcoin.core.serialize import (ser_read, Hash, Serializable, BytesSerializer, VectorSerializer,
+            VarIntSerializer, uint256VectorSerializer)
 
-from transaction import Transaction
+from serialization import compile_fields, BufferReader, CacheStats, MemoizedSerializable
+from transaction import Transaction, LazyTransaction, TxColumns
 
 block_header_fields = [
     ('nVersion', b'<i', 4, 1),
@@ -23,8 +26,45 @@ block_fields = [
     ('vtx', 'vectortx', None, None)
 ]
 
-@__make_mutable
-class BlockHeader(CBlockHeader):
+def _read_txs(f):
+    return VectorSerializer.stream_deserialize(Transaction, f)
+
+def _write_txs(vtx, f):
+    VectorSerializer.stream_serialize(Transaction, vtx, f)
+
+block_formats = {
+    'bytes': (BytesSerializer.stream_deserialize, BytesSerializer.stream_serialize),
+    'vectortx': (_read_txs, _write_txs),
+}
+"""Handlers of block field formats other than struct formats."""
+
+_header_layouts = {}
+_block_layouts = {}
+
+def get_header_layout(fields=None):
+    """Get the compiled FieldLayout of block header fields.
+
+    Fields with the format 'bytes' are fixed-width in block headers.
+    """
+    if fields is None:
+        fields = block_header_fields
+    key = tuple(fields)
+    layout = _header_layouts.get(key)
+    if layout is None:
+        layout = _header_layouts[key] = compile_fields(fields)
+    return layout
+
+def get_block_layout(fields=None):
+    """Get the compiled FieldLayout of block fields (excluding the header)."""
+    if fields is None:
+        fields = block_fields
+    key = tuple(fields)
+    layout = _block_layouts.get(key)
+    if layout is None:
+        layout = _block_layouts[key] = compile_fields(fields, block_formats)
+    return layout
+
+class BlockHeader(MemoizedSerializable, CBlockHeader):
     """Cryptocurrency block header.
 
     Subclassed from CBlockHeader so that its fields
@@ -35,9 +75,19 @@ class BlockHeader(CBlockHeader):
 
     For the most common purposes, chainparams.set_to_preset()
     can be used instead.
+
+    The serialization and hash are cached until a field changes.
     """
+    # Allow fields to be altered.
+    __setattr__ = MemoizedSerializable.__setattr__
+    __delattr__ = MemoizedSerializable.__delattr__
+    __hash__ = Serializable.__hash__
+    cache_stats = CacheStats()
+
     def __init__(self, nVersion=2, hashPrevBlock=b'\x00'*32, hashMerkleRoot=b'\x00'*32, nTime=0, nBits=0, nNonce=0, fields=None, kwfields=None):
         super(BlockHeader, self).__init__(nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, nNonce)
+        # (offset, length) of each field, if deserialized.
+        self.field_offsets = None
         if kwfields is None: kwfields = {}
         for k, v in kwfields.items():
             setattr(self, k, v)
@@ -84,19 +134,19 @@ class BlockHeader(CBlockHeader):
         self = cls()
         if not hasattr(self, 'fields'):
             setattr(self, 'fields', list(block_header_fields))
-        for attr, fmt, num_bytes, _ in self.fields:
-            if fmt not in ['bytes']:
-                setattr(self, attr, struct.unpack(fmt, ser_read(f, num_bytes))[0])
-            elif fmt == 'bytes':
-                setattr(self, attr, ser_read(f, num_bytes))
+        offsets = {}
+        for k, v in get_header_layout(self.fields).read(f, {}, offsets=offsets, start=f.tell()).items():
+            setattr(self, k, v)
+        self.field_offsets = offsets
         return self
 
-    def stream_serialize(self, f):
-        for attr, fmt, num_bytes, _ in self.fields:
-            if fmt not in ['bytes']:
-                f.write(struct.pack(fmt, getattr(self, attr)))
-            elif fmt == 'bytes':
-                f.write(getattr(self, attr))
+    def cache_state(self):
+        return [tuple(self.fields)] + [getattr(self, attr) for attr, _, _, _ in self.fields]
+
+    def _serialize(self):
+        f = BytesIO()
+        get_header_layout(self.fields).write(self, f)
+        return f.getvalue()
 
     def as_hex(self):
         return b2x(self.serialize())
@@ -108,6 +158,8 @@ class Block(BlockHeader):
     Most of this code is copied directly from the CBlock class in python-bitcoinlib.
     https://github.com/petertodd/python-bitcoinlib/blob/master/bitcoin/core/__init__.py
     """
+    cache_stats = CacheStats()
+
     @staticmethod
     def build_merkle_tree_from_txids(txids):
         """Build a full Block merkle tree from txids
@@ -164,24 +216,121 @@ class Block(BlockHeader):
     def calc_merkle_root(self):
         """Calculate the merkle root
 
-        The calculated merkle root is not cached; every invocation
-        re-calculates it from scratch.
+        The merkle tree is cached until vtx or the generation of
+        a transaction in it changes.
         """
         if not len(self.vtx):
             raise ValueError('Block contains no transactions')
-        return self.build_merkle_tree_from_txs(self.vtx)[-1]
+        return self.vMerkleTree[-1]
 
     def __init__(self, nVersion=2, hashPrevBlock=b'\x00'*32, hashMerkleRoot=b'\x00'*32, nTime=0, nBits=0, nNonce=0, vtx=(), header_fields=None, block_fields=None, kwfields=None):
         """Create a new block"""
+        self._merkle_tree = None
+        self._merkle_tree_state = None
+        self._vMerkleTree = None
+        self._offsets_cache = None
         super(Block, self).__init__(nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, nNonce, header_fields)
         if kwfields is None: kwfields = {}
         for k, v in kwfields.items():
             setattr(self, k, v)
 
         self.set_serialization(block_fields)
-        vMerkleTree = tuple(Block.build_merkle_tree_from_txs(vtx))
-        object.__setattr__(self, 'vMerkleTree', vMerkleTree)
-        object.__setattr__(self, 'vtx', tuple(Transaction.from_tx(tx) for tx in vtx))
+        self.vtx = tuple(Transaction.from_tx(tx) for tx in vtx)
+
+    @property
+    def vtx(self):
+        return self._vtx
+
+    @vtx.setter
+    def vtx(self, value):
+        self._vtx = value
+        self.invalidate_merkle_tree()
+
+    def get_tx_offsets(self):
+        """Return the (offset, length) of each transaction in the serialized block.
+
+        Offsets are recorded when the block is deserialized, and are valid until
+        the generation of the block or any of its transactions changes. Otherwise,
+        they (and field_offsets) are found from the cached serializations of the
+        transactions.
+        """
+        state = self.cache_state()
+        if self._offsets_cache is None or self._offsets_cache[0] != state:
+            self._offsets_cache = [state, self._find_offsets()]
+        return self._offsets_cache[1]
+
+    def _find_offsets(self):
+        """Find the offsets of fields and transactions using this block's serialization format."""
+        field_offsets = {}
+        pos = 0
+        for attr, _, num_bytes, _ in self.fields:
+            field_offsets[attr] = (pos, num_bytes)
+            pos += num_bytes
+        tx_offsets = []
+        for field in self.block_fields:
+            attr, fmt, _, _ = field
+            start = pos
+            if fmt == 'vectortx':
+                vtx = getattr(self, attr)
+                pos += len(VarIntSerializer.serialize(len(vtx)))
+                for tx in vtx:
+                    length = len(tx.serialize())
+                    tx_offsets.append((pos, length))
+                    pos += length
+            else:
+                f = BytesIO()
+                get_block_layout([field]).write(self, f)
+                pos += f.tell()
+            field_offsets[attr] = (start, pos - start)
+        # field_offsets is derived data, so this is not a new generation.
+        object.__setattr__(self, 'field_offsets', field_offsets)
+        return tx_offsets
+
+    @property
+    def vMerkleTree(self):
+        """Merkle tree of vtx in deepest first order.
+
+        The tree is built when it is first accessed.
+        """
+        tree = self.get_merkle_tree()
+        if self._vMerkleTree is None:
+            self._vMerkleTree = tuple(tree.flatten())
+        return self._vMerkleTree
+
+    def get_merkle_tree(self):
+        """Return the cached MerkleTree of vtx.
+
+        The tree is rebuilt if vtx is replaced, or if the generation
+        of any transaction in it has changed. Checking this does not
+        hash anything.
+        """
+        state = self._vtx_state()
+        if self._merkle_tree is None or self._merkle_tree_state != state:
+            self._merkle_tree = MerkleTree(tx.GetHash() for tx in self.vtx or ())
+            self._merkle_tree_state = state
+            self._vMerkleTree = None
+        return self._merkle_tree
+
+    def invalidate_merkle_tree(self):
+        """Discard the cached merkle tree."""
+        self._merkle_tree = None
+        self._merkle_tree_state = None
+        self._vMerkleTree = None
+
+    def get_txids(self):
+        """Return the hashes of the transactions in vtx.
+
+        These are the leaves of the cached merkle tree.
+        """
+        return list(self.get_merkle_tree().levels[0])
+
+    def get_merkle_proof(self, txids):
+        """Return a serialized proof that txids are in this block.
+
+        The proof is the block header followed by a PartialMerkleTree,
+        as returned by Bitcoin Core's gettxoutproof RPC.
+        """
+        return self.get_header().serialize() + self.get_merkle_tree().get_partial_tree(txids).serialize()
 
     def get_header(self):
         """Return the block header
@@ -194,7 +343,38 @@ class Block(BlockHeader):
         return BlockHeader(**d)
 
     def GetHash(self):
-        return self.get_header().GetHash()
+        """Return the hash of the block header."""
+        cache = self._get_cached('_hash_cache', self._header_state, self._serialize_header)
+        if cache[2] is None:
+            cache[2] = Hash(cache[1])
+        return cache[2]
+
+    def _header_state(self):
+        return BlockHeader.cache_state(self)
+
+    def _serialize_header(self):
+        return BlockHeader._serialize(self)
+
+    def cache_state(self):
+        """Return the generations of the block and its transactions.
+
+        Writes to block fields change the block's generation, so field
+        values do not need to be compared.
+        """
+        return [self._generation, tuple(self.fields), tuple(self.block_fields), self._vtx_state()]
+
+    def _vtx_state(self):
+        """Return the generations of the transactions in vtx."""
+        return tuple([tx._generation for tx in self.vtx or ()])
+
+    def invalidate_cache(self):
+        """Discard cached data, including the merkle tree.
+
+        This must be called after editing the inputs or outputs of
+        a transaction in vtx (or that transaction's invalidate_cache()).
+        """
+        super(Block, self).invalidate_cache()
+        self.invalidate_merkle_tree()
 
     def set_serialization(self, fields=None):
         """Set the serialization format.
@@ -211,24 +391,392 @@ class Block(BlockHeader):
 
     @classmethod
     def stream_deserialize(cls, f):
+        start = f.tell()
         self = super(Block, cls).stream_deserialize(f)
-        for attr, fmt, num_bytes, _ in self.block_fields:
-            if fmt not in ['bytes', 'vectortx']:
-                setattr(self, attr, struct.unpack(fmt, ser_read(f, num_bytes))[0])
-            elif fmt == 'bytes':
-                setattr(self, attr, BytesSerializer.stream_deserialize(f))
-            elif fmt == 'vectortx':
-                setattr(self, attr, VectorSerializer.stream_deserialize(Transaction, f))
-
-        setattr(self, 'vMerkleTree', tuple(Block.build_merkle_tree_from_txs(getattr(self, 'vtx'))))
+        values = {}
+        vtx = []
+        tx_offsets = []
+        for _, offset, length, tx in iter_block_fields(f, self.block_fields, values, self.field_offsets, start):
+            vtx.append(tx)
+            tx_offsets.append((offset, length))
+        values['vtx'] = vtx
+        for k, v in values.items():
+            setattr(self, k, v)
+        self._offsets_cache = [self.cache_state(), tx_offsets]
         return self
 
+    def _serialize(self):
+        f = BytesIO()
+        f.write(self._serialize_header())
+        get_block_layout(self.block_fields).write(self, f)
+        return f.getvalue()
+
+
+def iter_block_fields(f, fields, values, offsets=None, start=0):
+    """Generator that reads block fields (excluding the header) from f.
+
+    Values of fields other than vectors of transactions are stored in values.
+    If offsets is a dict, the (offset, length) of each field is stored in it,
+    with offsets relative to the stream position start.
+
+    Yields:
+        (index, offset, length, tx) tuples for each transaction.
+    """
+    prev_end = 0
+    for i, (attr, fmt, _, _) in enumerate(fields):
+        if fmt != 'vectortx':
+            continue
+        get_block_layout(fields[prev_end:i]).read(f, values, offsets=offsets, start=start)
+        prev_end = i + 1
+
+        vector_start = f.tell()
+        for index in xrange(VarIntSerializer.stream_deserialize(f)):
+            offset = f.tell()
+            tx = Transaction.stream_deserialize(f)
+            yield (index, offset - start, f.tell() - offset, tx)
+        if offsets is not None:
+            offsets[attr] = (vector_start - start, f.tell() - vector_start)
+    get_block_layout(fields[prev_end:]).read(f, values, offsets=offsets, start=start)
+
+def read_tx_columns(data, fields=None):
+    """Read the transactions of a serialized block into TxColumns.
+
+    Transactions are scanned in place, so no transaction, input,
+    or output objects are created.
+
+    Returns:
+        A 3-tuple of (header, columns, field_values), where field_values
+        contains the values of block fields other than vtx.
+    """
+    if fields is None:
+        fields = list(block_fields)
+    data = memoryview(data)
+    f = BufferReader(data)
+    header = BlockHeader.stream_deserialize(f)
+    columns = TxColumns()
+    values = {}
+    prev_end = 0
+    for i, (attr, fmt, _, _) in enumerate(fields):
+        if fmt != 'vectortx':
+            continue
+        get_block_layout(fields[prev_end:i]).read(f, values)
+        prev_end = i + 1
+        for _ in xrange(VarIntSerializer.stream_deserialize(f)):
+            tx = LazyTransaction(data, f.tell(), columns.fields)
+            columns.add_tx(tx)
+            f.pos += tx.size
+    get_block_layout(fields[prev_end:]).read(f, values)
+    return (header, columns, values)
+
+class IncrementalMerkleRoot(object):
+    """Merkle root calculator that is given txids one at a time.
+
+    Only one hash per level of the tree is kept, so memory usage
+    is logarithmic in the number of txids.
+    The result is the same as that of Block.build_merkle_tree_from_txids().
+    """
+    def __init__(self):
+        super(IncrementalMerkleRoot, self).__init__()
+        self.count = 0
+        # Hashes of complete subtrees, by level.
+        self.inner = []
+
+    def add(self, txid):
+        self.count += 1
+        level = 0
+        h = txid
+        while not self.count & (1 << level):
+            h = Hash(self.inner[level] + h)
+            level += 1
+        if level == len(self.inner):
+            self.inner.append(h)
+        else:
+            self.inner[level] = h
+
+    def root(self):
+        """Calculate the merkle root of the txids that have been added."""
+        count = self.count
+        if not count:
+            raise ValueError('Block contains no transactions')
+        level = 0
+        while not count & (1 << level):
+            level += 1
+        h = self.inner[level]
+        while count != 1 << level:
+            # h is not the top of the tree, so it is paired with itself.
+            h = Hash(h + h)
+            count += 1 << level
+            level += 1
+            while not count & (1 << level):
+                h = Hash(self.inner[level] + h)
+                level += 1
+        return h
+
+class BlockStream(object):
+    """Iterator over a serialized block.
+
+    Yields the block header, and then a 3-tuple of (index, offset, tx)
+    for each transaction, where offset is the position of the transaction
+    relative to the start of the block. Transactions are not retained,
+    so large blocks can be processed with little memory.
+
+    Block fields other than vtx are stored in field_values as they are read.
+
+    If check_merkle_root is True, the merkle root is calculated as transactions
+    are read, and ValueError is raised after the last transaction if it does
+    not match the header's merkle root.
+
+    Attributes:
+        header (BlockHeader): Block header, once it has been read.
+        num_txs (int): Number of transactions in the block.
+        field_values (dict): Values of block fields other than vtx.
+        field_offsets (dict): (offset, length) of each field that has been read.
+        merkle_root (str): Calculated merkle root, if check_merkle_root is True.
+    """
+    def __init__(self, data, check_merkle_root=False, fields=None):
+        super(BlockStream, self).__init__()
+        self.f = data if hasattr(data, 'read') else BytesIO(data)
+        self.check_merkle_root = check_merkle_root
+        if fields is None:
+            fields = list(block_fields)
+        self.block_fields = fields
+        self.header = None
+        self.num_txs = 0
+        self.field_values = {}
+        self.field_offsets = {}
+        self.merkle_root = None
+
+    def __iter__(self):
+        f = self.f
+        start = f.tell()
+        self.header = BlockHeader.stream_deserialize(f)
+        self.field_offsets = dict(self.header.field_offsets)
+        yield self.header
+
+        merkle = IncrementalMerkleRoot() if self.check_merkle_root else None
+        for index, offset, _, tx in iter_block_fields(f, self.block_fields, self.field_values, self.field_offsets, start):
+            self.num_txs = index + 1
+            if merkle:
+                merkle.add(tx.GetHash())
+            yield (index, offset, tx)
+
+        if merkle:
+            self.merkle_root = merkle.root()
+            if self.merkle_root != self.header.hashMerkleRoot:
+                raise ValueError('Merkle root mismatch: header has %s, transactions have %s' % (
+                                 b2lx(self.header.hashMerkleRoot), b2lx(self.merkle_root)))
+
+class MerkleTree(object):
+    """Merkle tree of txids, stored by level.
+
+    levels[0] is the list of txids and levels[-1] is a list of the merkle root.
+    Levels are built once, so inclusion proofs can be generated in O(log n).
+
+    Attributes:
+        levels (list): Lists of hashes, from the txids to the root.
+        mutated (bool): Whether two hashes that are paired in the tree are equal.
+            Such trees have the same root as a tree with duplicated transactions (CVE-2012-2459).
+    """
+    def __init__(self, txids):
+        super(MerkleTree, self).__init__()
+        level = list(txids)
+        self.levels = [level]
+        self.mutated = False
+        while len(level) > 1:
+            size = len(level)
+            next_level = []
+            for i in range(0, size, 2):
+                i2 = min(i + 1, size - 1)
+                if i2 != i and level[i] == level[i2]:
+                    self.mutated = True
+                next_level.append(Hash(level[i] + level[i2]))
+            self.levels.append(next_level)
+            level = next_level
+        self._positions = None
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    @property
+    def root(self):
+        if not self.levels[0]:
+            raise ValueError('Block contains no transactions')
+        return self.levels[-1][0]
+
+    def flatten(self):
+        """Return the tree in deepest first order, as in Block.build_merkle_tree_from_txids()."""
+        return [h for level in self.levels for h in level]
+
+    def index(self, txid):
+        """Return the position of txid in the tree."""
+        if self._positions is None:
+            self._positions = {}
+            for i, h in enumerate(self.levels[0]):
+                self._positions.setdefault(h, i)
+        try:
+            return self._positions[txid]
+        except KeyError:
+            raise ValueError('Transaction %s is not in the tree' % b2lx(txid))
+
+    def get_branch(self, index):
+        """Return the hashes that index's txid is combined with, from the bottom up."""
+        return self.get_branches([index])[0]
+
+    def get_branches(self, indexes):
+        """Return the merkle branches of several txids in one pass over the levels."""
+        positions = list(indexes)
+        for i in positions:
+            if not 0 <= i < len(self):
+                raise IndexError('Transaction index %d out of range' % i)
+        branches = [[] for _ in positions]
+        for level in self.levels[:-1]:
+            last = len(level) - 1
+            for k, pos in enumerate(positions):
+                branches[k].append(level[min(pos ^ 1, last)])
+                positions[k] = pos >> 1
+        return branches
+
+    def tree_width(self, height):
+        """Return the number of hashes at height (0 is the level of txids)."""
+        return (len(self) + (1 << height) - 1) >> height
+
+    def get_partial_tree(self, txids):
+        """Build a PartialMerkleTree that proves txids are in this tree.
+
+        This is the proof format of BIP 37 merkleblock messages.
+        """
+        if not len(self):
+            raise ValueError('Block contains no transactions')
+        matches = set(self.index(i) for i in txids)
+        hashes = []
+        flags = []
+        def traverse(height, pos):
+            first = pos << height
+            last = min((pos + 1) << height, len(self))
+            parent_of_match = any(i in matches for i in range(first, last))
+            flags.append(parent_of_match)
+            if height == 0 or not parent_of_match:
+                hashes.append(self.levels[height][pos])
+            else:
+                traverse(height - 1, pos * 2)
+                if pos * 2 + 1 < self.tree_width(height - 1):
+                    traverse(height - 1, pos * 2 + 1)
+        traverse(len(self.levels) - 1, 0)
+        return PartialMerkleTree(len(self), hashes, flags)
+
+def verify_merkle_branch(txid, index, branch, root):
+    """Check that txid is at index in the tree with merkle root root."""
+    h = txid
+    for other in branch:
+        if index & 1:
+            h = Hash(other + h)
+        else:
+            h = Hash(h + other)
+        index >>= 1
+    return h == root
+
+class PartialMerkleTree(Serializable):
+    """BIP 37 partial merkle tree.
+
+    Proves that a subset of a block's transactions are in the block.
+
+    Attributes:
+        num_txs (int): Number of transactions in the block.
+        hashes (list): Hashes in depth-first order.
+        flags (list): Bools in depth-first order, True for nodes that are
+            parents of (or are) matched txids.
+    """
+    def __init__(self, num_txs=0, hashes=None, flags=None):
+        super(PartialMerkleTree, self).__init__()
+        self.num_txs = num_txs
+        self.hashes = hashes if hashes is not None else []
+        self.flags = flags if flags is not None else []
+
+    @classmethod
+    def stream_deserialize(cls, f):
+        num_txs = struct.unpack(b'<I', ser_read(f, 4))[0]
+        hashes = uint256VectorSerializer.stream_deserialize(f)
+        flag_bytes = BytesSerializer.stream_deserialize(f)
+        flags = [bool(ord(flag_bytes[i // 8]) & (1 << (i % 8))) for i in range(len(flag_bytes) * 8)]
+        return cls(num_txs, hashes, flags)
+
     def stream_serialize(self, f):
-        super(Block, self).stream_serialize(f)
-        for attr, fmt, num_bytes, _ in self.block_fields:
-            if fmt not in ['bytes', 'vectortx']:
-                f.write(struct.pack(fmt, getattr(self, attr)))
-            elif fmt == 'bytes':
-                BytesSerializer.stream_serialize(getattr(self, attr), f)
-            elif fmt == 'vectortx':
-                VectorSerializer.stream_serialize(Transaction, getattr(self, attr), f)
+        f.write(struct.pack(b'<I', self.num_txs))
+        uint256VectorSerializer.stream_serialize(self.hashes, f)
+        flag_bytes = bytearray((len(self.flags) + 7) // 8)
+        for i, flag in enumerate(self.flags):
+            if flag:
+                flag_bytes[i // 8] |= 1 << (i % 8)
+        BytesSerializer.stream_serialize(bytes(flag_bytes), f)
+
+    def tree_width(self, height):
+        return (self.num_txs + (1 << height) - 1) >> height
+
+    def extract(self):
+        """Calculate the merkle root and find the matched txids.
+
+        Raises:
+            ValueError: The tree is malformed, or has identical siblings (CVE-2012-2459).
+
+        Returns:
+            A 2-tuple of (merkle_root, [(index, txid), ...]).
+        """
+        if self.num_txs == 0:
+            raise ValueError('Partial merkle tree has no transactions')
+        if len(self.hashes) > self.num_txs:
+            raise ValueError('Partial merkle tree has more hashes than transactions')
+        if len(self.flags) < len(self.hashes):
+            raise ValueError('Partial merkle tree has fewer flags than hashes')
+        height = 0
+        while self.tree_width(height) > 1:
+            height += 1
+
+        matches = []
+        # Numbers of flags and hashes used.
+        used = [0, 0]
+        def traverse(height, pos):
+            if used[0] >= len(self.flags):
+                raise ValueError('Partial merkle tree has too few flags')
+            parent_of_match = self.flags[used[0]]
+            used[0] += 1
+            if height == 0 or not parent_of_match:
+                if used[1] >= len(self.hashes):
+                    raise ValueError('Partial merkle tree has too few hashes')
+                h = self.hashes[used[1]]
+                used[1] += 1
+                if height == 0 and parent_of_match:
+                    matches.append((pos, h))
+                return h
+            left = traverse(height - 1, pos * 2)
+            if pos * 2 + 1 < self.tree_width(height - 1):
+                right = traverse(height - 1, pos * 2 + 1)
+                if right == left:
+                    raise ValueError('Partial merkle tree has identical siblings (CVE-2012-2459)')
+            else:
+                right = left
+            return Hash(left + right)
+
+        root = traverse(height, 0)
+        if (used[0] + 7) // 8 != (len(self.flags) + 7) // 8:
+            raise ValueError('Partial merkle tree has unused flags')
+        if used[1] != len(self.hashes):
+            raise ValueError('Partial merkle tree has unused hashes')
+        return (root, matches)
+
+def verify_merkle_proof(data):
+    """Verify a serialized merkle proof (a block header and a PartialMerkleTree).
+
+    This is the format of Bitcoin Core's gettxoutproof RPC.
+
+    Raises:
+        ValueError: The proof is invalid.
+
+    Returns:
+        A 2-tuple of (block_header, [(index, txid), ...]).
+    """
+    f = BytesIO(data)
+    header = BlockHeader.stream_deserialize(f)
+    root, matches = PartialMerkleTree.stream_deserialize(f).extract()
+    if root != header.hashMerkleRoot:
+        raise ValueError('Merkle root mismatch: header has %s, proof has %s' % (b2lx(header.hashMerkleRoot), b2lx(root)))
+    return (header, matches)
@@ -0,0 +1,238 @@
+"""Reading blocks from the blk*.dat files of a Bitcoin Core data directory.
+
+Block files are sequences of (magic, length, block) records.
+BlockFileReader memory-maps the files, and keeps an index of
+{block_hash: (file_name, offset, length)} that can be saved to disk
+so that only blocks appended since the last scan are read.
+Only the most recently used maps are kept open, since a data directory
+can contain thousands of block files.
+"""
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+import json
+import mmap
+import os
+import re
+import struct
+
+from bitcoin.core import b2x, x, b2lx, lx
+from bitcoin.core.serialize import Hash
+
+import chainparams
+from block import Block, BlockHeader
+from serialization import BufferReader
+
+block_file_pattern = re.compile(r'^blk(\d+)\.dat$')
+
+# Length of the magic bytes and the block length that precede each block.
+record_header_length = 8
+
+def xor_data(data, key, offset):
+    """XOR data with key, starting at offset into the key stream."""
+    if not key or not len(data):
+        return data
+    length = len(data)
+    start = offset % len(key)
+    key = key[start:] + key[:start]
+    stream = (key * (length // len(key) + 1))[:length]
+    # XOR the data as one integer instead of byte by byte.
+    result = int(hexlify(data), 16) ^ int(hexlify(stream), 16)
+    return unhexlify('%0*x' % (length * 2, result))
+
+class BlockFileReader(object):
+    """Reader and index for the block files in blocks_dir.
+
+    Args:
+        blocks_dir (str): Directory containing blk*.dat files.
+        index_path (str): Path of the index file. If specified, the index is
+            loaded from and saved to it.
+        magic (str): Magic bytes of the network. If not specified, the block_file_magic
+            of the active chainparams preset is used, or the magic is read from the first file.
+
+    Attributes:
+        index (dict): Dict of {block_hash: (file_name, offset, length)}.
+        scanned (dict): Dict of {file_name: position} of the data that has been indexed.
+
+    Blocks are deserialized with the active chainparams preset.
+    Buffers returned by read_data() are only valid while the map of their
+    file is open, so at most max_open_files maps are kept open.
+    """
+    max_open_files = 8
+
+    def __init__(self, blocks_dir, index_path=None, magic=None):
+        super(BlockFileReader, self).__init__()
+        self.blocks_dir = os.path.abspath(blocks_dir)
+        self.index_path = index_path
+        if magic is None and chainparams.active_preset:
+            magic = chainparams.active_preset.block_file_magic
+        self.magic = magic
+        self.index = {}
+        self.scanned = {}
+        self.mmaps = OrderedDict()
+        self.xor_key = self._read_xor_key()
+        if self.index_path:
+            self.load_index()
+
+    def _read_xor_key(self):
+        """Read the obfuscation key of block files (Bitcoin Core 28.0 and later)."""
+        path = os.path.join(self.blocks_dir, 'xor.dat')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            key = f.read()
+        # A key of zeroes means the files are not obfuscated.
+        if not key.strip(b'\x00'):
+            return None
+        return key
+
+    def block_files(self):
+        """Get the names of the block files in blocks_dir, in order."""
+        names = [i for i in os.listdir(self.blocks_dir) if block_file_pattern.match(i)]
+        return sorted(names, key=lambda i: int(block_file_pattern.match(i).group(1)))
+
+    def get_mmap(self, name):
+        """Get a read-only memory map of the block file name.
+
+        Returns None if the file is empty.
+        """
+        m = self.mmaps.pop(name, None)
+        size = os.path.getsize(os.path.join(self.blocks_dir, name))
+        # Remap files that have grown.
+        if m is not None and len(m) < size:
+            m.close()
+            m = None
+        if m is None:
+            if size == 0:
+                return None
+            with open(os.path.join(self.blocks_dir, name), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mmaps[name] = m
+        # Close the least recently used maps.
+        while len(self.mmaps) > self.max_open_files:
+            self.mmaps.popitem(last=False)[1].close()
+        return m
+
+    def read_data(self, name, offset, length):
+        """Read length bytes at offset in the block file name.
+
+        The data is a zero-copy buffer, unless the file is obfuscated.
+        """
+        m = self.get_mmap(name)
+        if m is None or offset + length > len(m):
+            raise ValueError('Data is beyond the end of %s' % name)
+        if self.xor_key:
+            return xor_data(m[offset:offset + length], self.xor_key, offset)
+        return buffer(m, offset, length)
+
+    def scan(self, progress=None, is_cancelled=None):
+        """Index blocks that have not been scanned yet.
+
+        Args:
+            progress (function): Called with (files_scanned, num_files) after each file.
+            is_cancelled (function): Returns whether to stop scanning. Files that have
+                been scanned remain in the index.
+
+        Returns:
+            The number of blocks that were added to the index.
+        """
+        header_length = BlockHeader.header_length()
+        added = 0
+        names = self.block_files()
+        for i, name in enumerate(names):
+            if is_cancelled and is_cancelled():
+                break
+            m = self.get_mmap(name)
+            size = len(m) if m is not None else 0
+            pos = self.scanned.get(name, 0)
+            while pos + record_header_length <= size:
+                magic, length = struct.unpack('<4sI', str(self.read_data(name, pos, record_header_length)))
+                # Files are preallocated with zeroes.
+                if magic == b'\x00' * 4:
+                    break
+                if self.magic is None:
+                    self.magic = magic
+                elif magic != self.magic:
+                    raise ValueError('Unexpected magic bytes %s at offset %d in %s' % (b2x(magic), pos, name))
+                offset = pos + record_header_length
+                # Stop at blocks that are still being written.
+                if length < header_length or offset + length > size:
+                    break
+                block_hash = Hash(str(self.read_data(name, offset, header_length)))
+                if block_hash not in self.index:
+                    added += 1
+                self.index[block_hash] = (name, offset, length)
+                pos = offset + length
+            self.scanned[name] = pos
+            if progress:
+                progress(i + 1, len(names))
+
+        if self.index_path:
+            self.save_index()
+        return added
+
+    def get_block_data(self, block_hash):
+        """Get the serialized block with block_hash.
+
+        Raises:
+            KeyError: The block is not in the index.
+        """
+        name, offset, length = self.index[block_hash]
+        return self.read_data(name, offset, length)
+
+    def get_block(self, block_hash):
+        """Deserialize the block with block_hash."""
+        return Block.stream_deserialize(BufferReader(self.get_block_data(block_hash)))
+
+    def get_header(self, block_hash):
+        """Deserialize the header of the block with block_hash."""
+        return BlockHeader.stream_deserialize(BufferReader(self.get_block_data(block_hash)))
+
+    def load_index(self):
+        """Load the index from index_path.
+
+        The index is discarded if it is for a different directory or network,
+        or if any block file is smaller than when it was scanned.
+        """
+        self.index, self.scanned = {}, {}
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('blocks_dir') != self.blocks_dir:
+            return
+        magic = x(data['magic']) if data.get('magic') else None
+        if self.magic is not None and magic is not None and magic != self.magic:
+            return
+        scanned = dict((str(k), v) for k, v in data.get('files', {}).items())
+        for name, pos in scanned.items():
+            path = os.path.join(self.blocks_dir, name)
+            if not os.path.exists(path) or os.path.getsize(path) < pos:
+                return
+        self.magic = self.magic or magic
+        self.scanned = scanned
+        self.index = dict((lx(k), (str(v[0]), v[1], v[2])) for k, v in data.get('blocks', {}).items())
+
+    def save_index(self):
+        """Save the index to index_path."""
+        data = {
+            'blocks_dir': self.blocks_dir,
+            'magic': b2x(self.magic) if self.magic else None,
+            'files': self.scanned,
+            'blocks': dict((b2lx(k), list(v)) for k, v in self.index.items()),
+        }
+        with open(self.index_path, 'w') as f:
+            json.dump(data, f)
+
+    def close(self):
+        for m in self.mmaps.values():
+            m.close()
+        self.mmaps = OrderedDict()
+
+    def __contains__(self, block_hash):
+        return block_hash in self.index
+
+    def __len__(self):
+        return len(self.index)
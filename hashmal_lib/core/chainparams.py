@@ -1,9 +1,5 @@
-import struct
-
 import bitcoin
-from bitcoin.core.script import (FindAndDelete, SIGHASH_ALL, SIGHASH_NONE,
-            SIGHASH_SINGLE, SIGHASH_ANYONECANPAY, CScript, OP_CODESEPARATOR,
-            OPCODE_NAMES, OPCODES_BY_NAME, DISABLED_OPCODES)
+from bitcoin.core.script import OPCODE_NAMES, OPCODES_BY_NAME, DISABLED_OPCODES
 
 import block
 import transaction
@@ -45,6 +41,8 @@ class ParamsPreset(object):
         - opcode_names (dict): Dict of {opcode_value: opcode_name}.
         - opcodes_by_name (dict): Dict of {opcode_name: opcode_value}.
         - disabled_opcodes (list): List of disabled opcode values.
+        - block_file_magic (str): Network magic bytes that precede blocks in block files.
+            If not specified, they are read from the block files.
 
     """
     def __init__(self, **kwargs):
@@ -58,59 +56,26 @@ class ParamsPreset(object):
         self.opcode_names = dict(OPCODE_NAMES)
         self.opcodes_by_name = dict(OPCODES_BY_NAME)
         self.disabled_opcodes = list(DISABLED_OPCODES)
+        self.block_file_magic = None
 
         for k, v in kwargs.items():
             setattr(self, k, v)
 
     @classmethod
-    def raw_signature_hash(cls, script, txTo, inIdx, hashtype):
-        HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-
-        if inIdx >= len(txTo.vin):
-            return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-        txtmp = transaction.Transaction.from_tx(txTo)
-
-        for txin in txtmp.vin:
-            txin.scriptSig = b''
-        txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
-
-        if (hashtype & 0x1f) == SIGHASH_NONE:
-            txtmp.vout = []
-
-            for i in range(len(txtmp.vin)):
-                if i != inIdx:
-                    txtmp.vin[i].nSequence = 0
-
-        elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-            outIdx = inIdx
-            if outIdx >= len(txtmp.vout):
-                return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
-
-            tmp = txtmp.vout[outIdx]
-            txtmp.vout = []
-            for i in range(outIdx):
-                txtmp.vout.append(bitcoin.core.CMutableTxOut())
-            txtmp.vout.append(tmp)
+    def raw_signature_hash(cls, script, txTo, inIdx, hashtype, sighash_cache=None):
+        """Get the signature hash of an input.
 
-            for i in range(len(txtmp.vin)):
-                if i != inIdx:
-                    txtmp.vin[i].nSequence = 0
-
-        if hashtype & SIGHASH_ANYONECANPAY:
-            tmp = txtmp.vin[inIdx]
-            txtmp.vin = []
-            txtmp.vin.append(tmp)
-
-        s = txtmp.serialize()
-        s += struct.pack(b"<I", hashtype)
-
-        hash = bitcoin.core.Hash(s)
-
-        return (hash, None)
+        Args:
+            sighash_cache (SighashCache): Cache for txTo. If not specified,
+                one will be created for this call.
+        """
+        if sighash_cache is None:
+            sighash_cache = transaction.SighashCache(txTo)
+        return sighash_cache.raw_signature_hash(script, inIdx, hashtype)
 
     @classmethod
-    def signature_hash(cls, script, txTo, inIdx, hashtype):
-        (h, err) = cls.raw_signature_hash(script, txTo, inIdx, hashtype)
+    def signature_hash(cls, script, txTo, inIdx, hashtype, sighash_cache=None):
+        (h, err) = cls.raw_signature_hash(script, txTo, inIdx, hashtype, sighash_cache)
         if err is not None:
             raise ValueError(err)
         return h
@@ -137,7 +102,8 @@ BitcoinPreset = ParamsPreset(
         tx_fields=[('nVersion', b'<i', 4, 1),
             ('vin', 'inputs', None, None),
             ('vout', 'outputs', None, None),
-            ('nLockTime', b'<I', 4, 0)]
+            ('nLockTime', b'<I', 4, 0)],
+        block_file_magic=b'\xf9\xbe\xb4\xd9'
 )
 
 ClamsPreset = ParamsPreset(
@@ -168,7 +134,8 @@ PeercoinPreset = ParamsPreset(
             ('Timestamp', b'<i', 4, 0),
             ('vin', 'inputs', None, None),
             ('vout', 'outputs', None, None),
-            ('nLockTime', b'<I', 4, 0)]
+            ('nLockTime', b'<I', 4, 0)],
+        block_file_magic=b'\xe6\xe8\xe9\xe5'
 )
 
 presets_list = [
@@ -241,6 +208,15 @@ def set_block_fields(fields):
     """
     block.block_fields = list(fields)
 
+def compile_serializers():
+    """Compile the serializers of the current transaction and block formats.
+
+    Serializers are cached, so this only needs to be done once per format.
+    """
+    transaction.get_serializer()
+    block.get_header_layout()
+    block.get_block_layout()
+
 def get_opcode_overrides():
     return opcodes.overridden_opcodes
 
@@ -270,11 +246,12 @@ def set_to_preset(name):
     set_tx_serializer(params.tx_serializer)
     set_block_header_fields(params.block_header_fields)
     set_block_fields(params.block_fields)
+    compile_serializers()
     set_script_engine_class(params.script_engine_cls)
     set_opcodes(params.opcode_names, params.opcodes_by_name, params.disabled_opcodes)
     set_opcode_overrides(params.opcode_overrides)
 
-def signature_hash(script, txTo, inIdx, hashtype):
+def signature_hash(script, txTo, inIdx, hashtype, sighash_cache=None):
     if not active_preset:
         raise Exception("No chainparams preset is active.")
-    return active_preset.signature_hash(script, txTo, inIdx, hashtype)
+    return active_preset.signature_hash(script, txTo, inIdx, hashtype, sighash_cache)
@@ -13,7 +13,7 @@ disabled_opcodes = list(DISABLED_OPCODES)
 overridden_opcodes = {}
 
 def is_overridden(op_value):
-    return op_value in overridden_opcodes.keys()
+    return op_value in overridden_opcodes
 
 def override(opcode, stack, txTo, inIdx, flags, execution_data, err_raiser):
     if not is_overridden(opcode):
@@ -2,10 +2,10 @@ import pyparsing
 from pyparsing import Word, QuotedString, OneOrMore, Combine
 import shlex
 
-from bitcoin.core.script import CScript
+from bitcoin.core.script import *
 
 import opcodes
-from utils import is_hex, push_script, format_hex_string
+from utils import is_hex, push_script, format_hex_string, LRUCache
 
 class Script(CScript):
     """Transaction script.
@@ -55,56 +55,197 @@ class Script(CScript):
 
     def get_hex(self):
         """Get the script as a hex-encoded string."""
-        s = []
-        iterator = self.raw_iter()
-        while 1:
-            try:
-                opcode, data, byte_index = next(iterator)
+        return parse_script(self).get_hex()
+
+    def human_iter(self):
+        return iter(parse_script(self).get_human_list())
+
+    def get_human(self):
+        """Get the script as a human-readable string."""
+        return ' '.join(parse_script(self).get_human_list())
+
+
+class ParsedScript(object):
+    """Decoded form of a script.
+
+    Attributes:
+        ops (tuple): (opcode, data, byte_index) tuples from CScript.raw_iter().
+        error (Exception): The exception that stopped parsing, if any.
+    """
+    def __init__(self, script):
+        super(ParsedScript, self).__init__()
+        ops = []
+        self.error = None
+        try:
+            for op in script.raw_iter():
+                ops.append(op)
+        except Exception as e:
+            self.error = e
+        self.ops = tuple(ops)
+        self._hex = None
+        self._human = None
+        self._human_names = None
+        self._analysis = None
+
+    def get_hex(self):
+        if self._hex is None:
+            s = []
+            for opcode, data, byte_index in self.ops:
                 hexcode = hex(opcode)[2:]
                 if len(hexcode) % 2 != 0:
                     hexcode = ''.join(['0', hexcode])
                 s.append(hexcode)
                 if data:
                     s.append(data.encode('hex'))
-            except StopIteration:
-                break
-            except Exception:
+            if self.error:
                 s.append('(CANNOT_PARSE)')
+            self._hex = ''.join(s)
+        return self._hex
 
-        return ''.join(s)
-
-    def human_iter(self):
-        iterator = self.raw_iter()
-        s = ''
-        while 1:
-            try:
-                opcode, data, byte_index = next(iterator)
+    def get_human_list(self):
+        """Get the human-readable form of each op."""
+        # Opcode names change with chainparams presets.
+        if self._human is None or self._human_names is not opcodes.opcode_names:
+            s = []
+            for opcode, data, byte_index in self.ops:
                 op_name = opcodes.opcode_names.get(opcode)
                 if op_name and not 'DATA' in op_name:
-                    s = op_name
+                    s.append(op_name)
+                elif data is None:
+                    s.append('(CANNOT_PARSE)')
+                elif all(ord(c) < 128 and ord(c) > 31 for c in data):
+                    s.append(''.join(['"', data, '"']))
                 else:
-                    if all(ord(c) < 128 and ord(c) > 31 for c in data):
-                        s = ''.join(['"', data, '"'])
-                    else:
-                        s = ''.join(['0x', data.encode('hex')])
-                yield s
-            except StopIteration:
-                break
-            except Exception:
-                yield '(CANNOT_PARSE)'
+                    s.append(''.join(['0x', data.encode('hex')]))
+            if self.error:
+                s.append('(CANNOT_PARSE)')
+            self._human = tuple(s)
+            self._human_names = opcodes.opcode_names
+        return self._human
 
-    def get_human(self):
-        """Get the script as a human-readable string."""
-        s = []
-        iterator = self.human_iter()
-        while 1:
-            try:
-                s.append(next(iterator))
-            except StopIteration:
-                break
-            except Exception:
-                break
-        return ' '.join(s)
+    def get_analysis(self):
+        """Get the ScriptAnalysis of this script."""
+        # Disabled and overridden opcodes change with chainparams presets.
+        key = (opcodes.disabled_opcodes, opcodes.overridden_opcodes)
+        if self._analysis is None or self._analysis_key[0] is not key[0] or self._analysis_key[1] is not key[1]:
+            self._analysis = ScriptAnalysis(self)
+            self._analysis_key = key
+        return self._analysis
+
+# Net effect of opcodes on the size of the stack.
+# Where the effect depends on stack contents, the largest possible effect is used.
+_stack_effects = {
+    OP_1NEGATE: 1,
+    OP_IF: -1, OP_NOTIF: -1, OP_VERIFY: -1, OP_RETURN: 0,
+    OP_TOALTSTACK: -1, OP_FROMALTSTACK: 1,
+    OP_2DROP: -2, OP_2DUP: 2, OP_3DUP: 3, OP_2OVER: 2, OP_2ROT: 0, OP_2SWAP: 0,
+    OP_IFDUP: 1, OP_DEPTH: 1, OP_DROP: -1, OP_DUP: 1, OP_NIP: -1, OP_OVER: 1,
+    OP_PICK: 0, OP_ROLL: -1, OP_ROT: 0, OP_SWAP: 0, OP_TUCK: 1,
+    OP_SIZE: 1, OP_EQUAL: -1, OP_EQUALVERIFY: -2,
+    OP_1ADD: 0, OP_1SUB: 0, OP_NEGATE: 0, OP_ABS: 0, OP_NOT: 0, OP_0NOTEQUAL: 0,
+    OP_ADD: -1, OP_SUB: -1, OP_BOOLAND: -1, OP_BOOLOR: -1, OP_NUMEQUAL: -1,
+    OP_NUMEQUALVERIFY: -2, OP_NUMNOTEQUAL: -1, OP_LESSTHAN: -1, OP_GREATERTHAN: -1,
+    OP_LESSTHANOREQUAL: -1, OP_GREATERTHANOREQUAL: -1, OP_MIN: -1, OP_MAX: -1,
+    OP_WITHIN: -2,
+    OP_RIPEMD160: 0, OP_SHA1: 0, OP_SHA256: 0, OP_HASH160: 0, OP_HASH256: 0,
+    OP_CODESEPARATOR: 0, OP_CHECKSIG: -1, OP_CHECKSIGVERIFY: -2,
+    OP_CHECKMULTISIG: -2, OP_CHECKMULTISIGVERIFY: -3,
+}
+for _op in [OP_NOP, OP_NOP1, OP_NOP2, OP_NOP3, OP_NOP4, OP_NOP5, OP_NOP6, OP_NOP7, OP_NOP8, OP_NOP9, OP_NOP10, OP_ELSE, OP_ENDIF]:
+    _stack_effects[_op] = 0
+
+class ScriptAnalysis(object):
+    """Static analysis of a parsed script.
+
+    Finds problems that make a script fail regardless of its inputs,
+    without executing it.
+
+    Attributes:
+        op_count (int): Number of opcodes that count towards MAX_SCRIPT_OPCODES.
+        max_depth (int): Upper bound on how far the stack can grow beyond its initial size.
+        max_push_size (int): Size of the largest data push.
+        if_balanced (bool): Whether IF/NOTIF, ELSE and ENDIF are balanced.
+        disabled (list): Disabled opcodes that the script contains.
+        errors (list): Messages describing why the script cannot succeed.
+    """
+    def __init__(self, parsed):
+        super(ScriptAnalysis, self).__init__()
+        self.op_count = 0
+        self.max_depth = 0
+        self.max_push_size = 0
+        self.if_balanced = True
+        self.disabled = []
+        self.errors = []
+
+        disabled_opcodes = set(opcodes.disabled_opcodes)
+        overridden_opcodes = opcodes.overridden_opcodes
+        # Flow control can only be checked if it has not been overridden.
+        check_flow = not any(op in overridden_opcodes for op in range(OP_IF, OP_ENDIF + 1))
+
+        depth = 0
+        # (depth at start of branch, [depths at end of previous branches]) for each open IF.
+        branches = []
+        for opcode, data, byte_index in parsed.ops:
+            if opcode in disabled_opcodes and opcode not in self.disabled:
+                self.disabled.append(opcode)
+            if opcode > OP_16:
+                self.op_count += 1
+
+            if opcode <= OP_PUSHDATA4:
+                self.max_push_size = max(self.max_push_size, len(data))
+                depth += 1
+            elif opcode <= OP_16:
+                depth += 1
+            elif opcode in overridden_opcodes:
+                depth += 1
+            else:
+                depth += _stack_effects.get(opcode, 1)
+
+            if check_flow and OP_IF <= opcode <= OP_ENDIF:
+                if opcode in [OP_IF, OP_NOTIF]:
+                    branches.append((depth, []))
+                elif not branches:
+                    self.if_balanced = False
+                elif opcode == OP_ELSE:
+                    branches[-1][1].append(depth)
+                    depth = branches[-1][0]
+                elif opcode == OP_ENDIF:
+                    start, ends = branches.pop()
+                    depth = max(ends + [depth])
+
+            self.max_depth = max(self.max_depth, depth)
+
+        if branches:
+            self.if_balanced = False
+
+        if parsed.error:
+            self.errors.append(str(parsed.error))
+        for opcode in self.disabled:
+            self.errors.append('opcode %s is disabled' % opcodes.opcode_names.get(opcode, hex(opcode)))
+        if self.op_count > MAX_SCRIPT_OPCODES:
+            self.errors.append('script has %d opcodes; maximum allowed is %d' % (self.op_count, MAX_SCRIPT_OPCODES))
+        if self.max_push_size > MAX_SCRIPT_ELEMENT_SIZE:
+            self.errors.append('PUSHDATA of length %d; maximum allowed is %d' % (self.max_push_size, MAX_SCRIPT_ELEMENT_SIZE))
+        if not self.if_balanced:
+            self.errors.append('Unbalanced IF/ELSE/ENDIF')
+
+    def is_valid(self):
+        """Return whether no problems were found."""
+        return not self.errors
+
+parsed_script_cache = LRUCache(max_size=2048)
+
+def parse_script(script):
+    """Get the ParsedScript for script.
+
+    Results are cached by script bytes.
+    """
+    key = str.__str__(script)
+    parsed = parsed_script_cache.get(key)
+    if parsed is None:
+        parsed = ParsedScript(script)
+        parsed_script_cache.put(key, parsed)
+    return parsed
 
 
 def transform_human(text, variables=None):
@@ -0,0 +1,255 @@
+"""Compiled and memoized serialization.
+
+Transactions, block headers, and blocks have formats that are defined by
+lists of (attr, fmt, num_bytes, default) tuples (see chainparams).
+compile_fields() turns such a list into a FieldLayout, which reads and writes
+adjacent fixed-width fields with one struct.Struct, and calls the handlers
+of other formats (e.g. vectors) directly.
+
+MemoizedSerializable caches the serialization and hash of objects,
+and BufferReader reads from memoryviews and buffers without copying them.
+"""
+import itertools
+import struct
+
+from bitcoin.core.serialize import ser_read, Hash
+
+# Kinds of FieldLayout steps.
+STRUCT = 0
+"""Fixed-width fields: (STRUCT, struct.Struct, attrs, sized_fields, field_sizes)."""
+CALL = 1
+"""Field with a format handler: (CALL, attr, read(f), write(value, f))."""
+CUSTOM = 2
+"""Field handled by a serializer object: (CUSTOM, attr, fmt, num_bytes)."""
+
+byte_orders = '<>!='
+
+class FieldLayout(object):
+    """Compiled list of fields.
+
+    Attributes:
+        fields (list): Fields that the layout was compiled from.
+        steps (list): Steps that are performed to read or write the fields.
+    """
+    def __init__(self, fields, steps):
+        super(FieldLayout, self).__init__()
+        self.fields = list(fields)
+        self.steps = steps
+
+    def read(self, f, values, obj=None, serializer=None, offsets=None, start=0):
+        """Read fields from f into the dict values.
+
+        CUSTOM steps are read with serializer.deserialize_field(obj, values, ...).
+        If offsets is a dict, the (offset, length) of each field is stored in it,
+        with offsets relative to the stream position start.
+        """
+        for step in self.steps:
+            kind = step[0]
+            if offsets is not None:
+                pos = f.tell() - start
+            if kind == STRUCT:
+                s = step[1]
+                values.update(zip(step[2], s.unpack(ser_read(f, s.size))))
+                if offsets is not None:
+                    for attr, size in zip(step[2], step[4]):
+                        offsets[attr] = (pos, size)
+                        pos += size
+                continue
+            elif kind == CALL:
+                values[step[1]] = step[2](f)
+            else:
+                serializer.deserialize_field(obj, values, step[1], step[2], step[3], f)
+            if offsets is not None:
+                offsets[step[1]] = (pos, f.tell() - start - pos)
+        return values
+
+    def write(self, obj, f, serializer=None):
+        """Write the fields of obj to f.
+
+        CUSTOM steps are written with serializer.serialize_field(obj, ...).
+        """
+        for step in self.steps:
+            kind = step[0]
+            if kind == STRUCT:
+                values = [getattr(obj, attr) for attr in step[2]]
+                for i, size in step[3]:
+                    if len(values[i]) != size:
+                        raise ValueError('%s must be %d bytes' % (step[2][i], size))
+                f.write(step[1].pack(*values))
+            elif kind == CALL:
+                step[3](getattr(obj, step[1]), f)
+            else:
+                serializer.serialize_field(obj, step[1], step[2], step[3], f)
+
+def split_format(fmt):
+    """Split a struct format into its byte order and format code.
+
+    The byte order is None for formats without one (native byte order and alignment).
+    """
+    if fmt[0] in byte_orders:
+        return (fmt[0], fmt[1:])
+    return (None, fmt)
+
+def compile_fields(fields, formats=None, custom_fields=()):
+    """Compile fields into a FieldLayout.
+
+    Args:
+        fields (list): List of (attr, fmt, num_bytes, default) tuples.
+        formats (dict): Handlers of non-struct formats in the form {fmt: (read(f), write(value, f))}.
+            Fields with the format 'bytes' that do not have a handler are fixed-width,
+            with a length of num_bytes.
+        custom_fields (iterable): Names of fields that are handled by a serializer object.
+    """
+    if formats is None:
+        formats = {}
+    steps = []
+    # Current run of fixed-width fields.
+    order, codes, attrs, sized, sizes = None, [], [], [], []
+    for attr, fmt, num_bytes, _ in fields:
+        step = None
+        if attr in custom_fields:
+            step = (CUSTOM, attr, fmt, num_bytes)
+        elif fmt in formats:
+            read, write = formats[fmt]
+            step = (CALL, attr, read, write)
+        elif fmt == 'bytes':
+            field_order, code = order, '%ds' % num_bytes
+            sized_field = num_bytes
+        else:
+            field_order, code = split_format(fmt)
+            sized_field = None
+            # Fields without a byte order are aligned, so they are not merged.
+            if field_order is None:
+                s = struct.Struct(fmt)
+                step = (STRUCT, s, (attr,), (), (s.size,))
+
+        if step is None and (order is None or field_order is None or field_order == order):
+            order = order or field_order
+            if sized_field is not None:
+                sized.append((len(attrs), sized_field))
+            codes.append(code)
+            attrs.append(attr)
+            sizes.append(struct.calcsize('<' + code))
+            continue
+
+        if attrs:
+            steps.append((STRUCT, struct.Struct((order or '<') + ''.join(codes)), tuple(attrs), tuple(sized), tuple(sizes)))
+            order, codes, attrs, sized, sizes = None, [], [], [], []
+        if step is None:
+            # Start a new run with this field.
+            order, codes, attrs, sizes = field_order, [code], [attr], [struct.calcsize('<' + code)]
+            sized = [(0, sized_field)] if sized_field is not None else []
+        else:
+            steps.append(step)
+
+    if attrs:
+        steps.append((STRUCT, struct.Struct((order or '<') + ''.join(codes)), tuple(attrs), tuple(sized), tuple(sizes)))
+    return FieldLayout(fields, steps)
+
+class BufferReader(object):
+    """Minimal file-like reader over a memoryview or buffer.
+
+    Only the data that is read is copied.
+    """
+    def __init__(self, data, pos=0):
+        super(BufferReader, self).__init__()
+        self.data = data
+        self.pos = pos
+
+    def read(self, n=-1):
+        start = self.pos
+        end = len(self.data) if n < 0 else start + n
+        self.pos = min(end, len(self.data))
+        chunk = self.data[start:self.pos]
+        # Slices of buffers are strings, and slices of memoryviews are memoryviews.
+        return chunk if isinstance(chunk, bytes) else chunk.tobytes()
+
+    def tell(self):
+        return self.pos
+
+class CacheStats(object):
+    """Hit and miss counts of a cache."""
+    def __init__(self):
+        super(CacheStats, self).__init__()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        """Get the fraction of lookups that were hits."""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        """Get a dict of cache statistics."""
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate()}
+
+# Source of the generations of MemoizedSerializable objects.
+_generations = itertools.count(1)
+
+class MemoizedSerializable(object):
+    """Mixin that caches serialize() and GetHash().
+
+    Subclasses must define two methods:
+        - cache_state(): Returns the values that the serialization depends on.
+            States are compared with ==.
+        - _serialize(): Returns the serialized object.
+
+    The cached data is used only while cache_state() is equal to the state
+    that it was created with. Checking the state is much cheaper than
+    serializing and hashing.
+
+    Each write to a public attribute gives the object a new generation,
+    which is unique across all objects. A state can contain the generations
+    of nested objects (e.g. the transactions of a block) instead of their
+    own states. Writes to the attributes of objects that are not
+    MemoizedSerializable (e.g. inputs) do not change the generation;
+    call invalidate_cache() after such edits.
+
+    Subclasses should have their own cache_stats.
+    """
+    cache_stats = CacheStats()
+    _generation = 0
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != '_':
+            object.__setattr__(self, '_generation', next(_generations))
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        if name[0] != '_':
+            object.__setattr__(self, '_generation', next(_generations))
+
+    def _get_cached(self, key, state_func, serialize_func):
+        """Get the [state, data, hash] list of the cache named key."""
+        state = state_func()
+        cache = self.__dict__.get(key)
+        if cache is not None and cache[0] == state:
+            self.cache_stats.hits += 1
+            return cache
+        self.cache_stats.misses += 1
+        cache = [state, serialize_func(), None]
+        object.__setattr__(self, key, cache)
+        return cache
+
+    def invalidate_cache(self):
+        """Discard cached data, and start a new generation."""
+        for key in ['_serialization_cache', '_hash_cache']:
+            self.__dict__.pop(key, None)
+        object.__setattr__(self, '_generation', next(_generations))
+
+    def serialize(self):
+        return self._get_cached('_serialization_cache', self.cache_state, self._serialize)[1]
+
+    def stream_serialize(self, f):
+        f.write(self.serialize())
+
+    def GetHash(self):
+        cache = self._get_cached('_serialization_cache', self.cache_state, self._serialize)
+        if cache[2] is None:
+            cache[2] = Hash(cache[1])
+        return cache[2]
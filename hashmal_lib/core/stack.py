@@ -1,16 +1,21 @@
+import functools
 import hashlib
 import sys
 from collections import namedtuple
+from timeit import default_timer
 
 import bitcoin
 from bitcoin.core.script import *
 from bitcoin.core.scripteval import *
 from bitcoin.core.scripteval import (
-        _CastToBigNum, _CastToBool, _CheckSig, _CheckMultiSig,
-        _ISA_UNOP, _ISA_BINOP, _CheckExec, _bord, MAX_STACK_ITEMS
+        _CastToBool,
+        _ISA_UNOP, _ISA_BINOP, _bord, MAX_STACK_ITEMS, MAX_NUM_SIZE
 )
 
 import opcodes
+import transaction
+from script import parse_script
+from utils import LRUCache
 
 
 def e(*args):
@@ -23,9 +28,297 @@ ExecutionData = namedtuple('ExecutionData', ('block_height', 'block_time'))
 
 StackState = namedtuple('StackState', ('stack', 'last_op', 'log'))
 
+# State of a Stack before executing the op at op_index.
+# num_steps is the number of steps yielded before that op.
+ExecutionCheckpoint = namedtuple('ExecutionCheckpoint', ('op_index', 'num_steps', 'stack', 'altstack',
+                                                         'vfExec', 'nOpCount', 'pbegincodehash'))
+
+class ScriptNum(str):
+    """Stack item for a number that was computed by an opcode.
+
+    A ScriptNum is the minimal encoding of its number, so it is
+    equivalent to any other stack item with the same bytes.
+    It also keeps the number as value, so that opcodes that use it
+    as a number do not need to decode it.
+    """
+    def __new__(cls, value):
+        self = str.__new__(cls, _encode_num(value))
+        self.value = value
+        return self
+
+def _encode_num(v):
+    """Encode v in the same way as bitcoin.core._bignum.bn2vch()."""
+    if v == 0:
+        return b''
+    neg = v < 0
+    if neg:
+        v = -v
+    result = bytearray()
+    while v:
+        result.append(v & 0xff)
+        v >>= 8
+    if result[-1] & 0x80:
+        result.append(0x80 if neg else 0x00)
+    elif neg:
+        result[-1] |= 0x80
+    return bytes(result)
+
+def _decode_num(s):
+    """Decode s in the same way as bitcoin.core._bignum.vch2bn()."""
+    if not s:
+        return 0
+    v = int(s[::-1].encode('hex'), 16)
+    sign_bit = 0x80 << (8 * (len(s) - 1))
+    if v & sign_bit:
+        return -(v & ~sign_bit)
+    return v
+
+# ScriptNums for the values of OP_1NEGATE through OP_16.
+_small_nums = dict((i, ScriptNum(i)) for i in range(-1, 17))
+
+def _num_item(v):
+    """Get the stack item for the number v."""
+    item = _small_nums.get(v)
+    if item is None:
+        item = ScriptNum(v)
+    return item
+
+def _CastToNum(s, err_raiser):
+    """Equivalent of _CastToBigNum() that does not decode ScriptNums."""
+    if len(s) > MAX_NUM_SIZE:
+        raise err_raiser(EvalScriptError, 'CastToBigNum() : overflow')
+    if type(s) is ScriptNum:
+        return s.value
+    return _decode_num(s)
+
+class ConditionStack(object):
+    """Stack of IF/NOTIF conditions.
+
+    Keeps the position of the first false condition, so that whether
+    ops are executed can be checked in O(1) at any nesting depth.
+    """
+    def __init__(self, values=()):
+        super(ConditionStack, self).__init__()
+        self.values = []
+        # Index of the first false condition, or None if all are true.
+        self.first_false = None
+        self.extend(values)
+
+    def append(self, value):
+        if not value and self.first_false is None:
+            self.first_false = len(self.values)
+        self.values.append(value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def pop(self):
+        value = self.values.pop()
+        if self.first_false == len(self.values):
+            self.first_false = None
+        return value
+
+    def toggle_top(self):
+        """Negate the top condition and return its new value."""
+        top = len(self.values) - 1
+        value = not self.values[top]
+        self.values[top] = value
+        if not value and self.first_false is None:
+            self.first_false = top
+        elif value and self.first_false == top:
+            self.first_false = None
+        return value
+
+    def all_true(self):
+        """Return whether ops are executed."""
+        return self.first_false is None
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __repr__(self):
+        return 'ConditionStack(%r)' % self.values
+
+# Statistics about an opcode in an ExecutionProfile.
+OpcodeProfile = namedtuple('OpcodeProfile', ('opcode', 'name', 'overridden', 'count', 'total_time', 'sigops'))
+
+class ExecutionProfile(object):
+    """Statistics about the opcodes executed in one or more evaluations.
+
+    Attributes:
+        evaluations (int): Number of evaluations profiled.
+        peak_depth (int): Largest number of items on the stack and altstack.
+        peak_bytes (int): Largest total size of the items on the stack and altstack.
+    """
+    def __init__(self):
+        super(ExecutionProfile, self).__init__()
+        self.clear()
+
+    def clear(self):
+        # Dict of {opcode: [count, total_time, sigops]}.
+        self.opcodes = {}
+        self.evaluations = 0
+        self.peak_depth = 0
+        self.peak_bytes = 0
+
+    def record(self, sop, elapsed, ctx, sigops=0):
+        """Record that sop was executed in ctx."""
+        stats = self.opcodes.get(sop)
+        if stats is None:
+            stats = self.opcodes[sop] = [0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += sigops
+
+        depth = len(ctx.stack) + len(ctx.altstack)
+        if depth > self.peak_depth:
+            self.peak_depth = depth
+        size = sum(len(i) for i in ctx.stack) + sum(len(i) for i in ctx.altstack)
+        if size > self.peak_bytes:
+            self.peak_bytes = size
+
+    def merge(self, other):
+        """Add the statistics of another ExecutionProfile to this one."""
+        for sop, (count, total_time, sigops) in other.opcodes.items():
+            stats = self.opcodes.setdefault(sop, [0, 0.0, 0])
+            stats[0] += count
+            stats[1] += total_time
+            stats[2] += sigops
+        self.evaluations += other.evaluations
+        self.peak_depth = max(self.peak_depth, other.peak_depth)
+        self.peak_bytes = max(self.peak_bytes, other.peak_bytes)
+
+    def get(self, sop):
+        """Get the OpcodeProfile for sop."""
+        count, total_time, sigops = self.opcodes.get(sop, (0, 0.0, 0))
+        name = opcodes.opcode_names.get(sop, 'PUSHDATA' if sop <= OP_PUSHDATA4 else hex(sop))
+        return OpcodeProfile(sop, name, opcodes.is_overridden(sop), count, total_time, sigops)
+
+    def rows(self):
+        """Get OpcodeProfiles for every opcode executed, by descending total time."""
+        return sorted([self.get(sop) for sop in self.opcodes], key=lambda i: i.total_time, reverse=True)
+
+    def total_time(self):
+        return sum(i[1] for i in self.opcodes.values())
+
+    def total_sigops(self):
+        return sum(i[2] for i in self.opcodes.values())
+
+# Results of signature checks, keyed by (sighash, pubkey, signature).
+signature_cache = LRUCache(max_size=50000)
+
+class StepHistory(object):
+    """Steps of a script's execution.
+
+    Instead of a copy of the stack for every step, each step stores
+    only how it changed the stack of the step before it: the number of
+    items that were kept, and the items that were pushed after them.
+    A full copy of the stack is stored every checkpoint_interval steps,
+    so that the stack of any step can be rebuilt from the nearest checkpoint.
+
+    Items are StackState instances, which are rebuilt on demand.
+    """
+    checkpoint_interval = 32
+
+    def __init__(self):
+        super(StepHistory, self).__init__()
+        # List of (number_of_kept_items, pushed_items) 2-tuples.
+        self.deltas = []
+        self.ops = []
+        self.logs = []
+        # Full stack copies for every checkpoint_interval steps.
+        self.checkpoints = []
+        # Stack state at the last step.
+        self.current = []
+
+    def append(self, stack, last_op, log):
+        """Record a step."""
+        current = self.current
+        kept = 0
+        max_kept = min(len(current), len(stack))
+        while kept < max_kept and current[kept] == stack[kept]:
+            kept += 1
+        pushed = tuple(stack[kept:])
+        del current[kept:]
+        current.extend(pushed)
+
+        if len(self.deltas) % self.checkpoint_interval == 0:
+            self.checkpoints.append(tuple(current))
+        self.deltas.append((kept, pushed))
+        self.ops.append(last_op)
+        self.logs.append(log)
+
+    def truncate(self, length):
+        """Remove every step after the first length steps."""
+        current = self.stack_at(length - 1) if length else []
+        del self.deltas[length:]
+        del self.ops[length:]
+        del self.logs[length:]
+        del self.checkpoints[(length + self.checkpoint_interval - 1) // self.checkpoint_interval:]
+        self.current = current
+
+    def stack_size(self, idx):
+        """Get the number of items on the stack at step idx."""
+        kept, pushed = self.deltas[idx]
+        return kept + len(pushed)
+
+    def stack_at(self, idx):
+        """Rebuild the stack at step idx."""
+        if idx == len(self.deltas) - 1:
+            return list(self.current)
+        checkpoint = idx // self.checkpoint_interval
+        stack = list(self.checkpoints[checkpoint])
+        for kept, pushed in self.deltas[checkpoint * self.checkpoint_interval + 1:idx + 1]:
+            del stack[kept:]
+            stack.extend(pushed)
+        return stack
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('step index out of range')
+        return StackState(self.stack_at(idx), self.ops[idx], self.logs[idx])
+
+    def __iter__(self):
+        stack = []
+        for (kept, pushed), last_op, log in zip(self.deltas, self.ops, self.logs):
+            del stack[kept:]
+            stack.extend(pushed)
+            yield StackState(list(stack), last_op, log)
+
 script_engine_class = None
 
-def get_script_engine():
+def get_script_engine(quiet=False, sighash_cache=None, profile=None):
+    """Get the script engine class.
+
+    If quiet is True, the returned callable instantiates
+    the script engine in quiet mode.
+
+    If sighash_cache is specified, the returned callable instantiates
+    the script engine with that SighashCache.
+
+    If profile is specified, the returned callable instantiates
+    the script engine with that ExecutionProfile.
+    """
+    kwargs = {}
+    if quiet:
+        kwargs['quiet'] = True
+    if sighash_cache is not None:
+        kwargs['sighash_cache'] = sighash_cache
+    if profile is not None:
+        kwargs['profile'] = profile
+    if kwargs:
+        return functools.partial(script_engine_class, **kwargs)
     return script_engine_class
 
 def set_script_engine(cls):
@@ -33,51 +326,146 @@ def set_script_engine(cls):
     script_engine_class = cls
 
 class ScriptExecution(object):
-    def __init__(self):
+    """Execution of a script.
+
+    When a script is evaluated again with the same context and only
+    the end of the script has changed, evaluation resumes from the
+    last checkpoint before the change. first_changed_step is the index
+    of the first step that was re-evaluated.
+
+    If profile is an ExecutionProfile, evaluations are profiled with it.
+    """
+    def __init__(self, profile=None):
         super(ScriptExecution, self).__init__()
         self.error = None
-        self.steps = []
+        self.steps = StepHistory()
+        self.profile = profile
+        self.first_changed_step = 0
+        # Checkpoints and ops of the last evaluation, and the context they are valid in.
+        self.checkpoints = []
+        self.checkpoint_ops = ()
+        self.checkpoint_context = None
         # Whether the script exited with a nonzero value.
         self.script_passed = None
         # Whether the script has been verified.
         self.script_verified = False
 
-    def evaluate(self, tx_script, txTo=None, inIdx=0, flags=None, execution_data=None):
+    def evaluate(self, tx_script, txTo=None, inIdx=0, flags=None, execution_data=None, quiet=False, sighash_cache=None):
+        """Evaluate tx_script.
+
+        If quiet is True, no log messages are built and only the
+        final state of the stack is stored in steps.
+
+        sighash_cache is an optional SighashCache for txTo. Passing the same
+        one when evaluating each input of txTo avoids redundant work.
+        """
         self.error = None
-        self.steps = []
         if flags is None:
             flags = ()
         self.script_passed = None
         self.script_verified = False
 
-        stack = get_script_engine()(tx_script, txTo, inIdx, flags, execution_data)
+        profile = self.profile
+        stack = get_script_engine(quiet, sighash_cache, profile)(tx_script, txTo, inIdx, flags, execution_data)
         verifying = stack.verifying
-        iterator = iter(stack)
+        # Resuming would leave the unchanged steps out of the profile.
+        checkpoint = None
+        if profile is None:
+            checkpoint = self.find_checkpoint(stack, tx_script, txTo, inIdx, flags, execution_data, quiet)
+        else:
+            profile.evaluations += 1
+        if checkpoint:
+            self.steps.truncate(checkpoint.num_steps)
+            self.first_changed_step = checkpoint.num_steps
+            stack.checkpoints = list(self.checkpoints)
+            iterator = stack.step(checkpoint)
+        else:
+            self.steps = StepHistory()
+            self.first_changed_step = 0
+            iterator = iter(stack)
+        state = None
         while 1:
             try:
                 state, last_op, log = iterator.next()
-                self.steps.append(StackState(list(state), last_op, log))
+                if not quiet:
+                    self.steps.append(state, last_op, log)
             except StopIteration:
                 break
             except Exception as e:
                 self.error = e
                 break
 
-        if self.steps and self.steps[-1].stack and not self.error:
+        if quiet and state is not None:
+            self.steps.append(state, last_op, '')
+
+        if self.steps and self.steps.current and not self.error:
             if verifying:
                 self.script_verified = True
-            top_value = _CastToBool(self.steps[-1].stack[-1])
+            top_value = _CastToBool(self.steps.current[-1])
             self.script_passed = top_value
+
+        # Keep the engine's checkpoints for the next evaluation.
+        if getattr(stack, 'checkpoints', None) and not quiet and not verifying:
+            self.checkpoints = stack.checkpoints
+            self.checkpoint_ops = parse_script(tx_script).ops
+            self.checkpoint_context = self._checkpoint_context(stack, inIdx, flags, execution_data)
+        else:
+            self.checkpoints = []
+            self.checkpoint_ops = ()
+            self.checkpoint_context = None
         return self.steps
 
+    def _checkpoint_context(self, stack, inIdx, flags, execution_data):
+        return (stack.__class__, inIdx, tuple(flags), execution_data, get_dispatch_table(), opcodes.disabled_opcodes)
+
+    def find_checkpoint(self, stack, tx_script, txTo, inIdx, flags, execution_data, quiet):
+        """Find the last checkpoint from which tx_script can be resumed.
+
+        Returns None if tx_script must be evaluated from the start.
+        """
+        if quiet or txTo is not None or not self.checkpoints or not hasattr(stack, 'checkpoints'):
+            return None
+        # Scripts that are too large fail before executing any op.
+        if len(tx_script) > MAX_SCRIPT_SIZE:
+            return None
+        context = self._checkpoint_context(stack, inIdx, flags, execution_data)
+        if context != self.checkpoint_context:
+            return None
+
+        # Number of leading ops that are unchanged.
+        old_ops = self.checkpoint_ops
+        new_ops = parse_script(tx_script).ops
+        common = 0
+        for old, new in zip(old_ops, new_ops):
+            if old[0] != new[0] or old[1] != new[1]:
+                break
+            common += 1
+
+        found = None
+        for checkpoint in self.checkpoints:
+            if checkpoint.op_index > common:
+                break
+            found = checkpoint
+        # Nothing is saved by resuming from the start.
+        if found is None or found.op_index == 0:
+            return None
+        return found
+
 class Stack(object):
     """State of a Script's execution.
 
     This is the default implementation of a script engine.
     Script engines are iterable. They have an attribute, 'verifying',
     that is True if the script is being verified with a signature script.
+
+    If quiet is True, log messages are not built for each step.
+    If sighash_cache is specified, it is used to compute signature hashes of txTo.
+    If profile is specified, each executed op is recorded in that ExecutionProfile.
     """
-    def __init__(self, tx_script, txTo=None, inIdx=0, flags=None, execution_data=None):
+    # Number of ops between ExecutionCheckpoints.
+    checkpoint_interval = 16
+
+    def __init__(self, tx_script, txTo=None, inIdx=0, flags=None, execution_data=None, quiet=False, sighash_cache=None, profile=None):
         super(Stack, self).__init__()
         self.tx_script = tx_script
         self.txTo = txTo
@@ -86,8 +474,13 @@ class Stack(object):
             flags = ()
         self.flags = flags
         self.execution_data = execution_data
+        self.quiet = quiet
         self.init_stack = []
         self.verifying = True if self.txTo else False
+        self.context = ExecutionContext(txTo, inIdx, flags, execution_data, quiet, sighash_cache)
+        self.profile = profile
+        # ExecutionCheckpoints taken while stepping, if not verifying.
+        self.checkpoints = []
 
     def __iter__(self):
         if self.txTo:
@@ -157,65 +550,83 @@ class Stack(object):
             if not _CastToBool(stack_copy[-1]):
                 raise VerifyScriptError("P2SH inner scriptPubKey returned false")
 
-    def step(self):
+    def step(self, checkpoint=None):
         """Generator for evaluating a script.
 
         Re-implemented _EvalScript from python-bitcoinlib for stack log.
+
+        If checkpoint is specified, evaluation resumes from it.
         """
-        stack = self.init_stack
-        scriptIn = self.tx_script
-        txTo = self.txTo
-        inIdx = self.inIdx
-        flags = self.flags
-        execution_data = self.execution_data
+        ctx = self.context
+        if checkpoint is None:
+            ctx.reset(self.tx_script, self.init_stack)
+            op_index = num_steps = 0
+            self.checkpoints = []
+        else:
+            ctx.restore(self.tx_script, self.init_stack, checkpoint)
+            op_index = checkpoint.op_index
+            num_steps = checkpoint.num_steps
+            self.checkpoints = [i for i in self.checkpoints if i.op_index < op_index]
+        stack = ctx.stack
+        altstack = ctx.altstack
+        vfExec = ctx.vfExec
+        scriptIn = ctx.scriptIn
         if len(scriptIn) > MAX_SCRIPT_SIZE:
             raise EvalScriptError('script too large; got %d bytes; maximum %d bytes' %
                                             (len(scriptIn), MAX_SCRIPT_SIZE),
                                   stack=stack,
                                   scriptIn=scriptIn,
-                                  txTo=txTo,
-                                  inIdx=inIdx,
-                                  flags=flags)
-
-        altstack = []
-        vfExec = []
-        pbegincodehash = 0
-        nOpCount = [0]
+                                  txTo=ctx.txTo,
+                                  inIdx=ctx.inIdx,
+                                  flags=ctx.flags)
+
+        table = get_dispatch_table()
+        disabled_opcodes = set(opcodes.disabled_opcodes)
+        err_raiser = ctx.err_raiser
+        quiet = ctx.quiet
         last = ''
-        for (sop, sop_data, sop_pc) in scriptIn.raw_iter():
-            last = ''
-            fExec = _CheckExec(vfExec)
-
-            def err_raiser(cls, *args):
-                """Helper function for raising EvalScriptError exceptions
-
-                cls   - subclass you want to raise
-
-                *args - arguments
-
-                Fills in the state of execution for you.
-                """
-                raise cls(*args,
-                        sop=sop,
-                        sop_data=sop_data,
-                        sop_pc=sop_pc,
-                        stack=stack, scriptIn=scriptIn, txTo=txTo, inIdx=inIdx, flags=flags,
-                        altstack=altstack, vfExec=vfExec, pbegincodehash=pbegincodehash, nOpCount=nOpCount[0])
-
-
-            if sop in opcodes.disabled_opcodes:
+        parsed = parse_script(scriptIn)
+        ops = parsed.ops
+        # Checkpoints are only valid up to the first signature check,
+        # since its result depends on the rest of the script.
+        take_checkpoints = not quiet and not self.verifying
+        checkpoint_interval = self.checkpoint_interval
+        checkpoints = self.checkpoints
+        profile = self.profile
+        # Without a log to build, fail before executing a script that cannot succeed.
+        if quiet:
+            analysis = parsed.get_analysis()
+            if analysis.errors:
+                raise EvalScriptError(analysis.errors[0],
+                                      stack=stack,
+                                      scriptIn=scriptIn,
+                                      txTo=ctx.txTo,
+                                      inIdx=ctx.inIdx,
+                                      flags=ctx.flags)
+        for op_index in xrange(op_index, len(ops)):
+            (sop, sop_data, sop_pc) = ops[op_index]
+            if profile is not None:
+                op_start = default_timer()
+                op_count_start = ctx.nOpCount[0]
+            if take_checkpoints:
+                if sop in _signature_opcodes:
+                    take_checkpoints = False
+                elif op_index % checkpoint_interval == 0 and op_index:
+                    checkpoints.append(ctx.checkpoint(op_index, num_steps))
+
+            ctx.sop = sop
+            ctx.sop_data = sop_data
+            ctx.sop_pc = sop_pc
+            ctx.fExec = fExec = vfExec.first_false is None
+
+            if sop in disabled_opcodes:
                 err_raiser(EvalScriptError, 'opcode %s is disabled' % opcodes.opcode_names[sop])
 
             if sop > OP_16:
-                nOpCount[0] += 1
-                if nOpCount[0] > MAX_SCRIPT_OPCODES:
+                ctx.nOpCount[0] += 1
+                if ctx.nOpCount[0] > MAX_SCRIPT_OPCODES:
                     err_raiser(MaxOpCountError)
 
-            def check_args(n):
-                if len(stack) < n:
-                    err_raiser(MissingOpArgumentsError, sop, stack, n)
-
-
             if sop <= OP_PUSHDATA4:
                 if len(sop_data) > MAX_SCRIPT_ELEMENT_SIZE:
                     err_raiser(EvalScriptError,
@@ -224,361 +635,726 @@ class Stack(object):
 
                 elif fExec:
                     stack.append(sop_data)
-#                    continue
-                    yield (stack, sop, '%s was pushed to the stack.' % e(sop_data))
+                    if not quiet:
+                        last = '%s was pushed to the stack.' % e(sop_data)
+                    if profile is not None:
+                        profile.record(sop, default_timer() - op_start, ctx)
+                    num_steps += 1
+                    yield (stack, sop, last)
                     continue
 
             elif fExec or (OP_IF <= sop <= OP_ENDIF):
-
-                if opcodes.is_overridden(sop):
-                    yield opcodes.override(sop, stack, txTo, inIdx, flags, execution_data, err_raiser)
-                    continue
-
-                elif sop == OP_1NEGATE or ((sop >= OP_1) and (sop <= OP_16)):
-                    v = sop - (OP_1 - 1)
-                    stack.append(bitcoin.core._bignum.bn2vch(v))
-                    last = '%s was pushed to the stack.' % e(stack[-1])
-
-                elif sop in _ISA_BINOP:
-                    last = _BinOp(sop, stack, err_raiser)
-
-                elif sop in _ISA_UNOP:
-                    last = _UnaryOp(sop, stack, err_raiser)
-
-                elif sop == OP_2DROP:
-                    check_args(2)
-                    last1 = stack.pop()
-                    last2 = stack.pop()
-                    last = '%s and %s were dropped.' % e(last1, last2)
-
-                elif sop == OP_2DUP:
-                    check_args(2)
-                    v1 = stack[-2]
-                    v2 = stack[-1]
-                    stack.append(v1)
-                    stack.append(v2)
-                    last = '%s and %s were copied onto the top.' % e(v1, v2)
-
-                elif sop == OP_2OVER:
-                    check_args(4)
-                    v1 = stack[-4]
-                    v2 = stack[-3]
-                    stack.append(v1)
-                    stack.append(v2)
-                    last = '%s and %s were copied onto the top.' % e(v1, v2)
-
-                elif sop == OP_2ROT:
-                    check_args(6)
-                    v1 = stack[-6]
-                    v2 = stack[-5]
-                    del stack[-6]
-                    del stack[-5]
-                    stack.append(v1)
-                    stack.append(v2)
-                    last = '%s and %s were moved to the top.' % e(v1, v2)
-
-                elif sop == OP_2SWAP:
-                    check_args(4)
-                    tmp = stack[-4]
-                    stack[-4] = stack[-2]
-                    stack[-2] = tmp
-
-                    tmp = stack[-3]
-                    stack[-3] = stack[-1]
-                    stack[-1] = tmp
-                    last = '%s and %s were swapped with %s and %s' % e(*stack[-4:])
-
-                elif sop == OP_3DUP:
-                    check_args(3)
-                    v1 = stack[-3]
-                    v2 = stack[-2]
-                    v3 = stack[-1]
-                    stack.append(v1)
-                    stack.append(v2)
-                    stack.append(v3)
-                    last = '%s, %s and %s were copied onto the top.' % e(v1, v2, v3)
-
-                # TODO stack log
-                elif sop == OP_CHECKMULTISIG or sop == OP_CHECKMULTISIGVERIFY:
-                    tmpScript = CScript(scriptIn[pbegincodehash:])
-                    _CheckMultiSig(sop, tmpScript, stack, txTo, inIdx, err_raiser, nOpCount)
-
-                elif sop == OP_CHECKSIG or sop == OP_CHECKSIGVERIFY:
-                    check_args(2)
-                    vchPubKey = stack[-1]
-                    vchSig = stack[-2]
-                    tmpScript = CScript(scriptIn[pbegincodehash:])
-
-                    # Drop the signature, since there's no way for a signature to sign itself
-                    #
-                    # Of course, this can only come up in very contrived cases now that
-                    # scriptSig and scriptPubKey are processed separately.
-                    tmpScript = FindAndDelete(tmpScript, CScript([vchSig]))
-
-                    ok = _CheckSig(vchSig, vchPubKey, tmpScript, txTo, inIdx,
-                                   err_raiser)
-                    if not ok and sop == OP_CHECKSIGVERIFY:
-                        err_raiser(VerifyOpFailedError, sop)
-
-                    else:
-                        stack.pop()
-                        stack.pop()
-
-                        if ok:
-                            if sop != OP_CHECKSIGVERIFY:
-                                stack.append(b"\x01")
-                        else:
-                            stack.append(b"\x00")
-                        # TODO implement
-                        if txTo is None:
-                            err_raiser(EvalScriptError, 'CHECKSIG opcodes require a spending transaction.')
-                        else:
-                            last1 = 'After %s %s,' % ('CHECKSIG' if sop == OP_CHECKSIG else 'CHECKSIGVERIFY', 'passed' if ok else 'failed')
-                            last2 = '%s was pushed to the stack.' % e(stack[-1])
-                            last = ' '.join([last1, last2])
-
-                elif sop == OP_CODESEPARATOR:
-                    last = '(code separator)'
-                    pbegincodehash = sop_pc
-
-                elif sop == OP_DEPTH:
-                    bn = len(stack)
-                    stack.append(bitcoin.core._bignum.bn2vch(bn))
-                    last = '%s (number of stack items) was pushed to the stack.' % e(stack[-1])
-
-                elif sop == OP_DROP:
-                    check_args(1)
-                    last1 = stack.pop()
-                    last = '%s was dropped.' % e(last1)
-
-                elif sop == OP_DUP:
-                    check_args(1)
-                    v = stack[-1]
-                    stack.append(v)
-                    last = '%s was copied onto the top.' % e(v)
-
-                elif sop == OP_ELSE:
-                    if len(vfExec) == 0:
-                        err_raiser(EvalScriptError, 'ELSE found without prior IF')
-                    vfExec[-1] = not vfExec[-1]
-                    last = 'Skipped ELSE statement.'
-                    if vfExec[-1]:
-                        last = 'Entered ELSE statement.'
-
-                elif sop == OP_ENDIF:
-                    last = 'End of IF statement.'
-                    if len(vfExec) == 0:
-                        err_raiser(EvalScriptError, 'ENDIF found without prior IF')
-                    vfExec.pop()
-
-                elif sop == OP_EQUAL:
-                    check_args(2)
-                    v1 = stack.pop()
-                    v2 = stack.pop()
-
-                    if v1 == v2:
-                        stack.append(b"\x01")
-                    else:
-                        stack.append(b"\x00")
-                    last = '%s EQUALSIGN %s, so %s was pushed to the stack.' % e(v1, v2, stack[-1])
-                    last = last.replace('EQUALSIGN', '==' if v1 == v2 else '!=')
-
-                elif sop == OP_EQUALVERIFY:
-                    check_args(2)
-                    v1 = stack[-1]
-                    v2 = stack[-2]
-
-                    if v1 == v2:
-                        last1 = stack.pop()
-                        last2 = stack.pop()
-                        last = 'EQUALVERIFY passed so %s and %s were dropped.' % e(last1, last2)
-                    else:
-                        err_raiser(VerifyOpFailedError, sop)
-
-                elif sop == OP_FROMALTSTACK:
-                    if len(altstack) < 1:
-                        err_raiser(MissingOpArgumentsError, sop, altstack, 1)
-                    v = altstack.pop()
-                    stack.append(v)
-                    last = '%s was pushed from the altstack to the stack.' % e(v)
-
-                elif sop == OP_HASH160:
-                    check_args(1)
-                    last1 = stack.pop()
-                    stack.append(bitcoin.core.serialize.Hash160(last1))
-                    last = '%s (HASH160 of %s) was pushed to the stack.' % e(stack[-1], last1)
-
-                elif sop == OP_HASH256:
-                    check_args(1)
-                    last1 = stack.pop()
-                    stack.append(bitcoin.core.serialize.Hash(last1))
-                    last = '%s (HASH256 of %s) was pushed to the stack.' % e(stack[-1], last1)
-
-                elif sop == OP_IF or sop == OP_NOTIF:
-                    val = False
-
-                    if fExec:
-                        check_args(1)
-                        vch = stack.pop()
-                        val = _CastToBool(vch)
-                        if sop == OP_NOTIF:
-                            val = not val
-
-                    if val:
-                        last = 'Entered IF statement.'
-                    else:
-                        last = 'Skipped IF statement.'
-                    vfExec.append(val)
-
-
-                elif sop == OP_IFDUP:
-                    check_args(1)
-                    vch = stack[-1]
-                    if _CastToBool(vch):
-                        stack.append(vch)
-                        last = 'The top stack item %s was duplicated.' % e(stack[-1])
-                    else:
-                        last = 'The top stack item %s was not duplicated.' % e(stack[-1])
-
-                elif sop == OP_NIP:
-                    check_args(2)
-                    last1 = stack[-2]
-                    del stack[-2]
-                    last = '%s was removed.' % e(last1)
-
-                elif sop == OP_NOP or (sop >= OP_NOP1 and sop <= OP_NOP10):
-                    last = '(NOP)'
-
-                elif sop == OP_OVER:
-                    check_args(2)
-                    vch = stack[-2]
-                    stack.append(vch)
-                    last = '%s was copied onto the top.' % e(vch)
-
-                elif sop == OP_PICK or sop == OP_ROLL:
-                    check_args(2)
-                    n = _CastToBigNum(stack.pop(), err_raiser)
-                    if n < 0 or n >= len(stack):
-                        err_raiser(EvalScriptError, "Argument for %s out of bounds" % opcodes.opcode_names[sop])
-                    vch = stack[-n-1]
-                    rolled = False # for "last"
-                    if sop == OP_ROLL:
-                        rolled = True
-                        del stack[-n-1]
-                    stack.append(vch)
-                    if rolled:
-                        last = '%s was moved to the top.' % e(vch)
-                    else:
-                        last = '%s was copied onto the top.' % e(vch)
-
-                elif sop == OP_RETURN:
-                    err_raiser(EvalScriptError, "OP_RETURN called")
-
-                elif sop == OP_RIPEMD160:
-                    check_args(1)
-
-                    h = hashlib.new('ripemd160')
-                    tmp = stack.pop()
-                    h.update(tmp)
-                    stack.append(h.digest())
-                    last = '%s (RIPEMD160 of %s) was pushed to the stack.' % e(stack[-1], tmp)
-
-                elif sop == OP_ROT:
-                    check_args(3)
-                    tmp = stack[-3]
-                    stack[-3] = stack[-2]
-                    stack[-2] = tmp
-
-                    tmp = stack[-2]
-                    stack[-2] = stack[-1]
-                    stack[-1] = tmp
-                    last = '%s, %s and %s were rotated to the left.' % e(stack[-1], stack[-3], stack[-2])
-
-                elif sop == OP_SIZE:
-                    check_args(1)
-                    bn = len(stack[-1])
-                    stack.append(bitcoin.core._bignum.bn2vch(bn))
-                    last = '%s (string length of %s) was pushed to the stack.' % e(stack[-1], stack[-2])
-
-                elif sop == OP_SHA1:
-                    check_args(1)
-                    last1 = stack.pop()
-                    stack.append(hashlib.sha1(last1).digest())
-                    last = '%s (SHA1 of %s) was pushed to the stack.' % e(stack[-1], last1)
-
-                elif sop == OP_SHA256:
-                    check_args(1)
-                    last1 = stack.pop()
-                    stack.append(hashlib.sha256(last1).digest())
-                    last = '%s (SHA256 of %s) was pushed to the stack.' % e(stack[-1], last1)
-
-                elif sop == OP_SWAP:
-                    check_args(2)
-                    tmp = stack[-2]
-                    stack[-2] = stack[-1]
-                    stack[-1] = tmp
-                    last = '%s and %s were swapped.' % e(stack[-1], stack[-2])
-
-                elif sop == OP_TOALTSTACK:
-                    check_args(1)
-                    v = stack.pop()
-                    altstack.append(v)
-                    last = '%s was pushed to the altstack.' % e(v)
-
-                elif sop == OP_TUCK:
-                    check_args(2)
-                    vch = stack[-1]
-                    stack.insert(len(stack) - 2, vch)
-                    last = '%s was copied into the second-to-top position.' % e(vch)
-
-                elif sop == OP_VERIFY:
-                    check_args(1)
-                    v = _CastToBool(stack[-1])
-                    if v:
-                        last1 = stack.pop()
-                        last = '%s was dropped after VERIFY passed.' % e(last1)
-                    else:
-                        raise err_raiser(VerifyOpFailedError, sop)
-
-                elif sop == OP_WITHIN:
-                    check_args(3)
-                    bn3 = _CastToBigNum(stack[-1], err_raiser)
-                    bn2 = _CastToBigNum(stack[-2], err_raiser)
-                    bn1 = _CastToBigNum(stack[-3], err_raiser)
-                    l3 = stack.pop()
-                    l2 = stack.pop()
-                    l1 = stack.pop()
-                    v = (bn2 <= bn1) and (bn1 < bn3)
-                    if v:
-                        stack.append(b"\x01")
-                    else:
-                        stack.append(b"\x00")
-                    last = '%s (the result of %s <= %s < %s) was pushed to the stack.' % e(stack[-1], l2, l1, l3)
-
-                else:
+                handler = table.get(sop)
+                if handler is None:
                     err_raiser(EvalScriptError, 'unsupported opcode 0x%x' % sop)
 
-                yield (stack, sop, last)
+                last = handler(ctx, sop)
+                if profile is not None:
+                    sigops = 0
+                    if sop in (OP_CHECKSIG, OP_CHECKSIGVERIFY):
+                        sigops = 1
+                    elif sop in (OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY):
+                        # CHECKMULTISIG adds its number of keys to the opcount.
+                        sigops = ctx.nOpCount[0] - op_count_start - 1
+                    profile.record(sop, default_timer() - op_start, ctx, sigops)
+                num_steps += 1
+                # Opcode overrides can report a different opcode.
+                yield (stack, ctx.sop, last)
 
             # size limits
             if len(stack) + len(altstack) > MAX_STACK_ITEMS:
                 err_raiser(EvalScriptError, 'max stack items limit reached')
 
+        # Script could not be parsed past the last op.
+        if parsed.error:
+            raise parsed.error
+
         # Unterminated IF/NOTIF/ELSE block
         if len(vfExec):
             raise EvalScriptError('Unterminated IF/ELSE block',
                                   stack=stack,
                                   scriptIn=scriptIn,
-                                  txTo=txTo,
-                                  inIdx=inIdx,
-                                  flags=flags)
+                                  txTo=ctx.txTo,
+                                  inIdx=ctx.inIdx,
+                                  flags=ctx.flags)
 
 
+class ExecutionContext(object):
+    """State of a script's execution within a Stack.
+
+    Opcode handlers receive the context as their first argument,
+    so no per-opcode state needs to be created while stepping.
+    A Stack reuses its context for each script that it evaluates.
+    """
+    def __init__(self, txTo=None, inIdx=0, flags=(), execution_data=None, quiet=False, sighash_cache=None):
+        super(ExecutionContext, self).__init__()
+        self.txTo = txTo
+        self.inIdx = inIdx
+        self.flags = flags
+        self.execution_data = execution_data
+        self.quiet = quiet
+        self.sighash_cache = sighash_cache
+        self.reset(CScript(), [])
+
+    def reset(self, scriptIn, stack):
+        """Prepare to evaluate scriptIn with stack."""
+        self.scriptIn = scriptIn
+        self.stack = stack
+        self.altstack = []
+        self.vfExec = ConditionStack()
+        self.fExec = True
+        self.pbegincodehash = 0
+        # List so that _CheckMultiSig can increment it.
+        self.nOpCount = [0]
+        self.sop = None
+        self.sop_data = None
+        self.sop_pc = None
+
+    def checkpoint(self, op_index, num_steps):
+        """Get an ExecutionCheckpoint of the current state."""
+        return ExecutionCheckpoint(op_index, num_steps, tuple(self.stack), tuple(self.altstack),
+                                   tuple(self.vfExec), self.nOpCount[0], self.pbegincodehash)
+
+    def restore(self, scriptIn, stack, checkpoint):
+        """Prepare to resume evaluating scriptIn from checkpoint."""
+        self.reset(scriptIn, stack)
+        stack[:] = checkpoint.stack
+        self.altstack.extend(checkpoint.altstack)
+        self.vfExec.extend(checkpoint.vfExec)
+        self.nOpCount[0] = checkpoint.nOpCount
+        self.pbegincodehash = checkpoint.pbegincodehash
+
+    def err_raiser(self, cls, *args):
+        """Helper function for raising EvalScriptError exceptions
+
+        cls   - subclass you want to raise
+
+        *args - arguments
+
+        Fills in the state of execution for you.
+        """
+        raise cls(*args,
+                sop=self.sop,
+                sop_data=self.sop_data,
+                sop_pc=self.sop_pc,
+                stack=self.stack, scriptIn=self.scriptIn, txTo=self.txTo, inIdx=self.inIdx, flags=self.flags,
+                altstack=self.altstack, vfExec=list(self.vfExec), pbegincodehash=self.pbegincodehash, nOpCount=self.nOpCount[0])
+
+    def check_args(self, n):
+        if len(self.stack) < n:
+            self.err_raiser(MissingOpArgumentsError, self.sop, self.stack, n)
+
+    def raw_signature_hash(self, script, hashtype):
+        """Get the signature hash of the input being evaluated."""
+        if self.txTo is None:
+            self.err_raiser(EvalScriptError, 'CHECKSIG opcodes require a spending transaction.')
+        if self.sighash_cache is None:
+            self.sighash_cache = transaction.SighashCache(self.txTo)
+        return self.sighash_cache.raw_signature_hash(script, self.inIdx, hashtype)
+
+
+# Opcode handlers.
+#
+# Each handler takes the arguments (ctx, sop), where ctx is an
+# ExecutionContext, and returns a log message for the step.
+
+def _op_small_int(ctx, sop):
+    stack = ctx.stack
+    v = sop - (OP_1 - 1)
+    stack.append(_num_item(v))
+    if ctx.quiet:
+        return ''
+    return '%s was pushed to the stack.' % e(stack[-1])
+
+def _op_binop(ctx, sop):
+    return _BinOp(sop, ctx.stack, ctx.err_raiser, ctx.quiet)
+
+def _op_unop(ctx, sop):
+    return _UnaryOp(sop, ctx.stack, ctx.err_raiser, ctx.quiet)
+
+def _op_2drop(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    last1 = stack.pop()
+    last2 = stack.pop()
+    if ctx.quiet:
+        return ''
+    return '%s and %s were dropped.' % e(last1, last2)
+
+def _op_2dup(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    v1 = stack[-2]
+    v2 = stack[-1]
+    stack.append(v1)
+    stack.append(v2)
+    if ctx.quiet:
+        return ''
+    return '%s and %s were copied onto the top.' % e(v1, v2)
+
+def _op_2over(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(4)
+    v1 = stack[-4]
+    v2 = stack[-3]
+    stack.append(v1)
+    stack.append(v2)
+    if ctx.quiet:
+        return ''
+    return '%s and %s were copied onto the top.' % e(v1, v2)
+
+def _op_2rot(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(6)
+    v1 = stack[-6]
+    v2 = stack[-5]
+    del stack[-6]
+    del stack[-5]
+    stack.append(v1)
+    stack.append(v2)
+    if ctx.quiet:
+        return ''
+    return '%s and %s were moved to the top.' % e(v1, v2)
+
+def _op_2swap(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(4)
+    tmp = stack[-4]
+    stack[-4] = stack[-2]
+    stack[-2] = tmp
+
+    tmp = stack[-3]
+    stack[-3] = stack[-1]
+    stack[-1] = tmp
+    if ctx.quiet:
+        return ''
+    return '%s and %s were swapped with %s and %s' % e(*stack[-4:])
+
+def _op_3dup(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(3)
+    v1 = stack[-3]
+    v2 = stack[-2]
+    v3 = stack[-1]
+    stack.append(v1)
+    stack.append(v2)
+    stack.append(v3)
+    if ctx.quiet:
+        return ''
+    return '%s, %s and %s were copied onto the top.' % e(v1, v2, v3)
+
+# TODO stack log
+def _op_checkmultisig(ctx, sop):
+    tmpScript = CScript(ctx.scriptIn[ctx.pbegincodehash:])
+    _CheckMultiSig(sop, tmpScript, ctx.stack, ctx, ctx.err_raiser, ctx.nOpCount)
+    return ''
+
+def _op_checksig(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    vchPubKey = stack[-1]
+    vchSig = stack[-2]
+    tmpScript = CScript(ctx.scriptIn[ctx.pbegincodehash:])
+
+    # Drop the signature, since there's no way for a signature to sign itself
+    #
+    # Of course, this can only come up in very contrived cases now that
+    # scriptSig and scriptPubKey are processed separately.
+    tmpScript = FindAndDelete(tmpScript, CScript([vchSig]))
+
+    ok = _CheckSig(vchSig, vchPubKey, tmpScript, ctx, ctx.err_raiser)
+    if not ok and sop == OP_CHECKSIGVERIFY:
+        ctx.err_raiser(VerifyOpFailedError, sop)
+
+    stack.pop()
+    stack.pop()
+
+    if ok:
+        if sop != OP_CHECKSIGVERIFY:
+            stack.append(b"\x01")
+    else:
+        stack.append(b"\x00")
+    # TODO implement
+    if ctx.txTo is None:
+        ctx.err_raiser(EvalScriptError, 'CHECKSIG opcodes require a spending transaction.')
+    if ctx.quiet:
+        return ''
+    last1 = 'After %s %s,' % ('CHECKSIG' if sop == OP_CHECKSIG else 'CHECKSIGVERIFY', 'passed' if ok else 'failed')
+    last2 = '%s was pushed to the stack.' % e(stack[-1])
+    return ' '.join([last1, last2])
+
+def _op_codeseparator(ctx, sop):
+    ctx.pbegincodehash = ctx.sop_pc
+    if ctx.quiet:
+        return ''
+    return '(code separator)'
+
+def _op_depth(ctx, sop):
+    stack = ctx.stack
+    bn = len(stack)
+    stack.append(_num_item(bn))
+    if ctx.quiet:
+        return ''
+    return '%s (number of stack items) was pushed to the stack.' % e(stack[-1])
+
+def _op_drop(ctx, sop):
+    ctx.check_args(1)
+    last1 = ctx.stack.pop()
+    if ctx.quiet:
+        return ''
+    return '%s was dropped.' % e(last1)
+
+def _op_dup(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(1)
+    v = stack[-1]
+    stack.append(v)
+    if ctx.quiet:
+        return ''
+    return '%s was copied onto the top.' % e(v)
+
+def _op_else(ctx, sop):
+    vfExec = ctx.vfExec
+    if len(vfExec) == 0:
+        ctx.err_raiser(EvalScriptError, 'ELSE found without prior IF')
+    val = vfExec.toggle_top()
+    if ctx.quiet:
+        return ''
+    if val:
+        return 'Entered ELSE statement.'
+    return 'Skipped ELSE statement.'
+
+def _op_endif(ctx, sop):
+    if len(ctx.vfExec) == 0:
+        ctx.err_raiser(EvalScriptError, 'ENDIF found without prior IF')
+    ctx.vfExec.pop()
+    if ctx.quiet:
+        return ''
+    return 'End of IF statement.'
+
+def _op_equal(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    v1 = stack.pop()
+    v2 = stack.pop()
+
+    if v1 == v2:
+        stack.append(b"\x01")
+    else:
+        stack.append(b"\x00")
+    if ctx.quiet:
+        return ''
+    last = '%s EQUALSIGN %s, so %s was pushed to the stack.' % e(v1, v2, stack[-1])
+    return last.replace('EQUALSIGN', '==' if v1 == v2 else '!=')
+
+def _op_equalverify(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    v1 = stack[-1]
+    v2 = stack[-2]
+
+    if v1 != v2:
+        ctx.err_raiser(VerifyOpFailedError, sop)
+    last1 = stack.pop()
+    last2 = stack.pop()
+    if ctx.quiet:
+        return ''
+    return 'EQUALVERIFY passed so %s and %s were dropped.' % e(last1, last2)
+
+def _op_fromaltstack(ctx, sop):
+    altstack = ctx.altstack
+    if len(altstack) < 1:
+        ctx.err_raiser(MissingOpArgumentsError, sop, altstack, 1)
+    v = altstack.pop()
+    ctx.stack.append(v)
+    if ctx.quiet:
+        return ''
+    return '%s was pushed from the altstack to the stack.' % e(v)
+
+def _op_hash160(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(1)
+    last1 = stack.pop()
+    stack.append(bitcoin.core.serialize.Hash160(last1))
+    if ctx.quiet:
+        return ''
+    return '%s (HASH160 of %s) was pushed to the stack.' % e(stack[-1], last1)
+
+def _op_hash256(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(1)
+    last1 = stack.pop()
+    stack.append(bitcoin.core.serialize.Hash(last1))
+    if ctx.quiet:
+        return ''
+    return '%s (HASH256 of %s) was pushed to the stack.' % e(stack[-1], last1)
+
+def _op_if(ctx, sop):
+    val = False
+
+    if ctx.fExec:
+        ctx.check_args(1)
+        vch = ctx.stack.pop()
+        val = _CastToBool(vch)
+        if sop == OP_NOTIF:
+            val = not val
+
+    ctx.vfExec.append(val)
+    if ctx.quiet:
+        return ''
+    if val:
+        return 'Entered IF statement.'
+    return 'Skipped IF statement.'
+
+def _op_ifdup(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(1)
+    vch = stack[-1]
+    if _CastToBool(vch):
+        stack.append(vch)
+        if ctx.quiet:
+            return ''
+        return 'The top stack item %s was duplicated.' % e(stack[-1])
+    if ctx.quiet:
+        return ''
+    return 'The top stack item %s was not duplicated.' % e(stack[-1])
+
+def _op_nip(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    last1 = stack[-2]
+    del stack[-2]
+    if ctx.quiet:
+        return ''
+    return '%s was removed.' % e(last1)
+
+def _op_nop(ctx, sop):
+    if ctx.quiet:
+        return ''
+    return '(NOP)'
+
+def _op_over(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    vch = stack[-2]
+    stack.append(vch)
+    if ctx.quiet:
+        return ''
+    return '%s was copied onto the top.' % e(vch)
+
+def _op_pick_roll(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    n = _CastToNum(stack.pop(), ctx.err_raiser)
+    if n < 0 or n >= len(stack):
+        ctx.err_raiser(EvalScriptError, "Argument for %s out of bounds" % opcodes.opcode_names[sop])
+    vch = stack[-n-1]
+    if sop == OP_ROLL:
+        del stack[-n-1]
+    stack.append(vch)
+    if ctx.quiet:
+        return ''
+    if sop == OP_ROLL:
+        return '%s was moved to the top.' % e(vch)
+    return '%s was copied onto the top.' % e(vch)
+
+def _op_return(ctx, sop):
+    ctx.err_raiser(EvalScriptError, "OP_RETURN called")
+
+def _op_ripemd160(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(1)
+
+    h = hashlib.new('ripemd160')
+    tmp = stack.pop()
+    h.update(tmp)
+    stack.append(h.digest())
+    if ctx.quiet:
+        return ''
+    return '%s (RIPEMD160 of %s) was pushed to the stack.' % e(stack[-1], tmp)
+
+def _op_rot(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(3)
+    tmp = stack[-3]
+    stack[-3] = stack[-2]
+    stack[-2] = tmp
+
+    tmp = stack[-2]
+    stack[-2] = stack[-1]
+    stack[-1] = tmp
+    if ctx.quiet:
+        return ''
+    return '%s, %s and %s were rotated to the left.' % e(stack[-1], stack[-3], stack[-2])
+
+def _op_size(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(1)
+    bn = len(stack[-1])
+    stack.append(_num_item(bn))
+    if ctx.quiet:
+        return ''
+    return '%s (string length of %s) was pushed to the stack.' % e(stack[-1], stack[-2])
+
+def _op_sha1(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(1)
+    last1 = stack.pop()
+    stack.append(hashlib.sha1(last1).digest())
+    if ctx.quiet:
+        return ''
+    return '%s (SHA1 of %s) was pushed to the stack.' % e(stack[-1], last1)
+
+def _op_sha256(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(1)
+    last1 = stack.pop()
+    stack.append(hashlib.sha256(last1).digest())
+    if ctx.quiet:
+        return ''
+    return '%s (SHA256 of %s) was pushed to the stack.' % e(stack[-1], last1)
+
+def _op_swap(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    tmp = stack[-2]
+    stack[-2] = stack[-1]
+    stack[-1] = tmp
+    if ctx.quiet:
+        return ''
+    return '%s and %s were swapped.' % e(stack[-1], stack[-2])
+
+def _op_toaltstack(ctx, sop):
+    ctx.check_args(1)
+    v = ctx.stack.pop()
+    ctx.altstack.append(v)
+    if ctx.quiet:
+        return ''
+    return '%s was pushed to the altstack.' % e(v)
+
+def _op_tuck(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(2)
+    vch = stack[-1]
+    stack.insert(len(stack) - 2, vch)
+    if ctx.quiet:
+        return ''
+    return '%s was copied into the second-to-top position.' % e(vch)
+
+def _op_verify(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(1)
+    if not _CastToBool(stack[-1]):
+        ctx.err_raiser(VerifyOpFailedError, sop)
+    last1 = stack.pop()
+    if ctx.quiet:
+        return ''
+    return '%s was dropped after VERIFY passed.' % e(last1)
+
+def _op_within(ctx, sop):
+    stack = ctx.stack
+    ctx.check_args(3)
+    bn3 = _CastToNum(stack[-1], ctx.err_raiser)
+    bn2 = _CastToNum(stack[-2], ctx.err_raiser)
+    bn1 = _CastToNum(stack[-3], ctx.err_raiser)
+    l3 = stack.pop()
+    l2 = stack.pop()
+    l1 = stack.pop()
+    v = (bn2 <= bn1) and (bn1 < bn3)
+    if v:
+        stack.append(b"\x01")
+    else:
+        stack.append(b"\x00")
+    if ctx.quiet:
+        return ''
+    return '%s (the result of %s <= %s < %s) was pushed to the stack.' % e(stack[-1], l2, l1, l3)
+
+def _override_handler(func):
+    """Wrap an opcode override function so it can be used as an opcode handler.
+
+    Overrides return (stack, opcode, log). Since Stack.step() keeps a reference
+    to the context's stack, a returned stack replaces its contents. The returned
+    opcode is recorded as the step's opcode.
+    """
+    def handler(ctx, sop):
+        stack, op, last = func(ctx.stack, ctx.txTo, ctx.inIdx, ctx.flags, ctx.execution_data, ctx.err_raiser)
+        if stack is not ctx.stack:
+            ctx.stack[:] = stack
+        ctx.sop = op
+        return last
+    return handler
+
+def build_dispatch_table(overrides=None):
+    """Build a dict of {opcode: handler} for the Stack class.
+
+    Args:
+        overrides (dict): Dict of {opcode_value: override_func}, such as
+            opcodes.overridden_opcodes. Overrides take precedence over
+            the default handlers.
+    """
+    table = {
+        OP_1NEGATE: _op_small_int,
+        OP_2DROP: _op_2drop,
+        OP_2DUP: _op_2dup,
+        OP_2OVER: _op_2over,
+        OP_2ROT: _op_2rot,
+        OP_2SWAP: _op_2swap,
+        OP_3DUP: _op_3dup,
+        OP_CHECKMULTISIG: _op_checkmultisig,
+        OP_CHECKMULTISIGVERIFY: _op_checkmultisig,
+        OP_CHECKSIG: _op_checksig,
+        OP_CHECKSIGVERIFY: _op_checksig,
+        OP_CODESEPARATOR: _op_codeseparator,
+        OP_DEPTH: _op_depth,
+        OP_DROP: _op_drop,
+        OP_DUP: _op_dup,
+        OP_ELSE: _op_else,
+        OP_ENDIF: _op_endif,
+        OP_EQUAL: _op_equal,
+        OP_EQUALVERIFY: _op_equalverify,
+        OP_FROMALTSTACK: _op_fromaltstack,
+        OP_HASH160: _op_hash160,
+        OP_HASH256: _op_hash256,
+        OP_IF: _op_if,
+        OP_NOTIF: _op_if,
+        OP_IFDUP: _op_ifdup,
+        OP_NIP: _op_nip,
+        OP_NOP: _op_nop,
+        OP_OVER: _op_over,
+        OP_PICK: _op_pick_roll,
+        OP_ROLL: _op_pick_roll,
+        OP_RETURN: _op_return,
+        OP_RIPEMD160: _op_ripemd160,
+        OP_ROT: _op_rot,
+        OP_SIZE: _op_size,
+        OP_SHA1: _op_sha1,
+        OP_SHA256: _op_sha256,
+        OP_SWAP: _op_swap,
+        OP_TOALTSTACK: _op_toaltstack,
+        OP_TUCK: _op_tuck,
+        OP_VERIFY: _op_verify,
+        OP_WITHIN: _op_within,
+    }
+    for op in range(OP_1, OP_16 + 1):
+        table[op] = _op_small_int
+    for op in range(OP_NOP1, OP_NOP10 + 1):
+        table[op] = _op_nop
+    for op in _ISA_BINOP:
+        table[op] = _op_binop
+    for op in _ISA_UNOP:
+        table[op] = _op_unop
+
+    if overrides:
+        for op, func in overrides.items():
+            table[op] = _override_handler(func)
+    return table
+
+_dispatch_table = build_dispatch_table()
+_dispatch_overrides = {}
+
+_signature_opcodes = frozenset([OP_CHECKSIG, OP_CHECKSIGVERIFY, OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY])
+
+def get_dispatch_table():
+    """Get the {opcode: handler} dict for the current opcode overrides.
+
+    The table is rebuilt only when the overridden opcodes change.
+    """
+    global _dispatch_table, _dispatch_overrides
+    if opcodes.overridden_opcodes is not _dispatch_overrides:
+        _dispatch_overrides = opcodes.overridden_opcodes
+        _dispatch_table = build_dispatch_table(_dispatch_overrides)
+    return _dispatch_table
+
+# Re-implemented here from python-bitcoinlib to use the signature and sighash caches.
+# Takes an ExecutionContext instead of txTo and inIdx.
+def _CheckSig(sig, pubkey, script, ctx, err_raiser):
+    if len(sig) == 0:
+        return False
+    hashtype = _bord(sig[-1])
+    sig = sig[:-1]
+
+    # Raw signature hash due to the SIGHASH_SINGLE bug
+    (h, err) = ctx.raw_signature_hash(script, hashtype)
+    cache_key = (h, pubkey, sig)
+    result = signature_cache.get(cache_key)
+    if result is None:
+        key = bitcoin.core.key.CECKey()
+        key.set_pubkey(pubkey)
+        result = key.verify(h, sig)
+        signature_cache.put(cache_key, result)
+    return result
+
+# Re-implemented here from python-bitcoinlib to use the signature and sighash caches.
+# Takes an ExecutionContext instead of txTo and inIdx.
+def _CheckMultiSig(opcode, script, stack, ctx, err_raiser, nOpCount):
+    i = 1
+    if len(stack) < i:
+        err_raiser(MissingOpArgumentsError, opcode, stack, i)
+
+    keys_count = _CastToNum(stack[-i], err_raiser)
+    if keys_count < 0 or keys_count > 20:
+        err_raiser(ArgumentsInvalidError, opcode, "keys count invalid")
+    i += 1
+    ikey = i
+    i += keys_count
+    nOpCount[0] += keys_count
+    if nOpCount[0] > MAX_SCRIPT_OPCODES:
+        err_raiser(MaxOpCountError)
+    if len(stack) < i:
+        err_raiser(ArgumentsInvalidError, opcode, "not enough keys on stack")
+
+    sigs_count = _CastToNum(stack[-i], err_raiser)
+    if sigs_count < 0 or sigs_count > keys_count:
+        err_raiser(ArgumentsInvalidError, opcode, "sigs count invalid")
+
+    i += 1
+    isig = i
+    i += sigs_count
+    if len(stack) < i-1:
+        err_raiser(ArgumentsInvalidError, opcode, "not enough sigs on stack")
+    elif len(stack) < i:
+        err_raiser(ArgumentsInvalidError, opcode, "missing dummy value")
+
+    # Drop the signature, since there's no way for a signature to sign itself
+    for k in range(sigs_count):
+        sig = stack[-isig - k]
+        script = FindAndDelete(script, CScript([sig]))
+
+    success = True
+
+    while success and sigs_count > 0:
+        sig = stack[-isig]
+        pubkey = stack[-ikey]
+
+        if _CheckSig(sig, pubkey, script, ctx, err_raiser):
+            isig += 1
+            sigs_count -= 1
+
+        ikey += 1
+        keys_count -= 1
+
+        if sigs_count > keys_count:
+            success = False
+
+            # with VERIFY bail now before we modify the stack
+            if opcode == OP_CHECKMULTISIGVERIFY:
+                err_raiser(VerifyOpFailedError, opcode)
+
+    while i > 0:
+        stack.pop()
+        i -= 1
+
+    if opcode == OP_CHECKMULTISIG:
+        if success:
+            stack.append(b"\x01")
+        else:
+            stack.append(b"\x00")
+
 # Re-implemented here from python-bitcoinlib for stack log.
-def _UnaryOp(opcode, stack, err_raiser):
+def _UnaryOp(opcode, stack, err_raiser, quiet=False):
     if len(stack) < 1:
         err_raiser(MissingOpArgumentsError, opcode, stack, 1)
-    bn = _CastToBigNum(stack[-1], err_raiser)
+    bn = _CastToNum(stack[-1], err_raiser)
     last2 = stack.pop()
     last1 = ''
 
@@ -610,18 +1386,20 @@ def _UnaryOp(opcode, stack, err_raiser):
     else:
         raise AssertionError("Unknown unary opcode encountered; this should not happen")
 
-    stack.append(bitcoin.core._bignum.bn2vch(bn))
+    stack.append(_num_item(bn))
+    if quiet:
+        return ''
     last = '%s %s' % (last2, last1)
     return last
 
 
 # Re-implemented here from python-bitcoinlib for stack log.
-def _BinOp(opcode, stack, err_raiser):
+def _BinOp(opcode, stack, err_raiser, quiet=False):
     if len(stack) < 2:
         err_raiser(MissingOpArgumentsError, opcode, stack, 2)
 
-    bn2 = _CastToBigNum(stack[-1], err_raiser)
-    bn1 = _CastToBigNum(stack[-2], err_raiser)
+    bn2 = _CastToNum(stack[-1], err_raiser)
+    bn1 = _CastToNum(stack[-2], err_raiser)
 
     # We don't pop the stack yet so that OP_NUMEQUALVERIFY can raise
     # VerifyOpFailedError with a correct stack.
@@ -694,10 +1472,12 @@ def _BinOp(opcode, stack, err_raiser):
     else:
         raise AssertionError("Unknown binop opcode encountered; this should not happen")
 
-    last = '%s (%s %s %s) was pushed to the stack.' % (bn, bn1, last1, bn2)
     stack.pop()
     stack.pop()
-    stack.append(bitcoin.core._bignum.bn2vch(bn))
+    stack.append(_num_item(bn))
+    if quiet:
+        return ''
+    last = '%s (%s %s %s) was pushed to the stack.' % (bn, bn1, last1, bn2)
     return last
 
 
@@ -1,8 +1,14 @@
+from array import array
+import hashlib
+from io import BytesIO
 import struct
 
-from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut, b2x
-from bitcoin.core.serialize import ser_read, BytesSerializer, VectorSerializer
-from bitcoin.core.script import SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE, SIGHASH_ANYONECANPAY
+from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut, CMutableOutPoint, b2x
+from bitcoin.core.serialize import ser_read, SerializationTruncationError, BytesSerializer, VectorSerializer, VarIntSerializer
+from bitcoin.core.script import (SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE, SIGHASH_ANYONECANPAY,
+            FindAndDelete, CScript, OP_CODESEPARATOR)
+
+from serialization import compile_fields, BufferReader, CacheStats, MemoizedSerializable
 
 transaction_fields = [
     ('nVersion', b'<i', 4, 1),
@@ -53,17 +59,62 @@ def sig_hash_explanation(hash_type):
     return explanations.get(hash_type)
 
 
+def _read_inputs(f):
+    return VectorSerializer.stream_deserialize(CMutableTxIn, f)
+
+def _write_inputs(vin, f):
+    VectorSerializer.stream_serialize(CMutableTxIn, vin, f)
+
+def _read_outputs(f):
+    return VectorSerializer.stream_deserialize(CMutableTxOut, f)
+
+def _write_outputs(vout, f):
+    VectorSerializer.stream_serialize(CMutableTxOut, vout, f)
+
 class TransactionSerializer(object):
-    """Default transaction serialization handler."""
+    """Default transaction serialization handler.
+
+    The fields are compiled into a FieldLayout when the serializer is created.
+    Use get_serializer() to get a cached serializer for a list of fields.
+
+    Subclasses that override deserialize_field() and serialize_field()
+    should list the fields that those methods handle in custom_fields.
+    If custom_fields is None, those methods handle every field.
+    """
+    custom_fields = None
+    formats = {
+        'inputs': (_read_inputs, _write_inputs),
+        'outputs': (_read_outputs, _write_outputs),
+        'bytes': (BytesSerializer.stream_deserialize, BytesSerializer.stream_serialize),
+    }
+    def __init__(self, fields=None):
+        super(TransactionSerializer, self).__init__()
+        if fields is None:
+            fields = transaction_fields
+        self.fields = list(fields)
+        self.layout = self.compile(self.fields)
+
+    def compile(self, fields):
+        custom_fields = self.custom_fields
+        if custom_fields is None:
+            cls = self.__class__
+            if (cls.deserialize_field.__func__ is TransactionSerializer.deserialize_field.__func__
+                    and cls.serialize_field.__func__ is TransactionSerializer.serialize_field.__func__):
+                custom_fields = ()
+            else:
+                custom_fields = [i[0] for i in fields]
+        return compile_fields(fields, self.formats, custom_fields)
+
+    def get_layout(self, tx):
+        if tx.fields == self.fields:
+            return self.layout
+        return get_serializer(self.__class__, tx.fields).layout
+
     def stream_deserialize(self, tx, f):
-        kwargs = {}
-        for attr, fmt, num_bytes, _ in tx.fields:
-            self.deserialize_field(tx, kwargs, attr, fmt, num_bytes, f)
-        return kwargs
+        return self.get_layout(tx).read(f, {}, tx, self)
 
     def stream_serialize(self, tx, f):
-        for attr, fmt, num_bytes, _ in tx.fields:
-            self.serialize_field(tx, attr, fmt, num_bytes, f)
+        self.get_layout(tx).write(tx, f, self)
 
     def deserialize_field(self, tx, kwargs, attr, fmt, num_bytes, f):
         if fmt not in ['inputs', 'outputs', 'bytes']:
@@ -85,7 +136,28 @@ class TransactionSerializer(object):
         elif fmt == 'bytes':
             BytesSerializer.stream_serialize(getattr(tx, attr), f)
 
-class Transaction(CMutableTransaction):
+_serializers = {}
+
+def get_serializer(serializer_class=None, fields=None):
+    """Get a compiled serializer.
+
+    Serializers are cached by their class and fields.
+
+    Args:
+        serializer_class: Serializer class. Defaults to Transaction.serializer_class.
+        fields (list): Transaction fields. Defaults to the global transaction_fields.
+    """
+    if serializer_class is None:
+        serializer_class = Transaction.serializer_class
+    if fields is None:
+        fields = transaction_fields
+    key = (serializer_class, tuple(fields))
+    serializer = _serializers.get(key)
+    if serializer is None:
+        serializer = _serializers[key] = serializer_class(fields)
+    return serializer
+
+class Transaction(MemoizedSerializable, CMutableTransaction):
     """Cryptocurrency transaction.
 
     Subclassed from CMutableTransaction so that its fields
@@ -96,8 +168,12 @@ class Transaction(CMutableTransaction):
 
     For the most common purposes, chainparams.set_to_preset()
     can be used instead.
+
+    The serialization and hash are cached until a field, input,
+    or output changes.
     """
     serializer_class = TransactionSerializer
+    cache_stats = CacheStats()
     def __init__(self, vin=None, vout=None, locktime=0, version=1, fields=None, kwfields=None):
         super(Transaction, self).__init__(vin, vout, locktime, version)
         if kwfields is None: kwfields = {}
@@ -128,13 +204,28 @@ class Transaction(CMutableTransaction):
     @classmethod
     def stream_deserialize(cls, f):
         self = cls()
-        kwargs = self.serializer_class().stream_deserialize(self, f)
+        kwargs = get_serializer(self.serializer_class, self.fields).stream_deserialize(self, f)
+        # Set the fields without a new generation for each one.
         for k, v in kwargs.items():
-            setattr(self, k, v)
+            object.__setattr__(self, k, v)
+        self.invalidate_cache()
         return self
 
-    def stream_serialize(self, f):
-        self.serializer_class().stream_serialize(self, f)
+    def cache_state(self):
+        state = [self.serializer_class, tuple(self.fields)]
+        for attr, fmt, _, _ in self.fields:
+            value = getattr(self, attr)
+            if fmt == 'inputs':
+                value = tuple([(i.prevout.hash, i.prevout.n, i.scriptSig, i.nSequence) for i in value])
+            elif fmt == 'outputs':
+                value = tuple([(o.nValue, o.scriptPubKey) for o in value])
+            state.append(value)
+        return state
+
+    def _serialize(self):
+        f = BytesIO()
+        get_serializer(self.serializer_class, self.fields).stream_serialize(self, f)
+        return f.getvalue()
 
     @classmethod
     def from_tx(cls, tx):
@@ -159,6 +250,434 @@ class Transaction(CMutableTransaction):
     def as_hex(self):
         return b2x(self.serialize())
 
+def _read_compact_size(data, pos):
+    """Read a compact size integer from data at pos.
+
+    Returns:
+        A 2-tuple of (value, position after the integer).
+    """
+    if pos >= len(data):
+        raise SerializationTruncationError('Asked to read compact size at %d; only %d bytes available' % (pos, len(data)))
+    i = ord(data[pos])
+    if i < 0xfd:
+        return (i, pos + 1)
+    fmt, size = {0xfd: (b'<H', 2), 0xfe: (b'<I', 4), 0xff: (b'<Q', 8)}[i]
+    if pos + 1 + size > len(data):
+        raise SerializationTruncationError('Asked to read compact size at %d; only %d bytes available' % (pos, len(data)))
+    return (struct.unpack_from(fmt, data, pos + 1)[0], pos + 1 + size)
+
+class LazyTransaction(object):
+    """Read-only view of a serialized transaction.
+
+    The offsets of the transaction's fields are recorded in one pass over data,
+    but inputs, outputs, and scripts are only created when they are accessed.
+    Fields other than inputs and outputs are deserialized by the serializer class
+    of Transaction, so the global transaction_fields layout (and custom
+    serializers such as ClamsTxSerializer) are respected.
+
+    Fields are available as attributes (e.g. lazy_tx.nVersion, lazy_tx.vin).
+
+    Attributes:
+        data (memoryview): Buffer that the transaction is in.
+        offset (int): Position of the transaction in data.
+        size (int): Length of the serialized transaction.
+        fields (list): Transaction fields that data was scanned with.
+    """
+    def __init__(self, data, offset=0, fields=None):
+        super(LazyTransaction, self).__init__()
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
+        if fields is None:
+            fields = list(transaction_fields)
+        self.data = data
+        self.offset = offset
+        self.fields = fields
+        self.field_values = {}
+        # Offsets of inputs as (start, script_start, script_end, end).
+        self.input_offsets = []
+        # Offsets of outputs as (start, script_start, script_end).
+        self.output_offsets = []
+        self._vin = None
+        self._vout = None
+        self.size = self.scan() - offset
+
+    def __getattr__(self, name):
+        values = self.__dict__.get('field_values')
+        if values is not None and name in values:
+            return values[name]
+        raise AttributeError('%s has no attribute %s' % (self.__class__.__name__, name))
+
+    def scan(self):
+        """Record the offsets of fields.
+
+        Returns:
+            The position after the end of the transaction.
+        """
+        data = self.data
+        serializer = get_serializer(fields=self.fields)
+        reader = BufferReader(data, self.offset)
+        for attr, fmt, num_bytes, _ in self.fields:
+            if fmt == 'inputs':
+                reader.pos = self._scan_inputs(reader.pos)
+            elif fmt == 'outputs':
+                reader.pos = self._scan_outputs(reader.pos)
+            else:
+                serializer.deserialize_field(self, self.field_values, attr, fmt, num_bytes, reader)
+        # Fields that the serializer skipped have their default values, as in Transaction.
+        for attr, fmt, _, default in self.fields:
+            if fmt not in ['inputs', 'outputs']:
+                self.field_values.setdefault(attr, default)
+        return reader.tell()
+
+    def _check_length(self, pos):
+        if pos > len(self.data):
+            raise SerializationTruncationError('Transaction data ends at %d; only %d bytes available' % (pos, len(self.data)))
+
+    def _scan_inputs(self, pos):
+        data = self.data
+        count, pos = _read_compact_size(data, pos)
+        offsets = self.input_offsets = []
+        for _ in range(count):
+            start = pos
+            script_len, script_start = _read_compact_size(data, pos + 36)
+            pos = script_start + script_len + 4
+            self._check_length(pos)
+            offsets.append((start, script_start, script_start + script_len, pos))
+        return pos
+
+    def _scan_outputs(self, pos):
+        data = self.data
+        count, pos = _read_compact_size(data, pos)
+        offsets = self.output_offsets = []
+        for _ in range(count):
+            start = pos
+            script_len, script_start = _read_compact_size(data, pos + 8)
+            pos = script_start + script_len
+            self._check_length(pos)
+            offsets.append((start, script_start, pos))
+        return pos
+
+    def num_inputs(self):
+        return len(self.input_offsets)
+
+    def num_outputs(self):
+        return len(self.output_offsets)
+
+    def get_input(self, i):
+        """Create the input at index i."""
+        if self._vin is not None:
+            return self._vin[i]
+        start, _, _, end = self.input_offsets[i]
+        return CMutableTxIn.deserialize(self.data[start:end].tobytes())
+
+    def get_output(self, i):
+        """Create the output at index i."""
+        if self._vout is not None:
+            return self._vout[i]
+        start, _, end = self.output_offsets[i]
+        return CMutableTxOut.deserialize(self.data[start:end].tobytes())
+
+    @property
+    def vin(self):
+        if self._vin is None:
+            self._vin = [self.get_input(i) for i in range(self.num_inputs())]
+        return self._vin
+
+    @property
+    def vout(self):
+        if self._vout is None:
+            self._vout = [self.get_output(i) for i in range(self.num_outputs())]
+        return self._vout
+
+    def prevout(self, i):
+        """Get the (hash, n) of the outpoint that input i spends."""
+        start = self.input_offsets[i][0]
+        return (self.data[start:start + 32].tobytes(), struct.unpack_from(b'<I', self.data, start + 32)[0])
+
+    def script_sig(self, i):
+        """Get the scriptSig of input i as a buffer slice."""
+        _, script_start, script_end, _ = self.input_offsets[i]
+        return self.data[script_start:script_end]
+
+    def sequence(self, i):
+        return struct.unpack_from(b'<I', self.data, self.input_offsets[i][3] - 4)[0]
+
+    def output_value(self, i):
+        return struct.unpack_from(b'<q', self.data, self.output_offsets[i][0])[0]
+
+    def script_pubkey(self, i):
+        """Get the scriptPubKey of output i as a buffer slice."""
+        _, script_start, script_end = self.output_offsets[i]
+        return self.data[script_start:script_end]
+
+    def raw(self):
+        """Get the serialized transaction as a buffer slice."""
+        return self.data[self.offset:self.offset + self.size]
+
+    def serialize(self):
+        return self.raw().tobytes()
+
+    def GetHash(self):
+        """Get the hash of the transaction without re-serializing it."""
+        return hashlib.sha256(hashlib.sha256(self.raw()).digest()).digest()
+
+    def to_transaction(self):
+        """Create a Transaction from this view."""
+        kwfields = dict(self.field_values)
+        kwfields['vin'] = [CMutableTxIn.from_txin(i) for i in self.vin]
+        kwfields['vout'] = [CMutableTxOut.from_txout(i) for i in self.vout]
+        return Transaction(fields=list(self.fields), kwfields=kwfields)
+
+class TxColumns(object):
+    """Compact storage of the inputs and outputs of many transactions.
+
+    Rather than a CMutableTxIn (and COutPoint) per input and a CMutableTxOut
+    per output, values are stored in parallel arrays, and every script is
+    stored in one shared buffer. This is much smaller for blocks with many
+    inputs and outputs. Mutable inputs, outputs, and transactions are only
+    created on demand (e.g. for editing), and are independent copies.
+
+    Inputs and outputs have indices across all transactions. The inputs of
+    transaction t are those in input_range(t).
+
+    Attributes:
+        fields (list): Transaction fields.
+        tx_values (list): Dicts of the values of fields other than inputs and outputs.
+        prevout_hashes (bytearray): 32-byte prevout hashes.
+        prevout_ns (array): Prevout indices.
+        sequences (array): Input sequence numbers.
+        values (bytearray): 8-byte little-endian output values.
+        scripts (bytearray): Buffer of scriptSigs and scriptPubKeys.
+        script_sig_bounds (array): (start, end) in scripts of each scriptSig.
+        script_pubkey_bounds (array): (start, end) in scripts of each scriptPubKey.
+        tx_inputs (array): Index of the first input of each transaction, and the number of inputs.
+        tx_outputs (array): Index of the first output of each transaction, and the number of outputs.
+    """
+    __slots__ = ('fields', 'tx_values', 'prevout_hashes', 'prevout_ns', 'sequences', 'values',
+                 'scripts', 'script_sig_bounds', 'script_pubkey_bounds', 'tx_inputs', 'tx_outputs')
+
+    def __init__(self, fields=None):
+        super(TxColumns, self).__init__()
+        if fields is None:
+            fields = list(transaction_fields)
+        self.fields = fields
+        self.tx_values = []
+        self.prevout_hashes = bytearray()
+        self.prevout_ns = array('I')
+        self.sequences = array('I')
+        self.values = bytearray()
+        self.scripts = bytearray()
+        self.script_sig_bounds = array('L')
+        self.script_pubkey_bounds = array('L')
+        self.tx_inputs = array('L', [0])
+        self.tx_outputs = array('L', [0])
+
+    @classmethod
+    def from_txs(cls, txs, fields=None):
+        columns = cls(fields)
+        for tx in txs:
+            columns.add_tx(tx)
+        return columns
+
+    def _add_script(self, bounds, script):
+        bounds.append(len(self.scripts))
+        self.scripts += script
+        bounds.append(len(self.scripts))
+
+    def add_tx(self, tx):
+        """Append the inputs and outputs of tx.
+
+        tx can be a LazyTransaction, in which case data is copied
+        directly from its buffer.
+        """
+        values = {}
+        for attr, fmt, _, default in self.fields:
+            if fmt not in ['inputs', 'outputs']:
+                values[attr] = getattr(tx, attr, default)
+        self.tx_values.append(values)
+
+        if isinstance(tx, LazyTransaction):
+            data = tx.data
+            for start, script_start, script_end, end in tx.input_offsets:
+                self.prevout_hashes += data[start:start + 32]
+                self.prevout_ns.append(struct.unpack_from(b'<I', data, start + 32)[0])
+                self._add_script(self.script_sig_bounds, data[script_start:script_end])
+                self.sequences.append(struct.unpack_from(b'<I', data, end - 4)[0])
+            for start, script_start, script_end in tx.output_offsets:
+                self.values += data[start:start + 8]
+                self._add_script(self.script_pubkey_bounds, data[script_start:script_end])
+        else:
+            for txin in tx.vin:
+                self.prevout_hashes += txin.prevout.hash
+                self.prevout_ns.append(txin.prevout.n)
+                self._add_script(self.script_sig_bounds, txin.scriptSig)
+                self.sequences.append(txin.nSequence)
+            for txout in tx.vout:
+                self.values += struct.pack(b'<q', txout.nValue)
+                self._add_script(self.script_pubkey_bounds, txout.scriptPubKey)
+
+        self.tx_inputs.append(len(self.prevout_ns))
+        self.tx_outputs.append(len(self.values) // 8)
+
+    def __len__(self):
+        return len(self.tx_values)
+
+    def num_inputs(self):
+        return len(self.prevout_ns)
+
+    def num_outputs(self):
+        return len(self.values) // 8
+
+    def input_range(self, tx_index):
+        """Get the indices of the inputs of the transaction at tx_index."""
+        return xrange(self.tx_inputs[tx_index], self.tx_inputs[tx_index + 1])
+
+    def output_range(self, tx_index):
+        """Get the indices of the outputs of the transaction at tx_index."""
+        return xrange(self.tx_outputs[tx_index], self.tx_outputs[tx_index + 1])
+
+    def prevout(self, i):
+        """Get the (hash, n) of the outpoint that input i spends."""
+        return (bytes(self.prevout_hashes[i * 32:i * 32 + 32]), self.prevout_ns[i])
+
+    def script_sig(self, i):
+        return bytes(self.scripts[self.script_sig_bounds[2 * i]:self.script_sig_bounds[2 * i + 1]])
+
+    def sequence(self, i):
+        return self.sequences[i]
+
+    def output_value(self, i):
+        return struct.unpack_from(b'<q', self.values, i * 8)[0]
+
+    def script_pubkey(self, i):
+        return bytes(self.scripts[self.script_pubkey_bounds[2 * i]:self.script_pubkey_bounds[2 * i + 1]])
+
+    def get_input(self, i):
+        """Create a mutable copy of input i."""
+        prevout_hash, n = self.prevout(i)
+        return CMutableTxIn(CMutableOutPoint(prevout_hash, n), CScript(self.script_sig(i)), self.sequences[i])
+
+    def get_output(self, i):
+        """Create a mutable copy of output i."""
+        return CMutableTxOut(self.output_value(i), CScript(self.script_pubkey(i)))
+
+    def to_transaction(self, tx_index):
+        """Create a Transaction from the transaction at tx_index."""
+        kwfields = dict(self.tx_values[tx_index])
+        kwfields['vin'] = [self.get_input(i) for i in self.input_range(tx_index)]
+        kwfields['vout'] = [self.get_output(i) for i in self.output_range(tx_index)]
+        return Transaction(fields=list(self.fields), kwfields=kwfields)
+
+    def nbytes(self):
+        """Get the number of bytes in the arrays and buffers of inputs and outputs."""
+        arrays = [self.prevout_ns, self.sequences, self.script_sig_bounds, self.script_pubkey_bounds,
+                  self.tx_inputs, self.tx_outputs]
+        buffers = [self.prevout_hashes, self.values, self.scripts]
+        return sum(len(i) * i.itemsize for i in arrays) + sum(len(i) for i in buffers)
+
+class SighashCache(object):
+    """Signature hash calculator for a transaction.
+
+    The parts of the signature hash preimage that do not depend on
+    the input being signed are serialized once, so computing the signature
+    hash of every input does not require copying and re-serializing the
+    transaction for each one.
+
+    The transaction is serialized according to the global transaction_fields
+    list and serializer class at the time that the cache is created.
+    The cache must not be used after the transaction's fields, inputs, or outputs change.
+    Changes to scriptSigs are fine, since they are not signed.
+    """
+    HASH_ONE = b'\x01' + b'\x00' * 31
+    # Size of a serialized input with an empty scriptSig.
+    BLANK_INPUT_SIZE = 36 + 1 + 4
+
+    def __init__(self, tx):
+        super(SighashCache, self).__init__()
+        self.num_inputs = len(tx.vin)
+        self.num_outputs = len(tx.vout)
+        self.prevouts = [txin.prevout.serialize() for txin in tx.vin]
+        self.sequences = [struct.pack(b'<I', txin.nSequence) for txin in tx.vin]
+        self.blank_inputs = b''.join([prevout + b'\x00' + seq for prevout, seq in zip(self.prevouts, self.sequences)])
+        self._blank_inputs_no_sequence = None
+        self.outputs = [txout.serialize() for txout in tx.vout]
+        self.all_outputs = VarIntSerializer.serialize(self.num_outputs) + b''.join(self.outputs)
+        self.null_output = CMutableTxOut().serialize()
+
+        # Serialize the fields other than inputs and outputs.
+        kwfields = {}
+        for attr, _, _, _ in transaction_fields:
+            if attr not in ['vin', 'vout'] and hasattr(tx, attr):
+                kwfields[attr] = getattr(tx, attr)
+        txtmp = Transaction(kwfields=kwfields)
+        serializer = get_serializer(txtmp.serializer_class, txtmp.fields)
+        self.layout = []
+        for attr, fmt, num_bytes, _ in txtmp.fields:
+            if fmt in ['inputs', 'outputs']:
+                self.layout.append((fmt, None))
+            else:
+                f = BytesIO()
+                serializer.serialize_field(txtmp, attr, fmt, num_bytes, f)
+                self.layout.append((fmt, f.getvalue()))
+
+        self.hashes = {}
+
+    def blank_inputs_no_sequence(self):
+        """Get serialized inputs with empty scriptSigs and zeroed nSequences."""
+        if self._blank_inputs_no_sequence is None:
+            self._blank_inputs_no_sequence = b''.join([prevout + b'\x00' * 5 for prevout in self.prevouts])
+        return self._blank_inputs_no_sequence
+
+    def raw_signature_hash(self, script, inIdx, hashtype):
+        """Get the signature hash of an input.
+
+        Returns:
+            A 2-tuple of (hash, error), as in python-bitcoinlib's RawSignatureHash().
+        """
+        key = (script, inIdx, hashtype)
+        result = self.hashes.get(key)
+        if result is None:
+            result = self.hashes[key] = self._raw_signature_hash(script, inIdx, hashtype)
+        return result
+
+    def _raw_signature_hash(self, script, inIdx, hashtype):
+        if inIdx >= self.num_inputs:
+            return (self.HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, self.num_inputs))
+
+        base_type = hashtype & 0x1f
+        this_input = b''.join([self.prevouts[inIdx],
+                               BytesSerializer.serialize(FindAndDelete(script, CScript([OP_CODESEPARATOR]))),
+                               self.sequences[inIdx]])
+
+        if base_type == SIGHASH_NONE:
+            outputs = VarIntSerializer.serialize(0)
+        elif base_type == SIGHASH_SINGLE:
+            if inIdx >= self.num_outputs:
+                return (self.HASH_ONE, "outIdx %d out of range (%d)" % (inIdx, self.num_outputs))
+            outputs = b''.join([VarIntSerializer.serialize(inIdx + 1), self.null_output * inIdx, self.outputs[inIdx]])
+        else:
+            outputs = self.all_outputs
+
+        if hashtype & SIGHASH_ANYONECANPAY:
+            inputs = [VarIntSerializer.serialize(1), this_input]
+        else:
+            blanks = self.blank_inputs_no_sequence() if base_type in [SIGHASH_NONE, SIGHASH_SINGLE] else self.blank_inputs
+            start = inIdx * self.BLANK_INPUT_SIZE
+            inputs = [VarIntSerializer.serialize(self.num_inputs), blanks[:start],
+                      this_input, blanks[start + self.BLANK_INPUT_SIZE:]]
+
+        h = hashlib.sha256()
+        for fmt, data in self.layout:
+            if fmt == 'inputs':
+                for i in inputs:
+                    h.update(i)
+            elif fmt == 'outputs':
+                h.update(outputs)
+            else:
+                h.update(data)
+        h.update(struct.pack(b'<I', hashtype))
+        return (hashlib.sha256(h.digest()).digest(), None)
+
 # Known serializer classes
 
 class ClamsTxSerializer(TransactionSerializer):
@@ -166,6 +685,7 @@ class ClamsTxSerializer(TransactionSerializer):
 
     Required because transaction serialization depends on transaction version.
     """
+    custom_fields = ('ClamSpeech',)
     def deserialize_field(self, tx, kwargs, attr, fmt, num_bytes, f):
         if attr != 'ClamSpeech':
             return super(ClamsTxSerializer, self).deserialize_field(tx, kwargs, attr, fmt, num_bytes, f)
@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import threading
+
 from bitcoin.core.script import CScriptOp
 
 def format_hex_string(x, with_prefix=True):
@@ -31,3 +34,59 @@ def push_script(x):
         x(str): Hex-encoded string to push.
     """
     return CScriptOp.encode_op_pushdata(x.decode('hex')).encode('hex')
+
+class LRUCache(object):
+    """Size-bounded dict that discards its least recently used items.
+
+    Lookups are counted so that the cache's hit rate can be checked.
+    Caches can be shared between threads, since lookups reorder items.
+    """
+    def __init__(self, max_size=1024):
+        super(LRUCache, self).__init__()
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Move key to the most recently used position.
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        """Remove all items and reset the counters."""
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def hit_rate(self):
+        """Get the fraction of lookups that were hits."""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        """Get a dict of cache statistics."""
+        return {'size': len(self.items), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate()}
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
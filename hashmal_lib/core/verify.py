@@ -0,0 +1,477 @@
+"""Verification of transaction inputs.
+
+Inputs can be verified across a pool of worker processes.
+Worker processes are given serialized data so that nothing
+unpicklable needs to be sent to them.
+
+Worker processes are forked, which is only safe while no other threads
+are running (see start_pool()). Verification that is started from a thread
+other than the main thread uses the shared pool if it has been started,
+and otherwise runs in the calling thread.
+
+UTXO providers are sources of unspent transaction outputs. They have a
+get_outputs(outpoints) method that takes a list of COutPoint instances and
+returns a 2-tuple of ({(hash, n): CTxOut}, {(hash, n): error_message}).
+"""
+from collections import deque
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from bitcoin.core import b2lx, lx, x, CTxOut
+from bitcoin.core.script import CScript
+
+import chainparams
+from stack import ScriptExecution
+from transaction import Transaction, SighashCache
+
+# Inputs are verified in the current process if there are fewer than this many.
+min_parallel_inputs = 16
+# Maximum number of inputs that are sent to a worker at once.
+max_chunk_inputs = 256
+# Default maximum size of the shared pool.
+max_pool_processes = 4
+
+class RawTxUTXOProvider(object):
+    """Gets outputs from raw transactions.
+
+    This can be backed by anything that can retrieve transactions by ID,
+    such as an RPC node or a block explorer.
+
+    Transactions are fetched one at a time, since data retrievers
+    (e.g. the Blockchain plugin and its cache) are not thread-safe.
+
+    Args:
+        get_raw_tx (callable): Function that takes a txid and returns a hex-encoded
+            raw transaction. It may raise an exception if the transaction cannot be fetched.
+        is_cancelled (callable): Function that returns True if fetching should stop.
+    """
+    def __init__(self, get_raw_tx, is_cancelled=None):
+        super(RawTxUTXOProvider, self).__init__()
+        self.get_raw_tx = get_raw_tx
+        self.is_cancelled = is_cancelled
+
+    def fetch(self, txid):
+        try:
+            raw_prev_tx = self.get_raw_tx(txid)
+            if not raw_prev_tx:
+                return (txid, None, 'Could not fetch transaction %s.' % txid)
+            return (txid, Transaction.deserialize(raw_prev_tx.decode('hex')), '')
+        except Exception as e:
+            return (txid, None, str(e))
+
+    def get_outputs(self, outpoints):
+        txids = []
+        for prevout in outpoints:
+            txid = b2lx(prevout.hash)
+            if txid not in txids:
+                txids.append(txid)
+
+        # Each transaction is only fetched once.
+        prev_txs = {}
+        fetch_errors = {}
+        for txid in txids:
+            if self.is_cancelled and self.is_cancelled():
+                fetch_errors[txid] = 'Cancelled.'
+                continue
+            _, prev_txs[txid], fetch_errors[txid] = self.fetch(txid)
+
+        outputs = {}
+        errors = {}
+        for prevout in outpoints:
+            key = (prevout.hash, prevout.n)
+            txid = b2lx(prevout.hash)
+            prev_tx = prev_txs.get(txid)
+            if prev_tx is None:
+                errors[key] = fetch_errors.get(txid)
+            elif prevout.n >= len(prev_tx.vout):
+                errors[key] = 'Transaction %s has no output %d.' % (txid, prevout.n)
+            else:
+                outputs[key] = prev_tx.vout[prevout.n]
+        return outputs, errors
+
+class FixtureDirUTXOProvider(RawTxUTXOProvider):
+    """Gets outputs from raw transactions in a directory.
+
+    Each transaction is stored hex-encoded in a file named "<txid>.hex".
+    """
+    def __init__(self, path):
+        super(FixtureDirUTXOProvider, self).__init__(self.read_raw_tx)
+        self.path = path
+
+    def read_raw_tx(self, txid):
+        with open(os.path.join(self.path, '%s.hex' % txid)) as f:
+            return f.read().strip()
+
+class SnapshotUTXOProvider(object):
+    """Gets outputs from a snapshot of the UTXO set.
+
+    Args:
+        utxos (dict): Dict of {(hash, n): CTxOut}.
+    """
+    def __init__(self, utxos):
+        super(SnapshotUTXOProvider, self).__init__()
+        self.utxos = utxos
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a snapshot from a JSON file.
+
+        The file contains an object of {"<txid>:<n>": {"value": value, "scriptPubKey": script_hex}}.
+        """
+        with open(path) as f:
+            d = json.load(f)
+        utxos = {}
+        for k, v in d.items():
+            txid, n = k.split(':')
+            utxos[(lx(txid), int(n))] = CTxOut(int(v['value']), CScript(x(v['scriptPubKey'])))
+        return cls(utxos)
+
+    def get_outputs(self, outpoints):
+        outputs = {}
+        errors = {}
+        for prevout in outpoints:
+            key = (prevout.hash, prevout.n)
+            txout = self.utxos.get(key)
+            if txout is None:
+                errors[key] = 'Output %s:%d is not in the snapshot.' % (b2lx(prevout.hash), prevout.n)
+            else:
+                outputs[key] = txout
+        return outputs, errors
+
+def fetch_prevout_scripts(tx, get_raw_tx, is_cancelled=None):
+    """Get the scriptPubKeys spent by the inputs of tx.
+
+    Each previous transaction is only fetched once.
+
+    Args:
+        tx (Transaction): Spending transaction.
+        get_raw_tx (callable): Function that takes a txid and returns a hex-encoded
+            raw transaction. It may raise an exception if the transaction cannot be fetched.
+        is_cancelled (callable): Function that returns True if fetching should stop.
+
+    Returns:
+        A 2-tuple of ({input_index: scriptPubKey}, {input_index: error_message}).
+    """
+    outputs, errors = RawTxUTXOProvider(get_raw_tx, is_cancelled).get_outputs([i.prevout for i in tx.vin])
+    scripts = {}
+    script_errors = {}
+    for i, txin in enumerate(tx.vin):
+        key = (txin.prevout.hash, txin.prevout.n)
+        if key in outputs:
+            scripts[i] = outputs[key].scriptPubKey
+        else:
+            script_errors[i] = errors.get(key)
+    return scripts, script_errors
+
+def count_sigops(script_sig, script_pubkey):
+    """Count the signature operations that verifying an input requires."""
+    try:
+        n = script_pubkey.GetSigOpCount(True)
+        if script_pubkey.is_p2sh():
+            redeem_script = None
+            for _, data, _ in script_sig.raw_iter():
+                redeem_script = data
+            if redeem_script:
+                n += CScript(redeem_script).GetSigOpCount(True)
+        return n
+    except Exception:
+        return 0
+
+def verify_input(tx, in_idx, script_pubkey, sighash_cache=None, profile=None):
+    """Verify an input of tx.
+
+    If profile is an ExecutionProfile, the evaluation is added to it.
+
+    Returns:
+        A 2-tuple of (verified, error_message).
+    """
+    execution = ScriptExecution(profile)
+    execution.evaluate(CScript(script_pubkey), tx, in_idx, quiet=True, sighash_cache=sighash_cache)
+    if execution.script_verified:
+        return (True, '')
+    return (False, str(execution.error) if execution.error else 'Script did not pass.')
+
+# Shared pool of worker processes.
+_pool = None
+_pool_processes = 0
+# {name: (preset, opcode_overrides)} of the presets that workers of the shared pool have.
+_pool_presets = {}
+
+def start_pool(processes=None):
+    """Start the shared pool of worker processes.
+
+    Workers are forked from this process. A fork copies locks that other
+    threads hold (e.g. in logging or HTTP sessions) and GUI state, which can
+    deadlock or crash the workers. So this must be called from the main thread
+    before any other threads are started. Hashmal calls it before creating
+    its QApplication.
+
+    Workers only have the chainparams presets (and their opcode overrides)
+    that exist when they are forked. Presets that are added or changed later
+    are verified in the current process.
+
+    Args:
+        processes (int): Number of worker processes. If not specified,
+            the number of CPUs (at most max_pool_processes) is used.
+
+    Returns:
+        The pool, or None if there are fewer than two processes.
+    """
+    global _pool, _pool_processes, _pool_presets
+    if _pool is not None:
+        return _pool
+    if processes is None:
+        processes = min(multiprocessing.cpu_count(), max_pool_processes)
+    if processes < 2:
+        return None
+    _pool = multiprocessing.Pool(processes)
+    _pool_processes = processes
+    _pool_presets = dict((i.name, (i, list(i.opcode_overrides))) for i in chainparams.get_presets())
+    return _pool
+
+def stop_pool():
+    """Terminate the shared pool of worker processes."""
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+
+def _get_pool(processes, preset_name):
+    """Get a pool to verify with.
+
+    Returns:
+        A 3-tuple of (pool, processes, is_temporary). pool is None if
+        verification should be done in the current thread.
+    """
+    if _pool is not None:
+        # Workers only have the presets that existed when they were forked.
+        if preset_name is None or _pool_has_preset(preset_name):
+            return (_pool, _pool_processes, False)
+        return (None, 0, False)
+    # Forking from other threads is unsafe.
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        return (None, 0, False)
+    return (multiprocessing.Pool(processes), processes, True)
+
+def _pool_has_preset(preset_name):
+    """Get whether workers of the shared pool have the current preset named preset_name."""
+    preset = chainparams.presets.get(preset_name)
+    if preset is None or preset_name not in _pool_presets:
+        return False
+    pool_preset, opcode_overrides = _pool_presets[preset_name]
+    return preset is pool_preset and preset.opcode_overrides == opcode_overrides
+
+def _set_worker_preset(preset_name):
+    if preset_name and (not chainparams.active_preset or chainparams.active_preset.name != preset_name):
+        chainparams.set_to_preset(preset_name)
+
+def verify_inputs(raw_tx, prevout_scripts, preset_name=None, processes=None):
+    """Generator that verifies inputs of a transaction.
+
+    Args:
+        raw_tx (str): Serialized transaction.
+        prevout_scripts (dict): Dict of {input_index: scriptPubKey} for the inputs to verify.
+        preset_name (str): Chainparams preset for worker processes to use.
+            If not specified, the active preset is used.
+        processes (int): Number of worker processes. If not specified, the number of CPUs is used.
+            The shared pool is used instead if it has been started.
+
+    Yields:
+        (input_index, verified, error_message) tuples in the order that inputs are verified.
+        Closing the generator stops submitting inputs to worker processes. Inputs that
+        were already submitted (at most two chunks per worker) are still verified
+        by the shared pool, while temporary worker processes are terminated.
+    """
+    if preset_name is None and chainparams.active_preset:
+        preset_name = chainparams.active_preset.name
+    tasks = [(i, str(script)) for i, script in sorted(prevout_scripts.items())]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+
+    pool = None
+    if processes >= 2 and len(tasks) >= min_parallel_inputs:
+        pool, processes, temporary = _get_pool(processes, preset_name)
+    if pool is None:
+        tx = Transaction.deserialize(raw_tx)
+        sighash_cache = SighashCache(tx)
+        for in_idx, script_pubkey in tasks:
+            verified, error = verify_input(tx, in_idx, script_pubkey, sighash_cache)
+            yield (in_idx, verified, error)
+        return
+
+    # Inputs are sent to workers in chunks, each with a copy of the transaction.
+    chunksize = max(1, min(len(tasks) // (processes * 4), max_chunk_inputs))
+    chunks = [(preset_name, 0, raw_tx, tasks[i:i + chunksize]) for i in range(0, len(tasks), chunksize)]
+    try:
+        for _, results, _ in _iter_pool_results(pool, processes, chunks):
+            for result in results:
+                yield result
+        if temporary:
+            pool.close()
+    finally:
+        if temporary:
+            pool.terminate()
+            pool.join()
+
+def _iter_pool_results(pool, processes, tasks):
+    """Generator that runs _verify_tx_task on tasks with pool.
+
+    Only a few tasks per worker are submitted at a time, so that closing
+    the generator drops the tasks that have not been submitted yet.
+
+    Yields:
+        Results of tasks in the order that they were submitted.
+    """
+    pending = deque()
+    next_task = 0
+    while 1:
+        while next_task < len(tasks) and len(pending) < processes * 2:
+            pending.append(pool.apply_async(_verify_tx_task, (tasks[next_task],)))
+            next_task += 1
+        if not pending:
+            return
+        yield pending.popleft().get()
+
+def _verify_tx_task(args):
+    preset_name, tx_idx, raw_tx, scripts = args
+    results = []
+    sigops = 0
+    try:
+        _set_worker_preset(preset_name)
+        tx = Transaction.deserialize(raw_tx)
+        sighash_cache = SighashCache(tx)
+    except Exception as e:
+        return (tx_idx, [(in_idx, False, str(e)) for in_idx, _ in scripts], sigops)
+
+    for in_idx, script_pubkey in scripts:
+        script_pubkey = CScript(script_pubkey)
+        sigops += count_sigops(tx.vin[in_idx].scriptSig, script_pubkey)
+        try:
+            verified, error = verify_input(tx, in_idx, script_pubkey, sighash_cache)
+        except Exception as e:
+            verified, error = False, str(e)
+        results.append((in_idx, verified, error))
+    return (tx_idx, results, sigops)
+
+class BlockVerifier(object):
+    """Verifies the scripts of every input in a block.
+
+    Prevouts are resolved from earlier transactions in the block
+    or from a UTXO provider. Transactions are verified across a process pool.
+
+    Attributes:
+        num_inputs (int): Number of inputs verified in the last run.
+        num_sigops (int): Number of signature operations in the inputs verified in the last run.
+        elapsed (float): Duration of the last run in seconds.
+    """
+    def __init__(self, utxo_provider, preset_name=None, processes=None):
+        super(BlockVerifier, self).__init__()
+        self.utxo_provider = utxo_provider
+        self.preset_name = preset_name
+        self.processes = processes
+        self.num_inputs = 0
+        self.num_sigops = 0
+        self.elapsed = 0.0
+
+    def inputs_per_second(self):
+        return self.num_inputs / self.elapsed if self.elapsed else 0.0
+
+    def sigops_per_second(self):
+        return self.num_sigops / self.elapsed if self.elapsed else 0.0
+
+    def resolve_prevouts(self, block):
+        """Get the outputs spent by the non-coinbase transactions in block.
+
+        Returns:
+            A 2-tuple of ({(hash, n): CTxOut}, {(hash, n): error_message}).
+        """
+        # Outputs created by earlier transactions in the block.
+        block_outputs = {}
+        spent_block_outputs = {}
+        external = []
+        for tx, txid in zip(block.vtx, block.get_txids()):
+            if not tx.is_coinbase():
+                for txin in tx.vin:
+                    key = (txin.prevout.hash, txin.prevout.n)
+                    if key in block_outputs:
+                        spent_block_outputs[key] = block_outputs[key]
+                    else:
+                        external.append(txin.prevout)
+            for n, txout in enumerate(tx.vout):
+                block_outputs[(txid, n)] = txout
+
+        outputs, errors = self.utxo_provider.get_outputs(external) if external else ({}, {})
+        outputs.update(spent_block_outputs)
+        return outputs, errors
+
+    def iter_verify(self, block):
+        """Generator that verifies block.
+
+        Yields:
+            (tx_index, input_index, verified, error_message) tuples in the order
+            that transactions are verified. Closing the generator stops submitting
+            transactions to worker processes, as with verify_inputs().
+        """
+        start = time.time()
+        self.num_inputs = 0
+        self.num_sigops = 0
+        self.elapsed = 0.0
+        preset_name = self.preset_name
+        if preset_name is None and chainparams.active_preset:
+            preset_name = chainparams.active_preset.name
+
+        outputs, errors = self.resolve_prevouts(block)
+        tasks = []
+        for tx_idx, tx in enumerate(block.vtx):
+            if tx.is_coinbase():
+                continue
+            scripts = []
+            for in_idx, txin in enumerate(tx.vin):
+                key = (txin.prevout.hash, txin.prevout.n)
+                if key in outputs:
+                    scripts.append((in_idx, str(outputs[key].scriptPubKey)))
+                else:
+                    self.num_inputs += 1
+                    yield (tx_idx, in_idx, False, errors.get(key) or 'Could not find the output being spent.')
+            if scripts:
+                tasks.append((preset_name, tx_idx, tx.serialize(), scripts))
+
+        processes = self.processes
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, len(tasks))
+
+        pool, temporary = None, False
+        if processes >= 2 and sum(len(i[3]) for i in tasks) >= min_parallel_inputs:
+            pool, processes, temporary = _get_pool(processes, preset_name)
+        if pool is None:
+            iterator = (_verify_tx_task(i) for i in tasks)
+        else:
+            iterator = _iter_pool_results(pool, processes, tasks)
+        try:
+            for tx_idx, results, sigops in iterator:
+                self.num_sigops += sigops
+                for in_idx, verified, error in results:
+                    self.num_inputs += 1
+                    self.elapsed = time.time() - start
+                    yield (tx_idx, in_idx, verified, error)
+            if temporary:
+                pool.close()
+        finally:
+            if temporary:
+                pool.terminate()
+                pool.join()
+            self.elapsed = time.time() - start
+
+    def verify(self, block):
+        """Verify block.
+
+        Returns:
+            A list of (tx_index, input_index, verified, error_message) tuples.
+        """
+        return sorted(self.iter_verify(block))
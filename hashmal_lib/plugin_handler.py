@@ -3,6 +3,7 @@ from pkg_resources import iter_entry_points
 from collections import OrderedDict
 import logging
 import sys
+import threading
 import __builtin__
 
 from PyQt4.QtGui import *
@@ -63,6 +64,8 @@ class PluginHandler(QWidget):
         self.config = main_window.config
         self.loaded_plugins = []
         self.config.optionChanged.connect(self.on_option_changed)
+        # Serializes calls to data retrievers, which may come from worker threads.
+        self.blockchain_data_lock = threading.Lock()
         # Whether the initial plugin loading is done.
         self.plugins_loaded = False
         # Augmentations waiting until all plugins load.
@@ -305,14 +308,18 @@ class PluginHandler(QWidget):
         Args:
             data_type (str): Type of data (e.g. 'raw_transaction').
             identifier (str): Data identifier (e.g. transaction ID).
+
+        This can be called from worker threads. Calls are serialized,
+        since data retrievers are not thread-safe.
         """
-        plugin_name = self.config.get_option('data_retriever', 'Blockchain')
-        plugin = self.get_plugin(plugin_name)
-        if not plugin or not hasattr(plugin.ui, 'retrieve_blockchain_data'):
-            plugin = self.get_plugin('Blockchain')
-        if not data_type in plugin.ui.supported_blockchain_data_types():
-            raise Exception('Plugin "%s" does not support downloading "%s" data.' % (plugin.name, data_type))
-        return plugin.ui.retrieve_blockchain_data(data_type, identifier)
+        with self.blockchain_data_lock:
+            plugin_name = self.config.get_option('data_retriever', 'Blockchain')
+            plugin = self.get_plugin(plugin_name)
+            if not plugin or not hasattr(plugin.ui, 'retrieve_blockchain_data'):
+                plugin = self.get_plugin('Blockchain')
+            if not data_type in plugin.ui.supported_blockchain_data_types():
+                raise Exception('Plugin "%s" does not support downloading "%s" data.' % (plugin.name, data_type))
+            return plugin.ui.retrieve_blockchain_data(data_type, identifier)
 
     def evaluate_current_script(self):
         """Evaluate the script being edited with the Stack Evaluator tool."""
@@ -1,5 +1,5 @@
 from bitcoin.core import x, b2x
-from bitcoin.base58 import CBase58Data
+from bitcoin.base58 import CBase58Data, B58_DIGITS
 
 from PyQt4.QtGui import *
 
@@ -17,7 +17,7 @@ class Hash160Item(Item):
         def ensure_hex(v):
             if v.startswith('0x'):
                 v = v[2:]
-            if len(v.decode('hex')) != 20:
+            if len(v) != 40 or len(v.decode('hex')) != 20:
                 raise Exception('Value is not a hash160')
             return v
 
@@ -36,9 +36,10 @@ class AddressItem(Item):
     @classmethod
     def coerce_item(cls, data):
         def coerce_address(v):
-            addr_data = CBase58Data(v)
-            if len(v) >= 26 and len(v) <= 35:
-                return addr_data
+            # Check the length and characters before base58-decoding.
+            if len(v) < 26 or len(v) > 35 or not set(v).issubset(B58_DIGITS):
+                return None
+            return CBase58Data(v)
 
         try:
             value = coerce_address(data)
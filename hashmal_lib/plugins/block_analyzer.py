@@ -1,16 +1,17 @@
-from io import BytesIO
+import os
 
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 
-from bitcoin.core import x, b2x
-from bitcoin.core.serialize import VarIntSerializer
+from bitcoin.core import x, b2x, lx
 
 from base import BaseDock, Plugin, Category, augmenter
 from item_types import ItemAction
-from hashmal_lib.gui_utils import Separator
+from hashmal_lib.gui_utils import Separator, floated_buttons
 from hashmal_lib.widgets.block import BlockWidget
-from hashmal_lib.core import BlockHeader, Block
+from hashmal_lib.core import BlockHeader, Block, chainparams
+from hashmal_lib.core.blockfile import BlockFileReader
+from hashmal_lib.core.verify import BlockVerifier, RawTxUTXOProvider
 
 def make_plugin():
     return Plugin(BlockAnalyzer)
@@ -35,6 +36,69 @@ def deserialize_block_or_header(raw):
     except Exception as e:
         return (None, None)
 
+class BlockScriptsVerifier(QObject):
+    """Verifies the scripts in a block.
+
+    Meant to be run in a separate QThread. Outputs spent by the block
+    are fetched with get_raw_tx, which stops when verification is cancelled.
+    """
+    inputVerified = pyqtSignal(int, int, bool, str)
+    finished = pyqtSignal(int, int, float)
+
+    def __init__(self, block, get_raw_tx, preset_name):
+        super(BlockScriptsVerifier, self).__init__()
+        self.block = block
+        self.cancelled = False
+        provider = RawTxUTXOProvider(get_raw_tx, lambda: self.cancelled)
+        self.verifier = BlockVerifier(provider, preset_name)
+
+    def cancel(self):
+        """Stop verifying. Called from the GUI thread."""
+        self.cancelled = True
+
+    @pyqtSlot()
+    def verify(self):
+        iterator = self.verifier.iter_verify(self.block)
+        try:
+            for tx_idx, in_idx, verified, error in iterator:
+                self.inputVerified.emit(tx_idx, in_idx, verified, error)
+                if self.cancelled:
+                    break
+        finally:
+            iterator.close()
+        v = self.verifier
+        self.finished.emit(v.num_inputs, v.num_sigops, v.elapsed)
+
+class BlockFileScanner(QObject):
+    """Indexes the block files of a BlockFileReader.
+
+    Meant to be run in a separate QThread. The reader must not
+    be used elsewhere until finished is emitted.
+    """
+    fileScanned = pyqtSignal(int, int)
+    finished = pyqtSignal(int, str)
+
+    def __init__(self, reader):
+        super(BlockFileScanner, self).__init__()
+        self.reader = reader
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop scanning. Called from the GUI thread."""
+        self.cancelled = True
+
+    @pyqtSlot()
+    def scan(self):
+        added, error = 0, ''
+        try:
+            added = self.reader.scan(self.fileScanned.emit, lambda: self.cancelled)
+        except (EnvironmentError, ValueError) as e:
+            error = str(e)
+        # The reader of a cancelled scan has been discarded.
+        if self.cancelled:
+            self.reader.close()
+        self.finished.emit(added, error)
+
 class BlockAnalyzer(BaseDock):
 
     tool_name = 'Block Analyzer'
@@ -45,11 +109,17 @@ class BlockAnalyzer(BaseDock):
     def init_data(self):
         self.header = None
         self.block = None
+        self.scripts_verifier = None
+        self.failed_inputs = []
+        self.block_file_reader = None
+        self.block_file_scanner = None
+        self.pending_block_hash = None
 
     @augmenter
     def item_actions(self, *args):
         return [
             ItemAction(self.tool_name, 'Block', 'Deserialize', self.deserialize_item),
+            ItemAction(self.tool_name, 'Block', 'Verify scripts', self.verify_item_scripts),
             ItemAction(self.tool_name, 'Block Header', 'Deserialize', self.deserialize_item)
         ]
 
@@ -75,12 +145,152 @@ class BlockAnalyzer(BaseDock):
         
         form = QFormLayout()
         form.setRowWrapPolicy(QFormLayout.WrapAllRows)
+        form.addRow(self.create_block_file_layout())
         form.addRow('Raw Block (Or Block Header):', self.raw_block_edit)
         form.addRow(self.raw_block_invalid)
+        form.addRow(self.create_verify_layout())
         form.addRow(Separator())
         form.addRow(self.block_widget)
         return form
 
+    def create_block_file_layout(self):
+        self.block_hash_edit = QLineEdit()
+        self.block_hash_edit.setWhatsThis('Enter the hash of a block to open from the block files of a Bitcoin Core data directory.')
+        self.block_hash_edit.returnPressed.connect(self.open_block_by_hash)
+
+        open_button = QPushButton('Open')
+        open_button.clicked.connect(self.open_block_by_hash)
+        open_button.setToolTip('Open the block with this hash from the block files')
+
+        blocks_dir_button = QPushButton('Blocks Directory...')
+        blocks_dir_button.clicked.connect(self.choose_blocks_dir)
+        blocks_dir_button.setToolTip('Choose the directory containing blk*.dat files')
+
+        self.scan_progress = QLabel()
+        self.scan_progress.setToolTip('Progress of indexing the block files')
+
+        hbox = QHBoxLayout()
+        hbox.addWidget(QLabel('Block Hash:'))
+        hbox.addWidget(self.block_hash_edit, stretch=1)
+        hbox.addWidget(self.scan_progress)
+        hbox.addWidget(open_button)
+        hbox.addWidget(blocks_dir_button)
+        return hbox
+
+    def choose_blocks_dir(self):
+        blocks_dir = str(QFileDialog.getExistingDirectory(self, 'Blocks directory', self.option('blocks_dir', '')))
+        if blocks_dir:
+            self.set_option('blocks_dir', blocks_dir)
+
+    def get_block_file_reader(self):
+        """Get the reader for the block files in the configured directory."""
+        blocks_dir = self.option('blocks_dir')
+        if not blocks_dir:
+            return None
+        if self.block_file_reader is None or self.block_file_reader.blocks_dir != os.path.abspath(blocks_dir):
+            self.close_block_file_reader()
+            # The index is stored with the config file, not in the data directory.
+            config_dir = os.path.dirname(self.config.get_option('filename', os.path.abspath('hashmal.conf')))
+            index_path = os.path.join(config_dir, 'block_index.json')
+            self.block_file_reader = BlockFileReader(blocks_dir, index_path)
+        return self.block_file_reader
+
+    def close_block_file_reader(self):
+        if self.block_file_scanner:
+            # The scanner closes the reader when it stops.
+            self.block_file_scanner.cancel()
+            self.block_file_scanner = None
+            self.scan_progress.clear()
+        elif self.block_file_reader:
+            self.block_file_reader.close()
+        self.block_file_reader = None
+
+    def open_block_by_hash(self):
+        """Open the block with the entered hash from the block files.
+
+        If the block is not in the index, the block files are scanned
+        in a separate thread first.
+        """
+        try:
+            block_hash = lx(str(self.block_hash_edit.text()).strip())
+            if len(block_hash) != 32:
+                raise ValueError()
+        except (TypeError, ValueError):
+            self.error('Invalid block hash.')
+            return
+        if self.block_file_scanner:
+            self.info('Block files are still being scanned.')
+            return
+        reader = self.get_block_file_reader()
+        if not reader:
+            self.error('No blocks directory has been chosen.')
+            return
+        if block_hash in reader:
+            self.show_block_from_file(block_hash)
+            return
+
+        # Index blocks that were written since the last scan.
+        self.pending_block_hash = block_hash
+        self.scan_progress.setText('Scanning block files...')
+        self.block_file_scanner = scanner = BlockFileScanner(reader)
+        self.scanner_thread = thread = QThread()
+        scanner.moveToThread(thread)
+        thread.started.connect(scanner.scan)
+
+        scanner.fileScanned.connect(self.on_block_file_scanned)
+        scanner.finished.connect(self.on_block_files_scanned)
+        scanner.finished.connect(thread.quit)
+        scanner.finished.connect(scanner.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+
+        thread.start()
+
+    def on_block_file_scanned(self, num_scanned, num_files):
+        if self.sender() is not self.block_file_scanner:
+            return
+        self.scan_progress.setText('Scanning block files ({}/{})...'.format(num_scanned, num_files))
+
+    def on_block_files_scanned(self, added, error):
+        if self.sender() is not self.block_file_scanner:
+            return
+        self.block_file_scanner = None
+        self.scan_progress.clear()
+        if error:
+            self.error('Cannot read block files: %s' % error)
+            return
+        self.show_block_from_file(self.pending_block_hash)
+
+    def show_block_from_file(self, block_hash):
+        try:
+            data = self.block_file_reader.get_block_data(block_hash)
+        except KeyError:
+            self.error('Block %s was not found.' % b2x(block_hash[::-1]))
+            return
+        except (EnvironmentError, ValueError) as e:
+            self.error('Cannot read block files: %s' % str(e))
+            return
+        self.raw_block_edit.setPlainText(b2x(str(data)))
+
+    def create_verify_layout(self):
+        self.verify_button = QPushButton('Verify Scripts')
+        self.verify_button.clicked.connect(self.verify_scripts)
+        self.verify_button.setToolTip('Verify the scripts of every input in the block')
+        self.verify_button.setWhatsThis('This button will attempt to verify every input in the block. Outputs spent by the block are retrieved with the plugin used to retrieve blockchain data, which can be changed in the Settings dialog.')
+        self.verify_button.setEnabled(False)
+
+        self.cancel_verify_button = QPushButton('Cancel')
+        self.cancel_verify_button.clicked.connect(self.stop_verifying)
+        self.cancel_verify_button.setToolTip('Stop verifying scripts')
+        self.cancel_verify_button.setEnabled(False)
+
+        self.verify_result = QLabel()
+        self.verify_result.setWordWrap(True)
+        self.verify_result.setToolTip('Script verification result')
+
+        hbox = floated_buttons([self.verify_button, self.cancel_verify_button])
+        hbox.insertWidget(0, self.verify_result, stretch=1)
+        return hbox
+
     def raw_block_context_menu(self, pos):
         menu = self.raw_block_edit.createStandardContextMenu()
         self.handler.add_plugin_actions(self, menu, str(self.raw_block_edit.toPlainText()))
@@ -96,6 +306,8 @@ class BlockAnalyzer(BaseDock):
 
         # Clears the widget if block_header is None.
         self.block_widget.set_block(self.header, self.block)
+        self.stop_verifying()
+        self.verify_result.clear()
 
     def deserialize_item(self, item):
         self.needsFocus.emit()
@@ -111,10 +323,20 @@ class BlockAnalyzer(BaseDock):
             r = selected.row()
             tx = self.block.vtx[r]
             raw_tx = b2x(tx.serialize())
+            menu.addAction('Copy Merkle Proof', lambda: self.copy_merkle_proof(r))
             self.handler.add_plugin_actions(self, menu, raw_tx)
 
         menu.exec_(self.block_widget.txs_widget.view.viewport().mapToGlobal(position))
 
+    def copy_merkle_proof(self, row):
+        """Copy a proof that the transaction at row is in the block.
+
+        The proof is in the format of Bitcoin Core's gettxoutproof RPC.
+        """
+        txid = self.block.get_txids()[row]
+        QApplication.clipboard().setText(b2x(self.block.get_merkle_proof([txid])))
+        self.info('Copied merkle proof of transaction %d.' % row)
+
     def select_block_text(self, start, length):
         """Select an area of the raw block textedit."""
         cursor = QTextCursor(self.raw_block_edit.document())
@@ -127,30 +349,80 @@ class BlockAnalyzer(BaseDock):
             return
         index = selected.indexes()[0]
         row = index.row()
-        header = [i[2] * 2 for i in self.header.fields]
-
-        start = sum(header[0:row])
-        self.select_block_text(start, header[row])
+        start, length = self.header.field_offsets[self.header.fields[row][0]]
+        self.select_block_text(start * 2, length * 2)
 
     def on_tx_selection(self, selected, deselected):
         if not self.block or not len(selected.indexes()):
             return
         index = selected.indexes()[0]
         row = index.row()
+        start, length = self.block.get_tx_offsets()[row]
+        self.select_block_text(start * 2, length * 2)
+
+    def verify_item_scripts(self, item):
+        self.deserialize_item(item)
+        self.verify_button.animateClick()
+
+    def verify_scripts(self):
+        """Verify the scripts of every input in the block in a separate thread."""
+        if not self.block:
+            return
+        self.stop_verifying()
+        self.failed_inputs = []
+        self.verify_result.setText('Verifying...')
+        self.verify_button.setEnabled(False)
+        self.cancel_verify_button.setEnabled(True)
 
-        def tx_len(i):
-            return len(self.block.vtx[i].serialize()) * 2
+        get_raw_tx = lambda txid: self.handler.download_blockchain_data('raw_transaction', txid)
+        self.scripts_verifier = verifier = BlockScriptsVerifier(self.block, get_raw_tx, chainparams.active_preset.name)
+        self.verifier_thread = thread = QThread()
+        verifier.moveToThread(thread)
+        thread.started.connect(verifier.verify)
 
-        start = BlockHeader.header_length() * 2 + sum(tx_len(i) for i in range(row))
-        # Account for VarInt.
-        _buf = BytesIO()
-        VarIntSerializer.stream_serialize(len(self.block.vtx), _buf)
-        start += len(_buf.getvalue()) * 2
+        verifier.inputVerified.connect(self.on_input_verified)
+        verifier.finished.connect(self.on_scripts_verified)
+        verifier.finished.connect(thread.quit)
+        verifier.finished.connect(verifier.deleteLater)
+        thread.finished.connect(thread.deleteLater)
 
-        length = len(self.block.vtx[row].serialize()) * 2
-        self.select_block_text(start, length)
+        thread.start()
+
+    def stop_verifying(self):
+        """Cancel verification of scripts, if any."""
+        if self.scripts_verifier:
+            self.scripts_verifier.cancel()
+            self.scripts_verifier = None
+            self.verify_result.setText('Verification cancelled.')
+        self.verify_button.setEnabled(self.block is not None)
+        self.cancel_verify_button.setEnabled(False)
+
+    def on_input_verified(self, tx_idx, in_idx, verified, error):
+        # Ignore results from cancelled verifiers.
+        if self.sender() is not self.scripts_verifier:
+            return
+        if not verified:
+            self.failed_inputs.append((tx_idx, in_idx))
+            self.error('Tx {} input {}: {}'.format(tx_idx, in_idx, error))
+
+    def on_scripts_verified(self, num_inputs, num_sigops, elapsed):
+        if self.sender() is not self.scripts_verifier:
+            return
+        self.scripts_verifier = None
+        self.stop_verifying()
+
+        if self.failed_inputs:
+            result = 'Failed to verify {} of {} inputs.'.format(len(self.failed_inputs), num_inputs)
+        else:
+            result = 'Successfully verified all {} inputs.'.format(num_inputs)
+        if elapsed:
+            result += ' ({:.1f} inputs/s, {:.1f} sigops/s)'.format(num_inputs / elapsed, num_sigops / elapsed)
+        self.verify_result.setText(result)
+        self.info(result)
 
     def on_option_changed(self, key):
         if key == 'chainparams':
+            # Block files of other networks have different magic bytes.
+            self.close_block_file_reader()
             self.raw_block_edit.textChanged.emit()
 
@@ -1,4 +1,5 @@
 from collections import OrderedDict
+import threading
 import requests
 
 from PyQt4.QtGui import *
@@ -111,6 +112,9 @@ class Blockchain(BaseDock):
         self.explorer = explorer
         # Cache of recently downloaded txs
         self.recent_data = OrderedDict()
+        # The cache is also used by data retrieval in worker threads.
+        self.cache_lock = threading.Lock()
+        self.cache_size = int(self.option('cache_size', 25))
 
     def create_layout(self):
         """Two tabs:
@@ -179,6 +183,7 @@ class Blockchain(BaseDock):
 
         def change_cache_size():
             new_size = cache_size_box.value()
+            self.cache_size = new_size
             self.set_option('cache_size', new_size)
         cache_size_box.valueChanged.connect(change_cache_size)
 
@@ -240,17 +245,22 @@ class Blockchain(BaseDock):
 
         menu.exec_(self.raw_edit.viewport().mapToGlobal(position))
 
+    def get_cached(self, identifier):
+        with self.cache_lock:
+            return self.recent_data.get(identifier)
+
     def update_cache(self, identifier, raw):
-        self.recent_data[identifier] = raw
-        while len(self.recent_data.keys()) > int(self.option('cache_size', 25)):
-            self.recent_data.popitem(False)
+        with self.cache_lock:
+            self.recent_data[identifier] = raw
+            while self.recent_data and len(self.recent_data) > self.cache_size:
+                self.recent_data.popitem(False)
 
     def do_download(self):
         self.download_button.setEnabled(False)
         identifier = str(self.id_edit.text())
         data_type = known_data_types[str(self.data_group.checkedButton().text())]
 
-        cached_data = self.recent_data.get(identifier)
+        cached_data = self.get_cached(identifier)
         if cached_data:
             self.set_result(data_type, identifier, cached_data, '')
             return
@@ -295,8 +305,9 @@ class Blockchain(BaseDock):
 
     def download_raw_tx(self, txid):
         """This is for use by other widgets."""
-        if self.recent_data.get(txid):
-            return self.recent_data.get(txid)
+        cached_data = self.get_cached(txid)
+        if cached_data:
+            return cached_data
 
         rawtx = self.explorer.get_data('raw_tx', txid)
         if rawtx:
@@ -305,8 +316,9 @@ class Blockchain(BaseDock):
 
     def download_block_header(self, blockhash):
         """This is for use by other widgets."""
-        if self.recent_data.get(blockhash):
-            return self.recent_data.get(blockhash)
+        cached_data = self.get_cached(blockhash)
+        if cached_data:
+            return cached_data
 
         rawheader = self.explorer.get_data('raw_header', blockhash)
         if rawheader:
@@ -4,12 +4,17 @@ This module makes it easier for individual plugins and
 parts of Hashmal to use consistent metadata.
 """
 from collections import namedtuple, defaultdict
+import hashlib
+from io import BytesIO
+import re
 
 from bitcoin.core import x, b2x, b2lx
+from bitcoin.core.serialize import VarIntSerializer
 from PyQt4.QtCore import pyqtSignal, QObject
 from PyQt4.QtGui import QApplication
 
-from hashmal_lib.core import Transaction, BlockHeader, Block
+from hashmal_lib.core import Transaction, BlockHeader, Block, chainparams
+from hashmal_lib.core.utils import LRUCache
 from base import Plugin, BasePluginUI, Category
 
 class Item(object):
@@ -20,6 +25,15 @@ class Item(object):
         """Attempt to coerce data into an item of this type."""
         return None
 
+    @classmethod
+    def coerce_item_data(cls, item_data):
+        """Attempt to coerce an ItemData instance into an item of this type.
+
+        Item types that can share work with other types (e.g. deserialization)
+        should override this.
+        """
+        return cls.coerce_item(item_data.data)
+
     def __init__(self, value):
         self.value = value
         # Actions that this item supports without the need of any plugins.
@@ -41,6 +55,124 @@ item_types = []
 # List of ItemAction instances.
 item_actions = []
 
+hex_pattern = re.compile(r'^([0-9a-fA-F]{2})+$')
+
+# Minimum serialized sizes of transaction inputs and outputs.
+min_input_size = 41
+min_output_size = 9
+
+def min_serialized_size(fields):
+    """Get the minimum serialized size of a list of fields.
+
+    Variable-length fields are at least one byte long (their length).
+    """
+    return sum(num_bytes if isinstance(num_bytes, int) else 1 for _, _, num_bytes, _ in fields)
+
+def is_plausible_count(raw, pos, min_item_size, min_count=0):
+    """Check whether raw has a vector of items that are at least min_item_size bytes long at pos."""
+    try:
+        count = VarIntSerializer.stream_deserialize(BytesIO(raw[pos:pos + 9]))
+    except Exception:
+        return False
+    count_size = len(VarIntSerializer.serialize(count))
+    return count >= min_count and count * min_item_size <= len(raw) - pos - count_size
+
+class ItemData(object):
+    """Data that is being coerced into items.
+
+    Item types share an ItemData so that hex is decoded once, and values
+    are deserialized at most once. Structural checks that are much cheaper
+    than deserialization are done first.
+
+    Attributes:
+        data: The data to coerce.
+        raw (str): The bytes of data if it is a string. Hex strings are decoded.
+    """
+    def __init__(self, data):
+        super(ItemData, self).__init__()
+        self.data = data
+        self.raw = None
+        self.parsed = {}
+        if isinstance(data, str):
+            self.raw = x(data) if hex_pattern.match(data) else data
+
+    def parse(self, kind, func, check):
+        """Get the value of raw deserialized with func.
+
+        Returns None if check() fails or raw cannot be deserialized.
+        The result is stored under kind.
+        """
+        if kind not in self.parsed:
+            value = None
+            if self.raw and check():
+                try:
+                    value = func(self.raw)
+                except Exception:
+                    pass
+            self.parsed[kind] = value
+        return self.parsed[kind]
+
+    def could_be_tx(self):
+        fields = chainparams.get_tx_fields()
+        if len(self.raw) < min_serialized_size(fields):
+            return False
+        # Check the number of inputs if the fields before them are fixed-width.
+        pos = 0
+        for _, fmt, num_bytes, _ in fields:
+            if fmt == 'inputs':
+                return is_plausible_count(self.raw, pos, min_input_size)
+            if not isinstance(num_bytes, int):
+                break
+            pos += num_bytes
+        return True
+
+    def could_be_header(self):
+        return len(self.raw) == BlockHeader.header_length()
+
+    def could_be_block(self):
+        header_length = BlockHeader.header_length()
+        fields = chainparams.get_block_fields()
+        if len(self.raw) < header_length + min_serialized_size(fields):
+            return False
+        if fields and fields[0][1] == 'vectortx':
+            min_tx_size = min_serialized_size(chainparams.get_tx_fields())
+            return is_plausible_count(self.raw, header_length, min_tx_size, min_count=1)
+        return True
+
+    def get_tx(self):
+        return self.parse('tx', Transaction.deserialize, self.could_be_tx)
+
+    def get_block(self):
+        return self.parse('block', Block.deserialize, self.could_be_block)
+
+    def get_header(self):
+        return self.parse('header', BlockHeader.deserialize, self.could_be_header)
+
+item_data_cache = LRUCache(max_size=16)
+"""Cache of ItemData instances by digest of their data."""
+
+def get_item_data(data):
+    """Get an ItemData instance for data.
+
+    Strings with the same digest share an instance, as long
+    as the transaction and block formats have not changed.
+    """
+    if isinstance(data, unicode):
+        try:
+            data = str(data)
+        except UnicodeEncodeError:
+            return ItemData(data)
+    if not isinstance(data, str):
+        return ItemData(data)
+    key = (hashlib.sha256(data).digest(), Transaction.serializer_class,
+           tuple(chainparams.get_tx_fields()), tuple(chainparams.get_block_header_fields()),
+           tuple(chainparams.get_block_fields()))
+    item_data = item_data_cache.get(key)
+    if item_data is None:
+        item_data = ItemData(data)
+        item_data_cache.put(key, item_data)
+    return item_data
+
 def instantiate_item(data, allow_multiple=False):
     """Attempt to instantiate an item with the value of data.
 
@@ -48,8 +180,9 @@ def instantiate_item(data, allow_multiple=False):
     will be returned.
     """
     items = []
+    item_data = get_item_data(data)
     for i in item_types:
-        instance = i.coerce_item(data)
+        instance = i.coerce_item_data(item_data)
         if instance is not None:
             if not allow_multiple:
                 return instance
@@ -74,26 +207,20 @@ class TxItem(Item):
     name = 'Transaction'
     @classmethod
     def coerce_item(cls, data):
-        # Coerce binary string.
-        def coerce_string(v):
-            return Transaction.deserialize(v)
-
-        # Coerce hex string.
-        def coerce_hex_string(v):
-            return Transaction.deserialize(x(v))
-
-        # Coerce transaction instance.
-        def coerce_tx(v):
-            return Transaction.from_tx(v)
+        return cls.coerce_item_data(get_item_data(data))
 
-        for i in [coerce_string, coerce_hex_string, coerce_tx]:
+    @classmethod
+    def coerce_item_data(cls, item_data):
+        if item_data.raw is not None:
+            value = item_data.get_tx()
+        else:
+            # Coerce transaction instance.
             try:
-                value = i(data)
+                value = Transaction.from_tx(item_data.data)
             except Exception:
-                continue
-            else:
-                if value:
-                    return cls(value)
+                value = None
+        if value:
+            return cls(value)
 
     def __init__(self, *args):
         super(TxItem, self).__init__(*args)
@@ -109,26 +236,20 @@ class BlockItem(Item):
     name = 'Block'
     @classmethod
     def coerce_item(cls, data):
-        # Coerce binary string.
-        def coerce_string(v):
-            return Block.deserialize(v)
-
-        # Coerce hex string.
-        def coerce_hex_string(v):
-            return Block.deserialize(x(v))
+        return cls.coerce_item_data(get_item_data(data))
 
-        # Coerce block instance.
-        def coerce_block(v):
-            return Block.from_block(v)
-
-        for i in [coerce_string, coerce_hex_string, coerce_block]:
+    @classmethod
+    def coerce_item_data(cls, item_data):
+        if item_data.raw is not None:
+            value = item_data.get_block()
+        else:
+            # Coerce block instance.
             try:
-                value = i(data)
+                value = Block.from_block(item_data.data)
             except Exception:
-                continue
-            else:
-                if value:
-                    return cls(value)
+                value = None
+        if value:
+            return cls(value)
 
     def __init__(self, *args):
         super(BlockItem, self).__init__(*args)
@@ -144,26 +265,20 @@ class BlockHeaderItem(Item):
     name = 'Block Header'
     @classmethod
     def coerce_item(cls, data):
-        # Coerce binary string.
-        def coerce_string(v):
-            return BlockHeader.deserialize(v)
-
-        # Coerce hex string.
-        def coerce_hex_string(v):
-            return BlockHeader.deserialize(x(v))
+        return cls.coerce_item_data(get_item_data(data))
 
-        # Coerce block header instance.
-        def coerce_header(v):
-            return BlockHeader.from_header(v)
-
-        for i in [coerce_string, coerce_hex_string, coerce_header]:
+    @classmethod
+    def coerce_item_data(cls, item_data):
+        if item_data.raw is not None:
+            value = item_data.get_header()
+        else:
+            # Coerce block header instance.
             try:
-                value = i(data)
+                value = BlockHeader.from_header(item_data.data)
             except Exception:
-                continue
-            else:
-                if value:
-                    return cls(value)
+                value = None
+        if value:
+            return cls(value)
 
     def __init__(self, *args):
         super(BlockHeaderItem, self).__init__(*args)
@@ -1,10 +1,12 @@
 import bitcoin
+from bitcoin.core.script import MAX_SCRIPT_OPCODES
 
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 
 from hashmal_lib.core import Transaction, Script
-from hashmal_lib.core.stack import ScriptExecution, ExecutionData
+from hashmal_lib.core.script import parse_script
+from hashmal_lib.core.stack import ScriptExecution, ExecutionData, ExecutionProfile, signature_cache
 from hashmal_lib.gui_utils import monospace_font, floated_buttons, AmountEdit, HBox, ReadOnlyCheckBox
 from hashmal_lib.widgets import ScriptExecutionWidget
 from base import BaseDock, Plugin, Category, augmenter
@@ -61,6 +63,8 @@ class StackEval(BaseDock):
         self.tx = None
         self.inIdx = 0
         self.execution = ScriptExecution()
+        # Aggregated across evaluations while profiling is enabled.
+        self.profile = ExecutionProfile()
 
     def reset(self):
         self.tx_script.clear()
@@ -68,6 +72,9 @@ class StackEval(BaseDock):
 
     def clear_execution(self):
         self.execution_widget.clear()
+        self.clear_results()
+
+    def clear_results(self):
         for i in [self.script_passed, self.script_verified]:
             i.setChecked(False)
             i.setProperty('hasSuccess', False)
@@ -80,6 +87,7 @@ class StackEval(BaseDock):
         tabs.addTab(self.create_main_tab(), 'Stack')
         tabs.addTab(self.create_tx_tab(), 'Transaction')
         tabs.addTab(self.create_block_tab(), 'Block')
+        tabs.addTab(self.create_profile_tab(), 'Profile')
         self.setFocusProxy(tabs)
         vbox.addWidget(tabs)
 
@@ -98,6 +106,12 @@ class StackEval(BaseDock):
         self.tx_script.setWhatsThis('Enter a raw script here to evaluate it.')
         self.tx_script.setFont(monospace_font)
         self.tx_script.setTabChangesFocus(True)
+        self.tx_script.textChanged.connect(self.analyze_script)
+
+        # Findings from static analysis of the script.
+        self.analysis_label = QLabel()
+        self.analysis_label.setWordWrap(True)
+        self.analysis_label.setToolTip('Problems found in the script without executing it')
 
         self.clear_button = QPushButton('Clear')
         self.clear_button.setToolTip('Clear the current script.')
@@ -110,6 +124,7 @@ class StackEval(BaseDock):
         vbox = QVBoxLayout()
         vbox.addWidget(QLabel('Script:'))
         vbox.addWidget(self.tx_script)
+        vbox.addWidget(self.analysis_label)
         vbox.addLayout(btn_hbox)
         vbox.addWidget(self.execution_widget, stretch=1)
 
@@ -195,6 +210,58 @@ class StackEval(BaseDock):
         w.setLayout(form)
         return w
 
+    def create_profile_tab(self):
+        form = QFormLayout()
+
+        self.profile_box = QCheckBox('Profile evaluations')
+        self.profile_box.setToolTip('Record statistics about the opcodes in each evaluation')
+        self.profile_box.setWhatsThis('Check this box to record how many times each opcode is executed, and how long it takes. Statistics are added up across evaluations until they are reset.')
+        self.profile_box.stateChanged.connect(self.set_profiling)
+
+        self.reset_profile_button = QPushButton('Reset')
+        self.reset_profile_button.setToolTip('Clear the recorded statistics')
+        self.reset_profile_button.clicked.connect(self.reset_profile)
+
+        self.profile_model = QStandardItemModel()
+        self.profile_view = QTableView()
+        self.profile_view.setModel(self.profile_model)
+        self.profile_view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.profile_view.verticalHeader().setVisible(False)
+        self.profile_view.horizontalHeader().setStretchLastSection(True)
+        self.profile_view.setWhatsThis('Statistics about each opcode that was executed are shown here. Opcodes that the current chainparams preset overrides are marked with "*".')
+
+        self.profile_summary = QLabel()
+        self.profile_summary.setWordWrap(True)
+
+        form.addRow(floated_buttons([self.profile_box, self.reset_profile_button], left=True))
+        form.addRow(self.profile_summary)
+        form.addRow(self.profile_view)
+
+        self.update_profile()
+        w = QWidget()
+        w.setLayout(form)
+        return w
+
+    def set_profiling(self):
+        self.execution.profile = self.profile if self.profile_box.isChecked() else None
+
+    def reset_profile(self):
+        self.profile.clear()
+        self.update_profile()
+
+    def update_profile(self):
+        profile = self.profile
+        self.profile_model.clear()
+        self.profile_model.setHorizontalHeaderLabels(['Opcode', 'Count', 'Time (ms)', 'Average (us)', 'Sigops'])
+        for row in profile.rows():
+            name = row.name + '*' if row.overridden else row.name
+            items = [name, str(row.count), '%.3f' % (row.total_time * 1000),
+                     '%.1f' % (row.total_time * 1000000 / row.count), str(row.sigops)]
+            self.profile_model.appendRow([QStandardItem(i) for i in items])
+
+        self.profile_summary.setText('Evaluations: %d. Time: %.3f ms. Sigops: %d. Peak stack depth: %d items. Peak stack size: %d bytes.' % (
+                profile.evaluations, profile.total_time() * 1000, profile.total_sigops(), profile.peak_depth, profile.peak_bytes))
+
     def set_spending_item(self, item):
         """Called from other tools to set the spending transaction."""
         self.needsFocus.emit()
@@ -226,11 +293,33 @@ class StackEval(BaseDock):
         self.tx_script.setPlainText(s)
         self.do_button.animateClick()
 
+    def analyze_script(self):
+        txt = str(self.tx_script.toPlainText())
+        try:
+            scr = Script(txt.decode('hex'))
+        except Exception:
+            scr = None
+        if not txt or scr is None:
+            self.analysis_label.clear()
+            self.analysis_label.setProperty('hasError', False)
+            self.style().polish(self.analysis_label)
+            return
+
+        analysis = parse_script(scr).get_analysis()
+        summary = 'Opcodes: %d/%d. Maximum stack growth: %d. Largest push: %d bytes.' % (
+                analysis.op_count, MAX_SCRIPT_OPCODES, analysis.max_depth, analysis.max_push_size)
+        text = ' '.join([summary] + ['%s.' % i for i in analysis.errors])
+        self.analysis_label.setText(text)
+        self.analysis_label.setProperty('hasError', not analysis.is_valid())
+        self.style().polish(self.analysis_label)
+
     def do_evaluate(self):
-        self.clear_execution()
+        # The execution is kept so that unchanged steps are not re-evaluated.
+        self.clear_results()
         try:
             scr = Script(str(self.tx_script.toPlainText()).decode('hex'))
         except Exception as e:
+            self.clear_execution()
             self.error('Error decoding script: %s' % str(e))
             return
         exec_data = None
@@ -241,6 +330,9 @@ class StackEval(BaseDock):
         verified = self.execution_widget.execution.script_verified
         self.script_passed.setChecked(passed)
         self.script_verified.setChecked(verified)
+        self.debug('Signature cache: %(size)d entries, %(hits)d hits, %(misses)d misses.' % signature_cache.stats())
+        if self.execution.profile is not None:
+            self.update_profile()
         for widget in [self.script_passed, self.script_verified]:
             widget.setProperty('hasSuccess', widget.isChecked())
             self.style().polish(widget)
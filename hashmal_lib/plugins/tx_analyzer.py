@@ -8,6 +8,7 @@ from base import BaseDock, Plugin, Category, augmenter
 from item_types import ItemAction
 from hashmal_lib.gui_utils import monospace_font, floated_buttons
 from hashmal_lib.widgets.tx import TxWidget
+from hashmal_lib.core import chainparams, verify
 from hashmal_lib.core.script import Script
 from hashmal_lib.core.transaction import Transaction, sig_hash_name
 
@@ -96,6 +97,50 @@ class InputsStatusModel(QAbstractTableModel):
         self.inputs[idx][0] = verified
         self.dataChanged.emit(self.index(idx, 1), self.index(idx, 1))
 
+class InputsVerifier(QObject):
+    """Verifies the inputs of a transaction.
+
+    Meant to be run in a separate QThread. Previous transactions are fetched
+    one at a time, and then scripts are verified across a process pool.
+    """
+    inputVerified = pyqtSignal(int, bool, str)
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal()
+
+    def __init__(self, tx, get_raw_tx, preset_name):
+        super(InputsVerifier, self).__init__()
+        self.tx = tx
+        self.get_raw_tx = get_raw_tx
+        self.preset_name = preset_name
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop verifying. Called from the GUI thread."""
+        self.cancelled = True
+
+    @pyqtSlot()
+    def verify(self):
+        total = len(self.tx.vin)
+        done = 0
+        scripts, errors = verify.fetch_prevout_scripts(self.tx, self.get_raw_tx, lambda: self.cancelled)
+        for in_idx, error in errors.items():
+            done += 1
+            self.inputVerified.emit(in_idx, False, error)
+        self.progress.emit(done, total)
+
+        if not self.cancelled:
+            iterator = verify.verify_inputs(self.tx.serialize(), scripts, self.preset_name)
+            try:
+                for in_idx, verified, error in iterator:
+                    done += 1
+                    self.inputVerified.emit(in_idx, verified, error)
+                    self.progress.emit(done, total)
+                    if self.cancelled:
+                        break
+            finally:
+                iterator.close()
+        self.finished.emit()
+
 class TxAnalyzer(BaseDock):
     tool_name = 'Transaction Analyzer'
     description = 'Deserializes transactions and verifies their inputs.'
@@ -119,6 +164,8 @@ class TxAnalyzer(BaseDock):
 
     def init_data(self):
         self.tx = None
+        self.verifier = None
+        self.failed_inputs = []
 
     def create_layout(self):
         self.raw_tx_edit = QPlainTextEdit()
@@ -181,6 +228,15 @@ class TxAnalyzer(BaseDock):
         self.verify_all_button.setToolTip('Verify all inputs')
         self.verify_all_button.setWhatsThis('This button will attempt to verify all inputs.\n\nIf no plugin is available to retrieve blockchain data, such as the "Blockchain" or "Wallet RPC" plugins, this will not function. The plugin used to retrieve blockchain data can be changed in the Settings dialog.')
 
+        self.cancel_verify_button = QPushButton('Cancel')
+        self.cancel_verify_button.clicked.connect(self.stop_verifying)
+        self.cancel_verify_button.setToolTip('Stop verifying inputs')
+        self.cancel_verify_button.setEnabled(False)
+
+        self.verify_progress = QProgressBar()
+        self.verify_progress.setToolTip('Verification progress')
+        self.verify_progress.hide()
+
         self.result_edit = QLineEdit()
         self.result_edit.setToolTip('Verification result')
         self.result_edit.setWhatsThis('The result of verifying an input is shown here.')
@@ -198,7 +254,8 @@ class TxAnalyzer(BaseDock):
         self.inputs_table.setWhatsThis('This table displays which inputs you have verified for the transaction being analyzed.')
 
         form.addRow('Verify Input:', floated_buttons([self.inputs_box, self.verify_button]))
-        form.addRow(floated_buttons([self.verify_all_button]))
+        form.addRow(floated_buttons([self.verify_all_button, self.cancel_verify_button]))
+        form.addRow(self.verify_progress)
         form.addRow('Result:', self.result_edit)
         form.addRow(self.inputs_table)
 
@@ -241,6 +298,7 @@ class TxAnalyzer(BaseDock):
         menu.exec_(outputs.view.viewport().mapToGlobal(position))
 
     def clear(self):
+        self.stop_verifying()
         self.result_edit.clear()
         self.tx_widget.clear()
         self.inputs_table_model.clear()
@@ -305,7 +363,9 @@ class TxAnalyzer(BaseDock):
 
         try:
             prev_tx = Transaction.deserialize(raw_prev_tx.decode('hex'))
-            result = bitcoin.core.scripteval.VerifyScript(tx_in.scriptSig, prev_tx.vout[prev_out_n].scriptPubKey, tx, in_idx)
+            verified, error = verify.verify_input(tx, in_idx, prev_tx.vout[prev_out_n].scriptPubKey)
+            if not verified:
+                raise Exception(error)
             self.result_edit.setText('Successfully verified input {}'.format(in_idx))
             self.inputs_table_model.set_verified(in_idx, True)
         except Exception as e:
@@ -317,25 +377,74 @@ class TxAnalyzer(BaseDock):
         return True
 
     def do_verify_inputs(self, tx):
+        """Verify all inputs of tx in a separate thread."""
         if tx.is_coinbase():
             self.result_edit.setText('Error: Cannot verify coinbase transactions.')
             self.error('Attempted to verify coinbase transaction.')
             return False
-        failed_inputs = []
+        if len(tx.vin) == 0:
+            self.result_edit.setText('Transaction has no inputs.')
+            return False
+        self.stop_verifying()
+
+        self.failed_inputs = []
         self.result_edit.setText('Verifying...')
-        for i in range(len(tx.vin)):
-            if not self.do_verify_input(tx, i):
-                failed_inputs.append(i)
+        self.verify_progress.setRange(0, len(tx.vin))
+        self.verify_progress.setValue(0)
+        self.verify_progress.show()
+        self.verify_all_button.setEnabled(False)
+        self.cancel_verify_button.setEnabled(True)
+
+        get_raw_tx = lambda txid: self.handler.download_blockchain_data('raw_transaction', txid)
+        self.verifier = verifier = InputsVerifier(tx, get_raw_tx, chainparams.active_preset.name)
+        self.verifier_thread = thread = QThread()
+        verifier.moveToThread(thread)
+        thread.started.connect(verifier.verify)
+
+        verifier.inputVerified.connect(self.on_input_verified)
+        verifier.progress.connect(self.on_verify_progress)
+        verifier.finished.connect(self.on_inputs_verified)
+        verifier.finished.connect(thread.quit)
+        verifier.finished.connect(verifier.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+
+        thread.start()
+        return True
+
+    def stop_verifying(self):
+        """Cancel verification of inputs, if any."""
+        if self.verifier:
+            self.verifier.cancel()
+            self.verifier = None
+            self.result_edit.setText('Verification cancelled.')
+        self.verify_progress.hide()
+        self.verify_all_button.setEnabled(self.tx is not None)
+        self.cancel_verify_button.setEnabled(False)
+
+    def on_input_verified(self, in_idx, verified, error):
+        # Ignore results from cancelled verifiers.
+        if self.sender() is not self.verifier:
+            return
+        self.inputs_table_model.set_verified(in_idx, verified)
+        if not verified:
+            self.failed_inputs.append(in_idx)
+            self.error('Input {}: {}'.format(in_idx, error))
+
+    def on_verify_progress(self, done, total):
+        if self.sender() is not self.verifier:
+            return
+        self.verify_progress.setValue(done)
+
+    def on_inputs_verified(self):
+        if self.sender() is not self.verifier:
+            return
+        self.verifier = None
+        self.stop_verifying()
 
         result = 'Successfully verified all inputs.'
-        ret_val = True
-        if failed_inputs:
-            result = 'Failed to verify inputs: {}'.format(failed_inputs)
-            ret_val = False
-        if len(tx.vin) == 0:
-            result = 'Transaction has no inputs.'
+        if self.failed_inputs:
+            result = 'Failed to verify inputs: {}'.format(sorted(self.failed_inputs))
         self.result_edit.setText(result)
-        return ret_val
 
     def verify_input(self):
         in_idx = self.inputs_box.value()
@@ -1,7 +1,7 @@
 import bitcoin
 from bitcoin.core import x, b2x, CMutableOutPoint, CMutableTxIn, CMutableTxOut
 from bitcoin.core.script import SIGHASH_ALL, SIGHASH_ANYONECANPAY
-from bitcoin.core.scripteval import VerifyScript, SCRIPT_VERIFY_P2SH
+from bitcoin.core.scripteval import SCRIPT_VERIFY_P2SH
 from bitcoin.wallet import CBitcoinSecret
 
 from PyQt4.QtGui import *
@@ -10,7 +10,8 @@ from PyQt4.QtCore import QAbstractTableModel, QModelIndex, Qt, QVariant
 
 from hashmal_lib.core.script import Script
 from hashmal_lib.core import chainparams
-from hashmal_lib.core.transaction import Transaction, sig_hash_name, sig_hash_explanation, sighash_types, sighash_types_by_value
+from hashmal_lib.core.stack import ScriptExecution
+from hashmal_lib.core.transaction import Transaction, SighashCache, sig_hash_name, sig_hash_explanation, sighash_types, sighash_types_by_value
 from hashmal_lib.core.utils import is_hex, format_hex_string
 from hashmal_lib.widgets.tx import TxWidget, InputsTree, OutputsTree, TimestampWidget
 from hashmal_lib.widgets.script import ScriptEditor
@@ -658,7 +659,9 @@ class SigHashWidget(QWidget):
         if not privkey:
             self.set_result_message('Could not parse private key.', error=True)
             return
-        sig_hash = chainparams.signature_hash(script, txTo, inIdx, hash_type)
+        # Signature hashes do not depend on scriptSigs, so this can be used for verification after signing.
+        sighash_cache = SighashCache(txTo)
+        sig_hash = chainparams.signature_hash(script, txTo, inIdx, hash_type, sighash_cache)
 
         sig = privkey.sign(sig_hash)
         hash_type_hex = format_hex_string(hex(hash_type), with_prefix=False).decode('hex')
@@ -667,10 +670,10 @@ class SigHashWidget(QWidget):
 
         if self.verify_script.isChecked():
             # Try verify
-            try:
-                VerifyScript(txTo.vin[inIdx].scriptSig, script, txTo, inIdx, (SCRIPT_VERIFY_P2SH,))
-            except Exception as e:
-                self.set_result_message('Error when verifying: %s' % str(e), error=True)
+            execution = ScriptExecution()
+            execution.evaluate(script, txTo, inIdx, flags=(SCRIPT_VERIFY_P2SH,), quiet=True, sighash_cache=sighash_cache)
+            if not execution.script_verified:
+                self.set_result_message('Error when verifying: %s' % str(execution.error), error=True)
                 return
 
         self.dock.deserialize_raw(b2x(txTo.serialize()))
@@ -1,8 +1,9 @@
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 import logging
+import multiprocessing
 
-from hashmal_lib.core import chainparams
+from hashmal_lib.core import chainparams, verify
 from gui_utils import floated_buttons, Amount, monospace_font, Separator
 
 class ChainparamsComboBox(QComboBox):
@@ -330,9 +331,23 @@ class SettingsDialog(QDialog):
         self.log_level.currentIndexChanged.connect(change_log_level)
 
 
+        self.verification_processes = QSpinBox()
+        self.verification_processes.setRange(0, multiprocessing.cpu_count())
+        self.verification_processes.setSpecialValueText('Disabled')
+        self.verification_processes.setValue(self.config.get_option('verification_processes',
+                min(multiprocessing.cpu_count(), verify.max_pool_processes)))
+        self.verification_processes.setToolTip('Number of worker processes that verify scripts. Changes take effect when Hashmal is restarted.')
+        self.verification_processes.setWhatsThis('Scripts of transactions and blocks are verified across this many worker processes, which are started with Hashmal. If disabled, scripts are verified in a single thread.')
+
+        def change_verification_processes(value):
+            self.config.set_option('verification_processes', value)
+        self.verification_processes.valueChanged.connect(change_verification_processes)
+
+
         form.addRow('Amount format:', amnt_format)
         form.addRow('Data retriever:', data_retriever)
         form.addRow('Log level:', self.log_level)
+        form.addRow('Verification processes:', self.verification_processes)
 
         w = QWidget()
         w.setLayout(form)
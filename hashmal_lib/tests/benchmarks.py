@@ -0,0 +1,268 @@
+"""Script engine benchmarks.
+
+Times ScriptExecution over the scripts in script_corpus.json, and compares
+the results with a baseline stored in benchmark_baseline.json.
+
+Usage:
+    python -m hashmal_lib.tests.benchmarks [--repeat N] [--tolerance T] [--save-baseline]
+
+The exit status is nonzero if any case regressed by more than the tolerance,
+or did not have the expected result, or if the time to evaluate nested
+conditions does not scale linearly with their depth.
+Baselines depend on the machine that they were recorded on.
+"""
+import argparse
+import json
+import os
+import sys
+from collections import namedtuple
+from timeit import default_timer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from bitcoin.core import x
+from bitcoin.core.script import OP_IF, OP_ELSE, OP_ENDIF
+
+from hashmal_lib.core import chainparams
+from hashmal_lib.core.script import Script, parse_script
+from hashmal_lib.core.stack import (ScriptExecution, ExecutionData, ExecutionContext,
+        get_dispatch_table, signature_cache)
+from hashmal_lib.core.transaction import Transaction
+
+corpus_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'script_corpus.json')
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# Metrics that are compared with the baseline, and whether higher values are better.
+compared_metrics = [('ops_per_second', True), ('steps_per_second', True), ('history_bytes', False)]
+
+# Maximum ratio of the times to evaluate nested conditions 8 times deeper.
+# Linear scaling gives a ratio of about 8; quadratic gives about 64.
+max_condition_scaling = 24
+
+BenchmarkResult = namedtuple('BenchmarkResult', ('name', 'passed', 'error', 'ops', 'steps',
+                                                 'ops_per_second', 'steps_per_second',
+                                                 'history_bytes', 'max_rss'))
+
+class BenchmarkCase(object):
+    """A script to evaluate from the corpus.
+
+    If the case has a serialized spending transaction, script is verified
+    with the input at in_idx. The transaction is deserialized by prepare(),
+    since its format depends on the chainparams preset.
+    """
+    def __init__(self, name, script, raw_tx=None, in_idx=0, preset='Bitcoin', execution_data=None, expect=True):
+        super(BenchmarkCase, self).__init__()
+        self.name = name
+        self.script = script
+        self.raw_tx = raw_tx
+        self.tx = None
+        self.in_idx = in_idx
+        self.preset = preset
+        self.execution_data = execution_data
+        self.expect = expect
+
+    @classmethod
+    def from_dict(cls, d):
+        raw_tx = x(d['tx']) if d.get('tx') else None
+        execution_data = None
+        if 'block_height' in d or 'block_time' in d:
+            execution_data = ExecutionData(d.get('block_height', 0), d.get('block_time', 0))
+        return cls(d['name'], Script(x(d['script'])), raw_tx, d.get('input', 0),
+                   d.get('preset', 'Bitcoin'), execution_data, d.get('expect', True))
+
+    def prepare(self):
+        """Deserialize the spending transaction with the active preset."""
+        if self.raw_tx:
+            self.tx = Transaction.deserialize(self.raw_tx)
+
+    def scripts(self):
+        """Get the scripts that evaluating this case executes."""
+        if not self.tx:
+            return [self.script]
+        script_sig = Script(self.tx.vin[self.in_idx].scriptSig)
+        scripts = [script_sig, self.script]
+        if self.script.is_p2sh():
+            pushes = [data for op, data, _ in parse_script(script_sig).ops]
+            if pushes and pushes[-1] is not None:
+                scripts.append(Script(pushes[-1]))
+        return scripts
+
+    def op_count(self):
+        return sum(len(parse_script(i).ops) for i in self.scripts())
+
+    def evaluate(self, execution, quiet):
+        execution.evaluate(self.script, self.tx, self.in_idx, execution_data=self.execution_data, quiet=quiet)
+        if self.tx:
+            return execution.script_verified
+        return bool(execution.script_passed)
+
+def load_corpus(path=None):
+    """Load BenchmarkCases from a corpus file."""
+    with open(path or corpus_path) as f:
+        data = json.load(f)
+    return [BenchmarkCase.from_dict(i) for i in data['cases']]
+
+def history_size(steps):
+    """Estimate the number of bytes that a StepHistory retains."""
+    size = sys.getsizeof(steps.deltas) + sys.getsizeof(steps.ops) + sys.getsizeof(steps.logs)
+    for kept, pushed in steps.deltas:
+        size += sys.getsizeof(pushed) + sum(sys.getsizeof(i) for i in pushed)
+    size += sum(sys.getsizeof(i) for i in steps.logs)
+    for checkpoint in steps.checkpoints:
+        size += sys.getsizeof(checkpoint) + sum(sys.getsizeof(i) for i in checkpoint)
+    return size
+
+def max_rss():
+    """Get the peak memory usage of this process, in kilobytes."""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_case(case, repeat=100):
+    """Benchmark case.
+
+    Ops per second are measured with quiet evaluations. Steps per second
+    and history size are measured with full evaluations.
+    The signature cache is cleared before each evaluation so that
+    signature checks are included in the timings.
+    """
+    active_preset = chainparams.active_preset.name if chainparams.active_preset else 'Bitcoin'
+    chainparams.set_to_preset(case.preset)
+    try:
+        case.prepare()
+        # Warm up caches, and check the result.
+        execution = ScriptExecution()
+        passed = case.evaluate(execution, quiet=True)
+        error = str(execution.error) if execution.error else ''
+
+        start = default_timer()
+        for _ in range(repeat):
+            signature_cache.clear()
+            case.evaluate(ScriptExecution(), quiet=True)
+        quiet_time = default_timer() - start
+
+        start = default_timer()
+        for _ in range(repeat):
+            signature_cache.clear()
+            execution = ScriptExecution()
+            case.evaluate(execution, quiet=False)
+        traced_time = default_timer() - start
+        steps = len(execution.steps)
+        ops = case.op_count()
+    finally:
+        chainparams.set_to_preset(active_preset)
+
+    return BenchmarkResult(case.name, passed == case.expect, error, ops, steps,
+                           ops * repeat / max(quiet_time, 1e-9),
+                           steps * repeat / max(traced_time, 1e-9),
+                           history_size(execution.steps), max_rss())
+
+def time_nested_conditions(depth):
+    """Time evaluating depth nested IF/ELSE/ENDIFs.
+
+    MAX_SCRIPT_OPCODES limits the nesting of a whole script,
+    so the conditions are evaluated through the opcode handlers.
+    """
+    ctx = ExecutionContext()
+    table = get_dispatch_table()
+    start = default_timer()
+    for _ in range(depth):
+        ctx.fExec = ctx.vfExec.all_true()
+        if ctx.fExec:
+            ctx.stack.append('\x01')
+        table[OP_IF](ctx, OP_IF)
+    for _ in range(depth):
+        ctx.fExec = ctx.vfExec.all_true()
+        table[OP_ELSE](ctx, OP_ELSE)
+        table[OP_ENDIF](ctx, OP_ENDIF)
+    return default_timer() - start
+
+def condition_scaling(depth=2000, repeat=3):
+    """Get the ratio of the times to evaluate conditions nested 8 * depth and depth deep."""
+    time_nested_conditions(depth // 2)
+    small = min(time_nested_conditions(depth) for _ in range(repeat))
+    large = min(time_nested_conditions(depth * 8) for _ in range(repeat))
+    return large / max(small, 1e-9)
+
+def run_benchmarks(cases=None, repeat=100):
+    if cases is None:
+        cases = load_corpus()
+    return [run_case(case, repeat) for case in cases]
+
+def load_baseline(path=None):
+    """Load a baseline of {case_name: {metric: value}}."""
+    with open(path or baseline_path) as f:
+        return json.load(f)['cases']
+
+def save_baseline(results, path=None):
+    data = {'cases': dict((r.name, dict((metric, int(round(getattr(r, metric)))) for metric, _ in compared_metrics)) for r in results)}
+    with open(path or baseline_path, 'w') as f:
+        json.dump(data, f, indent=4, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+
+def compare(results, baseline, tolerance=0.25):
+    """Find regressions from baseline.
+
+    Returns:
+        A list of (case_name, metric, baseline_value, value) tuples.
+    """
+    regressions = []
+    for r in results:
+        expected = baseline.get(r.name)
+        if not expected:
+            continue
+        for metric, higher_is_better in compared_metrics:
+            if metric not in expected:
+                continue
+            value = getattr(r, metric)
+            if higher_is_better and value < expected[metric] * (1 - tolerance):
+                regressions.append((r.name, metric, expected[metric], value))
+            elif not higher_is_better and value > expected[metric] * (1 + tolerance):
+                regressions.append((r.name, metric, expected[metric], value))
+    return regressions
+
+def format_results(results):
+    lines = ['%-16s %6s %6s %14s %14s %14s %12s' % ('Case', 'Ops', 'Steps', 'Ops/s', 'Steps/s', 'History bytes', 'Max RSS (kB)')]
+    for r in results:
+        lines.append('%-16s %6d %6d %14.0f %14.0f %14d %12d' % (r.name, r.ops, r.steps, r.ops_per_second,
+                                                              r.steps_per_second, r.history_bytes, r.max_rss))
+    return '\n'.join(lines)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the script engine.')
+    parser.add_argument('--repeat', type=int, default=100, help='Number of evaluations per case')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed fraction of regression from the baseline')
+    parser.add_argument('--corpus', default=corpus_path, help='Corpus file')
+    parser.add_argument('--baseline', default=baseline_path, help='Baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline')
+    args = parser.parse_args(args)
+
+    results = run_benchmarks(load_corpus(args.corpus), args.repeat)
+    print(format_results(results))
+
+    status = 0
+    for r in results:
+        if not r.passed:
+            print('%s: unexpected result. %s' % (r.name, r.error))
+            status = 1
+
+    scaling = condition_scaling()
+    print('Nested conditions: %.1fx the time for 8x the depth' % scaling)
+    if scaling > max_condition_scaling:
+        print('Nested conditions scale worse than linearly')
+        status = 1
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print('Saved baseline to %s' % args.baseline)
+    elif os.path.exists(args.baseline):
+        for name, metric, expected, value in compare(results, load_baseline(args.baseline), args.tolerance):
+            print('%s: %s regressed from %.0f to %.0f' % (name, metric, expected, value))
+            status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,29 @@
+import unittest
+
+from hashmal_lib.core import chainparams
+from hashmal_lib.tests import benchmarks
+
+class BenchmarksTest(unittest.TestCase):
+    def setUp(self):
+        super(BenchmarksTest, self).setUp()
+        chainparams.set_to_preset('Bitcoin')
+
+    def test_corpus(self):
+        cases = benchmarks.load_corpus()
+        self.assertEqual(set(['p2pkh', 'p2sh_multisig', 'arithmetic', 'deep_ifs', 'big_pushes', 'cltv']),
+                         set(i.name for i in cases))
+        for result in benchmarks.run_benchmarks(cases, repeat=1):
+            self.assertTrue(result.passed, '%s: %s' % (result.name, result.error))
+            self.assertTrue(result.ops_per_second > 0)
+            self.assertTrue(result.history_bytes > 0)
+        self.assertEqual('Bitcoin', chainparams.active_preset.name)
+
+    def test_compare(self):
+        baseline = {'arithmetic': {'ops_per_second': 1000, 'steps_per_second': 1000, 'history_bytes': 1000}}
+        result = benchmarks.BenchmarkResult('arithmetic', True, '', 10, 10, 900, 700, 1300, 0)
+        self.assertEqual([('arithmetic', 'steps_per_second', 1000, 700), ('arithmetic', 'history_bytes', 1000, 1300)],
+                         benchmarks.compare([result], baseline, tolerance=0.25))
+        self.assertEqual([], benchmarks.compare([result], baseline, tolerance=0.5))
+
+    def test_condition_scaling(self):
+        self.assertTrue(benchmarks.condition_scaling(depth=100, repeat=1) > 0)
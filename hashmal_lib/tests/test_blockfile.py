@@ -0,0 +1,129 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from hashmal_lib.core import chainparams, Block
+from hashmal_lib.core.blockfile import BlockFileReader, xor_data
+from hashmal_lib.tests.test_chainparams import bitcoin_raw_block, clams_raw_block
+
+bitcoin_magic = b'\xf9\xbe\xb4\xd9'
+
+def block_record(raw_block, magic=bitcoin_magic):
+    return magic + struct.pack('<I', len(raw_block)) + raw_block
+
+class BlockFileReaderTest(unittest.TestCase):
+    def setUp(self):
+        super(BlockFileReaderTest, self).setUp()
+        chainparams.set_to_preset('Bitcoin')
+        self.blocks_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(tempfile.mkdtemp(), 'index.json')
+
+    def tearDown(self):
+        super(BlockFileReaderTest, self).tearDown()
+        shutil.rmtree(self.blocks_dir)
+        shutil.rmtree(os.path.dirname(self.index_path))
+
+    def write_file(self, name, data, mode='wb'):
+        with open(os.path.join(self.blocks_dir, name), mode) as f:
+            f.write(data)
+
+    def test_scan(self):
+        # Preallocated space follows the block.
+        self.write_file('blk00000.dat', block_record(bitcoin_raw_block) + b'\x00' * 64)
+        reader = BlockFileReader(self.blocks_dir)
+        self.assertEqual(1, reader.scan())
+        blk = Block.deserialize(bitcoin_raw_block)
+        self.assertIn(blk.GetHash(), reader)
+        self.assertEqual(bitcoin_raw_block, str(reader.get_block_data(blk.GetHash())))
+        self.assertEqual(blk.serialize(), reader.get_block(blk.GetHash()).serialize())
+        self.assertEqual(blk.get_header().serialize(), reader.get_header(blk.GetHash()).serialize())
+        self.assertRaises(KeyError, reader.get_block, b'\x00' * 32)
+        reader.close()
+
+    def test_wrong_magic(self):
+        self.write_file('blk00000.dat', block_record(bitcoin_raw_block, b'\xe6\xe8\xe9\xe5'))
+        reader = BlockFileReader(self.blocks_dir)
+        self.assertRaises(ValueError, reader.scan)
+
+    def test_inferred_magic(self):
+        chainparams.set_to_preset('Clams')
+        magic = b'\x15\x35\x22\x03'
+        self.write_file('blk00000.dat', block_record(clams_raw_block, magic))
+        reader = BlockFileReader(self.blocks_dir)
+        self.assertEqual(1, reader.scan())
+        self.assertEqual(magic, reader.magic)
+        blk = Block.deserialize(clams_raw_block)
+        self.assertEqual(clams_raw_block, reader.get_block(blk.GetHash()).serialize())
+
+    def test_persistent_index(self):
+        blk = Block.deserialize(bitcoin_raw_block)
+        clams_blk_data = block_record(clams_raw_block)
+        # The second block is still being written.
+        self.write_file('blk00000.dat', block_record(bitcoin_raw_block) + clams_blk_data[:100])
+        reader = BlockFileReader(self.blocks_dir, self.index_path)
+        self.assertEqual(1, reader.scan())
+        reader.close()
+
+        reader = BlockFileReader(self.blocks_dir, self.index_path)
+        self.assertEqual(1, len(reader))
+        self.assertEqual({'blk00000.dat': len(bitcoin_raw_block) + 8}, reader.scanned)
+        self.assertEqual(bitcoin_raw_block, reader.get_block(blk.GetHash()).serialize())
+
+        # Only appended data is scanned.
+        self.write_file('blk00000.dat', clams_blk_data[100:], 'ab')
+        self.write_file('blk00001.dat', b'')
+        self.assertEqual(1, reader.scan())
+        self.assertEqual(0, reader.scan())
+        self.assertEqual(2, len(reader))
+        reader.close()
+
+        # The index is discarded if files are truncated.
+        self.write_file('blk00000.dat', block_record(bitcoin_raw_block))
+        reader = BlockFileReader(self.blocks_dir, self.index_path)
+        self.assertEqual(0, len(reader))
+
+    def test_obfuscated_files(self):
+        key = b'\x01\x02\x03\x04\x05\x06\x07\x08'
+        self.write_file('xor.dat', key)
+        self.write_file('blk00000.dat', xor_data(block_record(bitcoin_raw_block), key, 0))
+        reader = BlockFileReader(self.blocks_dir)
+        self.assertEqual(1, reader.scan())
+        blk = Block.deserialize(bitcoin_raw_block)
+        self.assertEqual(bitcoin_raw_block, reader.get_block(blk.GetHash()).serialize())
+
+    def test_open_files(self):
+        self.write_file('blk00000.dat', block_record(bitcoin_raw_block))
+        self.write_file('blk00001.dat', b'')
+        self.write_file('blk00002.dat', block_record(clams_raw_block))
+        reader = BlockFileReader(self.blocks_dir)
+        reader.max_open_files = 1
+        progress = []
+        self.assertEqual(2, reader.scan(lambda *args: progress.append(args)))
+        self.assertEqual([(1, 3), (2, 3), (3, 3)], progress)
+        self.assertEqual(['blk00002.dat'], list(reader.mmaps))
+        blk = Block.deserialize(bitcoin_raw_block)
+        self.assertEqual(bitcoin_raw_block, reader.get_block(blk.GetHash()).serialize())
+        self.assertEqual(['blk00000.dat'], list(reader.mmaps))
+        reader.close()
+
+    def test_cancelled_scan(self):
+        self.write_file('blk00000.dat', block_record(bitcoin_raw_block))
+        self.write_file('blk00001.dat', block_record(clams_raw_block))
+        reader = BlockFileReader(self.blocks_dir)
+        progress = []
+        self.assertEqual(1, reader.scan(lambda *args: progress.append(args), lambda: len(progress) > 0))
+        self.assertEqual(['blk00000.dat'], list(reader.scanned))
+        self.assertEqual(1, reader.scan())
+        reader.close()
+
+    def test_xor_data(self):
+        key = b'\x01\x02\x03\x04\x05\x06\x07\x08'
+        data = b'\x00\xff' * 37
+        for offset in [0, 3, 8, 13]:
+            expected = ''.join(chr(ord(c) ^ ord(key[(offset + i) % len(key)])) for i, c in enumerate(data))
+            self.assertEqual(expected, xor_data(data, key, offset))
+            self.assertEqual(expected, xor_data(buffer(data), key, offset))
+        self.assertEqual(b'\x01', xor_data(b'\x00', key, 0))
+        self.assertEqual(b'', xor_data(b'', key, 5))
@@ -1,8 +1,16 @@
+import struct
 import unittest
 
-from bitcoin.core import COutPoint, CTxIn, CTxOut, CTransaction, x, lx, b2x
+from bitcoin.core import COutPoint, CTxIn, CTxOut, CTransaction, CMutableTransaction, CMutableTxOut, x, lx, b2x
+from bitcoin.core.script import CScript, OP_CODESEPARATOR, OP_CHECKSIG, SignatureHash
+from bitcoin.core.serialize import SerializationTruncationError
 
 from hashmal_lib.core import chainparams, Transaction, BlockHeader, Block
+from hashmal_lib.core.block import (get_header_layout, IncrementalMerkleRoot, BlockStream, MerkleTree,
+            PartialMerkleTree, verify_merkle_branch, verify_merkle_proof, read_tx_columns)
+from hashmal_lib.core.serialization import STRUCT, CALL, CUSTOM
+from hashmal_lib.core.transaction import (SighashCache, LazyTransaction, TransactionSerializer, get_serializer,
+            TxColumns)
 
 maza_raw_tx = '010000000279fd18c19fad871077a757804561e11d722296b68e6afd4d2a16c06d9c9a30b8000000006a4730440220380bf06cf81a43a9d425b6d34be7315e9ebb396081ecb94e291a906e6b9e36a6022060458349b8592a1d7133e77756a011e2d8e5749b67a2a94f3a5488e81458c00c0121024370144b106ab92b9bdf2cf2de6eb173f4656e581d27ed2c0f77479db338fc21ffffffff551d183e1f98a5a5e7f5b296ba6d77729babb7f90aaabe6b8eb128c624e10fce000000006b483045022100e1d89636d53334e29703dff014323cb8c9836e2b77f666477f185a1882cc2c7a02201d3af8352b2bf338b79a709a30fdf4e9c5166487b7af15fb48a85eac2e43c722012103c4e79c99c1cfcce534b4715ec9a8f6ccf735f050a58caf7b6126ebe4691aa480ffffffff025a232d00000000001976a9144fd5ae7260db3ddc49d058e6f200a486058c666288ac00127a00000000001976a9149d0d296ad8e00e57f90670215d9276765ba1c81788ac00000000'.decode('hex')
 
@@ -117,6 +125,115 @@ class TransactionTest(unittest.TestCase):
         tx = Transaction.deserialize(maza_raw_tx)
         self.assertEqual(maza_raw_tx.encode('hex'), tx.as_hex())
 
+    def test_sighash_cache(self):
+        tx = Transaction.deserialize(maza_raw_tx)
+        script = CScript([OP_CODESEPARATOR, b'\x01' * 33, OP_CHECKSIG])
+        cache = SighashCache(tx)
+        for in_idx in range(len(tx.vin)):
+            for hash_type in [1, 2, 3, 0x81, 0x82, 0x83]:
+                expected = SignatureHash(script, tx, in_idx, hash_type)
+                self.assertEqual(expected, chainparams.signature_hash(script, tx, in_idx, hash_type, cache))
+                self.assertEqual(expected, chainparams.signature_hash(script, tx, in_idx, hash_type))
+
+        self.assertRaises(ValueError, chainparams.signature_hash, script, tx, 2, 1, cache)
+        # SIGHASH_SINGLE without a corresponding output.
+        tx.vout.pop()
+        self.assertRaises(ValueError, chainparams.signature_hash, script, tx, 1, 3, SighashCache(tx))
+
+    def test_lazy_transaction(self):
+        # Freicoin transactions have a RefHeight field after nLockTime.
+        frc_raw_tx = maza_raw_tx + '\x10\x27\x00\x00'
+        for preset, raw_tx in [('Bitcoin', maza_raw_tx), ('Clams', clams_raw_tx), ('Clams', clams_v1_raw_tx),
+                               ('Peercoin', ppc_raw_tx), ('Freicoin', frc_raw_tx)]:
+            chainparams.set_to_preset(preset)
+            tx = Transaction.deserialize(raw_tx)
+            # Surround the transaction with other data.
+            lazy_tx = LazyTransaction(bytearray(b'\x00' * 5 + raw_tx + b'\xff' * 3), 5)
+            self.assertEqual(len(raw_tx), lazy_tx.size)
+            self.assertEqual(tx.GetHash(), lazy_tx.GetHash())
+            self.assertEqual(raw_tx, lazy_tx.serialize())
+            for attr, fmt, _, _ in tx.fields:
+                if fmt not in ['inputs', 'outputs']:
+                    self.assertEqual(getattr(tx, attr), getattr(lazy_tx, attr))
+
+            self.assertEqual(len(tx.vin), lazy_tx.num_inputs())
+            self.assertEqual(len(tx.vout), lazy_tx.num_outputs())
+            for i, txin in enumerate(tx.vin):
+                self.assertEqual((txin.prevout.hash, txin.prevout.n), lazy_tx.prevout(i))
+                self.assertEqual(txin.scriptSig, lazy_tx.script_sig(i).tobytes())
+                self.assertEqual(txin.nSequence, lazy_tx.sequence(i))
+            for i, txout in enumerate(tx.vout):
+                self.assertEqual(txout.nValue, lazy_tx.output_value(i))
+                self.assertEqual(txout.scriptPubKey, lazy_tx.script_pubkey(i).tobytes())
+            self.assertEqual(tx.vin[0].serialize(), lazy_tx.get_input(0).serialize())
+            self.assertEqual([i.serialize() for i in tx.vout], [i.serialize() for i in lazy_tx.vout])
+            self.assertEqual(raw_tx, lazy_tx.to_transaction().serialize())
+
+        self.assertRaises(AttributeError, getattr, lazy_tx, 'Timestamp')
+        chainparams.set_to_preset('Bitcoin')
+        self.assertRaises(SerializationTruncationError, LazyTransaction, maza_raw_tx[:-10])
+
+    def test_compiled_serializer(self):
+        serializer = get_serializer()
+        self.assertIs(serializer, get_serializer(TransactionSerializer, bitcoin_fields))
+        self.assertEqual([STRUCT, CALL, CALL, STRUCT], [i[0] for i in serializer.layout.steps])
+
+        # Adjacent fixed-width fields are merged.
+        chainparams.set_to_preset('Clams')
+        steps = get_serializer().layout.steps
+        self.assertEqual([STRUCT, CALL, CALL, STRUCT, CUSTOM], [i[0] for i in steps])
+        self.assertEqual(('nVersion', 'Timestamp'), steps[0][2])
+        self.assertEqual('<ii', steps[0][1].format)
+
+        # Serializers that do not list custom_fields handle every field.
+        class VersionSerializer(TransactionSerializer):
+            def deserialize_field(self, tx, kwargs, attr, fmt, num_bytes, f):
+                super(VersionSerializer, self).deserialize_field(tx, kwargs, attr, fmt, num_bytes, f)
+                if attr == 'nVersion':
+                    kwargs[attr] += 1
+        chainparams.set_to_preset('Bitcoin')
+        chainparams.set_tx_serializer(VersionSerializer)
+        try:
+            tx = Transaction.deserialize(maza_raw_tx)
+        finally:
+            chainparams.set_to_preset('Bitcoin')
+        self.assertEqual(2, tx.nVersion)
+        self.assertEqual([CUSTOM] * 4, [i[0] for i in get_serializer(VersionSerializer).layout.steps])
+
+    def test_serialization_cache(self):
+        tx = Transaction.deserialize(maza_raw_tx)
+        Transaction.cache_stats.clear()
+        txid = tx.GetHash()
+        self.assertEqual(maza_raw_tx, tx.serialize())
+        self.assertEqual(txid, tx.GetHash())
+        self.assertEqual(1, Transaction.cache_stats.misses)
+        self.assertEqual(2, Transaction.cache_stats.hits)
+
+        def check(tx):
+            self.assertEqual(CMutableTransaction.from_tx(tx).serialize(), tx.serialize())
+            self.assertEqual(CMutableTransaction.from_tx(tx).GetHash(), tx.GetHash())
+
+        # Edits to fields, inputs, and outputs invalidate the cache.
+        tx.vin[0].scriptSig = CScript([OP_CHECKSIG])
+        check(tx)
+        tx.vin[1].prevout = COutPoint(tx.vin[1].prevout.hash, 5)
+        check(tx)
+        tx.vout[0].nValue = 1
+        check(tx)
+        tx.vout.append(CMutableTxOut(2, CScript([OP_CHECKSIG])))
+        check(tx)
+        tx.nLockTime = 10
+        check(tx)
+        self.assertNotEqual(txid, tx.GetHash())
+        self.assertEqual(6, Transaction.cache_stats.misses)
+
+        chainparams.set_to_preset('Clams')
+        tx = Transaction.deserialize(clams_raw_tx)
+        speech_hash = tx.GetHash()
+        tx.ClamSpeech = b'Hello'
+        self.assertNotEqual(speech_hash, tx.GetHash())
+        tx.ClamSpeech = Transaction.deserialize(clams_raw_tx).ClamSpeech
+        self.assertEqual(speech_hash, tx.GetHash())
 
 bitcoin_raw_header = '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c'.decode('hex')
 
@@ -143,6 +260,65 @@ class BlockHeaderTest(unittest.TestCase):
         header = BlockHeader.deserialize(bitcoin_raw_header)
         self.assertEqual(bitcoin_raw_header.encode('hex'), header.as_hex())
 
+    def test_serialization_cache(self):
+        blk = Block.deserialize(bitcoin_raw_block)
+        BlockHeader.cache_stats.clear()
+        Block.cache_stats.clear()
+        block_hash = blk.GetHash()
+        self.assertEqual(block_hash, BlockHeader.deserialize(bitcoin_raw_header).GetHash())
+        self.assertEqual(block_hash, blk.GetHash())
+        self.assertEqual(bitcoin_raw_block, blk.serialize())
+        self.assertEqual(1, Block.cache_stats.hits)
+
+        blk.nNonce += 1
+        self.assertNotEqual(block_hash, blk.GetHash())
+        self.assertEqual(blk.get_header().GetHash(), blk.GetHash())
+        blk.nNonce -= 1
+
+        # Edits to transactions change the block and its merkle tree.
+        merkle_root = blk.calc_merkle_root()
+        self.assertEqual(bitcoin_raw_block, blk.serialize())
+        blk.vtx[0].nLockTime = 1
+        self.assertNotEqual(bitcoin_raw_block, blk.serialize())
+        blk.vtx[0].nLockTime = 0
+        self.assertEqual(bitcoin_raw_block, blk.serialize())
+        # Edits to inputs and outputs require invalidating the cache.
+        blk.vtx[0].vout[0].nValue = 1
+        blk.vtx[0].invalidate_cache()
+        self.assertNotEqual(bitcoin_raw_block, blk.serialize())
+        self.assertEqual(Block.build_merkle_tree_from_txs(blk.vtx)[-1], blk.calc_merkle_root())
+        self.assertNotEqual(merkle_root, blk.calc_merkle_root())
+        self.assertEqual(block_hash, blk.GetHash())
+
+    def test_generations(self):
+        blk = Block.deserialize(bitcoin_raw_block)
+        generation = blk._generation
+        blk.nNonce = blk.nNonce
+        self.assertNotEqual(generation, blk._generation)
+        self.assertNotEqual(blk._generation, blk.vtx[0]._generation)
+        # Private attributes do not change the generation.
+        generation = blk._generation
+        blk.get_txids()
+        self.assertEqual(generation, blk._generation)
+
+        # Fields that are edited in place are detected.
+        blk.nExtra = 0
+        Block.cache_stats.clear()
+        blk.serialize()
+        blk.block_fields.append(('nExtra', b'<I', 4, 0))
+        blk.serialize()
+        self.assertEqual(2, Block.cache_stats.misses)
+        self.assertEqual(len(bitcoin_raw_block) + 4, len(blk.serialize()))
+
+    def test_compiled_layout(self):
+        steps = get_header_layout().steps
+        self.assertEqual(1, len(steps))
+        self.assertEqual('<i32s32sIII', steps[0][1].format)
+
+        header = BlockHeader.deserialize(bitcoin_raw_header)
+        header.hashPrevBlock = b'\x00'
+        self.assertRaises(ValueError, header.serialize)
+
 bitcoin_raw_block = '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c0101000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000'.decode('hex')
 
 clams_raw_block = '07000000e4f9a8c328439e9e4aafe6090ef46238ea9b2fe8d2cbf17fce881a51b9c8ac2718f7ce4ce75ebc5ac6c2d872f9c7098f1601e7300cc55aab28ed04b54e324ed240695956daeb001b00000000020200000040695956010000000000000000000000000000000000000000000000000000000000000000ffffffff0403126f0bffffffff010000000000000000000000000000020000004069595601c07c8709388cb589e8c9db523d9619d3dcedf3b338178cbaa6343fb641a4e8310100000048473044022034e7215232df91f5d3c8bec4da07ea230db94de55ac6ef451afdbf6e46693bf6022007196949a85cebce1dc00e68d21168ae4bfe712e4875a6a3eb7aa3cfcd89754101ffffffff030000000000000000004000b14f000000002321037bedfabb451755cf6061636c8004dba32cb95095ba8cba61de236a70f95e3d2aac80867353000000002321037bedfabb451755cf6061636c8004dba32cb95095ba8cba61de236a70f95e3d2aac000000003445787072657373696f6e206f6620506f6c69746963616c2046726565646f6d3a20536570617261746973742066656d696e69736d473045022100b4e1b24eff6f0c7945c1cabc2d37ac88df861fe37f9bc22ac3c8594bac58f6f9022044e8dfde90dc28d06ba17d5c2b9b3a65ad1cdc03c3e0f8f5655d1f5b9c8cfa0b'.decode('hex')
@@ -166,3 +342,170 @@ class BlockTest(unittest.TestCase):
         blk = Block.deserialize(clams_raw_block)
         self.assertEqual(clams_raw_block.encode('hex'), blk.as_hex())
         self.assertEqual('3045022100b4e1b24eff6f0c7945c1cabc2d37ac88df861fe37f9bc22ac3c8594bac58f6f9022044e8dfde90dc28d06ba17d5c2b9b3a65ad1cdc03c3e0f8f5655d1f5b9c8cfa0b', b2x(blk.blockSig))
+
+    def test_incremental_merkle_root(self):
+        for n in range(1, 18):
+            txids = [chr(i) * 32 for i in range(n)]
+            merkle = IncrementalMerkleRoot()
+            for txid in txids:
+                merkle.add(txid)
+            self.assertEqual(Block.build_merkle_tree_from_txids(txids)[-1], merkle.root())
+        self.assertRaises(ValueError, IncrementalMerkleRoot().root)
+
+    def test_block_stream(self):
+        for preset, raw_block in [('Bitcoin', bitcoin_raw_block), ('Clams', clams_raw_block)]:
+            chainparams.set_to_preset(preset)
+            blk = Block.deserialize(raw_block)
+            stream = BlockStream(raw_block, check_merkle_root=True)
+            items = iter(stream)
+            self.assertEqual(blk.get_header().serialize(), items.next().serialize())
+            txs = list(items)
+            self.assertEqual(len(blk.vtx), stream.num_txs)
+            self.assertEqual([i.serialize() for i in blk.vtx], [tx.serialize() for _, _, tx in txs])
+            for index, offset, tx in txs:
+                self.assertEqual(index, blk.vtx.index(tx))
+                self.assertEqual(tx.serialize(), raw_block[offset:offset + len(tx.serialize())])
+            self.assertEqual(blk.hashMerkleRoot, stream.merkle_root)
+
+        self.assertEqual(blk.blockSig, stream.field_values['blockSig'])
+
+        chainparams.set_to_preset('Bitcoin')
+        bad_block = bitcoin_raw_block[:36] + b'\x00' * 32 + bitcoin_raw_block[68:]
+        self.assertEqual(2, len(list(BlockStream(bad_block))))
+        self.assertRaises(ValueError, list, BlockStream(bad_block, check_merkle_root=True))
+
+    def test_merkle_tree_cache(self):
+        blk = Block.deserialize(bitcoin_raw_block)
+        self.assertIsNone(blk._vMerkleTree)
+        self.assertEqual(blk.hashMerkleRoot, blk.calc_merkle_root())
+        self.assertIs(blk.vMerkleTree, blk._vMerkleTree)
+        self.assertEqual([blk.vtx[0].GetHash()], blk.get_txids())
+
+        tx = Transaction.deserialize(maza_raw_tx)
+        blk.vtx = blk.vtx + [tx]
+        self.assertIsNone(blk._vMerkleTree)
+        self.assertEqual(Block.build_merkle_tree_from_txs(blk.vtx)[-1], blk.calc_merkle_root())
+
+        tree = blk.get_merkle_tree()
+        self.assertIs(tree, blk.get_merkle_tree())
+        tx.nLockTime = 1
+        self.assertEqual(tx.GetHash(), blk.get_txids()[1])
+        tx.vout[0].nValue += 1
+        tx.invalidate_cache()
+        self.assertEqual(tx.GetHash(), blk.get_txids()[1])
+
+        blk2 = Block(vtx=blk.vtx)
+        self.assertIsNot(blk.vtx[0], blk2.vtx[0])
+        self.assertEqual(blk.vMerkleTree, blk2.vMerkleTree)
+
+    def test_merkle_tree(self):
+        for n in range(1, 18):
+            txids = [chr(i) * 32 for i in range(n)]
+            tree = MerkleTree(txids)
+            self.assertEqual(Block.build_merkle_tree_from_txids(txids), tree.flatten())
+            self.assertFalse(tree.mutated)
+            branches = tree.get_branches(range(n))
+            for i, txid in enumerate(txids):
+                self.assertEqual(branches[i], tree.get_branch(tree.index(txid)))
+                self.assertTrue(verify_merkle_branch(txid, i, branches[i], tree.root))
+                self.assertFalse(verify_merkle_branch(b'\xff' * 32, i, branches[i], tree.root))
+
+            for matched in [txids[:1], txids[-1:], txids[::3], txids]:
+                partial = PartialMerkleTree.deserialize(tree.get_partial_tree(matched).serialize())
+                root, matches = partial.extract()
+                self.assertEqual(tree.root, root)
+                self.assertEqual([(txids.index(i), i) for i in matched], matches)
+
+        self.assertRaises(ValueError, MerkleTree(txids).index, b'\xff' * 32)
+        # CVE-2012-2459: duplicating the last transactions does not change the root.
+        tree = MerkleTree(txids[:3])
+        mutated = MerkleTree(txids[:3] + txids[2:3])
+        self.assertEqual(tree.root, mutated.root)
+        self.assertTrue(mutated.mutated)
+        self.assertRaises(ValueError, mutated.get_partial_tree([txids[2]]).extract)
+
+    def test_merkle_proof(self):
+        blk = Block.deserialize(bitcoin_raw_block)
+        txid = blk.vtx[0].GetHash()
+        proof = blk.get_merkle_proof([txid])
+        header, matches = verify_merkle_proof(proof)
+        self.assertEqual(bitcoin_raw_header, header.serialize())
+        self.assertEqual([(0, txid)], matches)
+        self.assertRaises(ValueError, verify_merkle_proof, bitcoin_raw_block[:36] + b'\x00' * 32 + proof[68:])
+
+    def test_offsets(self):
+        for preset, raw_block in [('Bitcoin', bitcoin_raw_block), ('Clams', clams_raw_block)]:
+            chainparams.set_to_preset(preset)
+            blk = Block.deserialize(raw_block)
+            for attr, fmt, num_bytes, _ in blk.fields:
+                offset, length = blk.field_offsets[attr]
+                self.assertEqual(num_bytes, length)
+                data = raw_block[offset:offset + length]
+                self.assertEqual(getattr(blk, attr), data if fmt == 'bytes' else struct.unpack(fmt, data)[0])
+            for tx, (offset, length) in zip(blk.vtx, blk.get_tx_offsets()):
+                self.assertEqual(tx.serialize(), raw_block[offset:offset + length])
+            tx_offsets = blk.get_tx_offsets()
+            offset, length = blk.field_offsets['vtx']
+            self.assertEqual(tx_offsets[-1][0] + tx_offsets[-1][1], offset + length)
+            self.assertEqual(len(raw_block), sum(blk.field_offsets[i[0]][1] for i in blk.fields + blk.block_fields))
+
+            # Offsets are found again from the serialization of blocks that changed.
+            blk2 = Block.deserialize(raw_block)
+            blk2.nNonce += 1
+            self.assertEqual(tx_offsets, blk2.get_tx_offsets())
+            self.assertEqual(blk.field_offsets, blk2.field_offsets)
+
+            # Offsets change with transactions that are edited in place
+            # (after invalidate_cache() for edits of inputs or outputs).
+            def check_offsets(blk):
+                data = blk.serialize()
+                for tx, (offset, length) in zip(blk.vtx, blk.get_tx_offsets()):
+                    self.assertEqual(tx.serialize(), data[offset:offset + length])
+                self.assertEqual(len(data), sum(blk.field_offsets[i[0]][1] for i in blk.fields + blk.block_fields))
+
+            blk2 = Block.deserialize(raw_block)
+            self.assertIs(blk2.get_tx_offsets(), blk2.get_tx_offsets())
+            blk2.vtx[0].vin[0].scriptSig += b'\x00'
+            blk2.invalidate_cache()
+            self.assertNotEqual(tx_offsets[0][1], blk2.get_tx_offsets()[0][1])
+            check_offsets(blk2)
+
+            # Offsets use the block's own fields.
+            blk2.fields = blk2.fields + [('nExtra', b'<I', 4, 0)]
+            blk2.nExtra = 0
+            self.assertEqual(tx_offsets[0][0] + 4, blk2.get_tx_offsets()[0][0])
+            check_offsets(blk2)
+
+    def test_tx_columns(self):
+        for preset, raw_block in [('Bitcoin', bitcoin_raw_block), ('Clams', clams_raw_block)]:
+            chainparams.set_to_preset(preset)
+            blk = Block.deserialize(raw_block)
+            header, columns, values = read_tx_columns(raw_block)
+            self.assertEqual(blk.get_header().serialize(), header.serialize())
+            self.assertEqual(dict((attr, getattr(blk, attr)) for attr, fmt, _, _ in blk.block_fields if fmt != 'vectortx'), values)
+            self.assertEqual(len(blk.vtx), len(columns))
+            self.assertEqual(sum(len(tx.vin) for tx in blk.vtx), columns.num_inputs())
+            self.assertEqual(sum(len(tx.vout) for tx in blk.vtx), columns.num_outputs())
+
+            for tx_index, tx in enumerate(blk.vtx):
+                for txin, i in zip(tx.vin, columns.input_range(tx_index)):
+                    self.assertEqual((txin.prevout.hash, txin.prevout.n), columns.prevout(i))
+                    self.assertEqual(txin.scriptSig, columns.script_sig(i))
+                    self.assertEqual(txin.nSequence, columns.sequence(i))
+                for txout, i in zip(tx.vout, columns.output_range(tx_index)):
+                    self.assertEqual(txout.nValue, columns.output_value(i))
+                    self.assertEqual(txout.scriptPubKey, columns.script_pubkey(i))
+                self.assertEqual(tx.serialize(), columns.to_transaction(tx_index).serialize())
+
+            # Columns of transaction objects are the same as those read from data.
+            from_txs = TxColumns.from_txs(blk.vtx)
+            self.assertEqual(columns.scripts, from_txs.scripts)
+            self.assertEqual(columns.values, from_txs.values)
+            self.assertEqual(columns.tx_values, from_txs.tx_values)
+            self.assertEqual(columns.nbytes(), from_txs.nbytes())
+
+            # Created transactions are independent copies.
+            tx = columns.to_transaction(0)
+            tx.vin[0].prevout.n = 5
+            tx.vout[0].nValue = 1
+            self.assertEqual(blk.vtx[0].serialize(), columns.to_transaction(0).serialize())
@@ -5,7 +5,7 @@ from bitcoin.core import b2lx
 
 from hashmal_lib.plugins.addr_encoder import encode_address, decode_address
 from hashmal_lib.plugins.block_analyzer import deserialize_block_or_header
-from hashmal_lib.plugins import script_gen
+from hashmal_lib.plugins import script_gen, item_types
 from hashmal_lib.plugins.variables import classify_data
 from hashmal_lib.core import chainparams, Script
 
@@ -60,6 +60,47 @@ class BlockAnalyzerTest(unittest.TestCase):
         self.assertEqual('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f', b2lx(blk.GetHash()))
         self.assertEqual('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f', b2lx(header.GetHash()))
 
+class ItemTypesTest(unittest.TestCase):
+    def setUp(self):
+        super(ItemTypesTest, self).setUp()
+        chainparams.set_to_preset('Bitcoin')
+        item_types.item_data_cache.clear()
+
+    def test_instantiate_item(self):
+        genesis = BlockAnalyzerTest.btc_genesis
+        genesis_tx = genesis[162:]
+        test_items = [
+            (genesis, ['Block']),
+            (genesis.decode('hex'), ['Block']),
+            (BlockAnalyzerTest.btc_genesis_header, ['Block Header']),
+            (genesis_tx, ['Transaction']),
+            ('', []),
+            ('xyz', []),
+        ]
+        for data, names in test_items:
+            items = item_types.instantiate_item(data, allow_multiple=True)
+            self.assertEqual(names, [i.name for i in items if i.name in ['Block', 'Block Header', 'Transaction']])
+
+    def test_structural_checks(self):
+        genesis = BlockAnalyzerTest.btc_genesis.decode('hex')
+        item_data = item_types.ItemData(genesis)
+        self.assertTrue(item_data.could_be_block())
+        self.assertFalse(item_data.could_be_header())
+        # Implausible numbers of inputs and transactions.
+        self.assertFalse(item_types.ItemData(b'\x01\x00\x00\x00\xfd\xff\xff' + b'\x00' * 20).could_be_tx())
+        self.assertFalse(item_types.ItemData(genesis[:80] + b'\xfd\xff\x00' + genesis[81:]).could_be_block())
+        self.assertFalse(item_types.ItemData(genesis[:80]).could_be_block())
+
+    def test_shared_item_data(self):
+        genesis = BlockAnalyzerTest.btc_genesis
+        item_data = item_types.get_item_data(genesis)
+        self.assertIs(item_data, item_types.get_item_data(genesis))
+        block = item_types.BlockItem.coerce_item(genesis).value
+        self.assertIs(block, item_data.get_block())
+        # Data is parsed again when the transaction format changes.
+        chainparams.set_to_preset('Peercoin')
+        self.assertIsNot(item_data, item_types.get_item_data(genesis))
+
 class AddrEncoderTest(unittest.TestCase):
     def test_decode_address(self):
         addr = '1111111111111111111114oLvT2'
@@ -3,7 +3,7 @@ from collections import namedtuple
 
 from bitcoin.core.script import *
 
-from hashmal_lib.core.script import Script, transform_human
+from hashmal_lib.core.script import Script, transform_human, parse_script, parsed_script_cache
 
 # Test item with hex and human representations.
 ScriptItem = namedtuple('ScriptItem', ('hex', 'human'))
@@ -23,6 +23,45 @@ class ScriptTest(unittest.TestCase):
         s = Script(i.hex.decode('hex'))
         self.assertEqual(s.get_human(), i.human)
 
+    def test_parsed_script_cache(self):
+        s = Script('76a914000000000000000000000000000000000000000088ac'.decode('hex'))
+        parsed = parse_script(s)
+        hits = parsed_script_cache.hits
+        self.assertIs(parsed, parse_script(Script(str(s))))
+        self.assertEqual(hits + 1, parsed_script_cache.hits)
+        self.assertEqual(list(s.raw_iter()), list(parsed.ops))
+        self.assertEqual('76a914000000000000000000000000000000000000000088ac', s.get_hex())
+
+        # Truncated push.
+        s = Script('6a0501'.decode('hex'))
+        self.assertEqual('6a(CANNOT_PARSE)', s.get_hex())
+        self.assertEqual('OP_RETURN (CANNOT_PARSE)', s.get_human())
+
+    def test_script_analysis(self):
+        analysis = parse_script(Script.from_human('0x01 OP_IF OP_DUP OP_DUP OP_ELSE OP_DROP OP_ENDIF OP_ADD')).get_analysis()
+        self.assertTrue(analysis.is_valid())
+        self.assertEqual(7, analysis.op_count)
+        self.assertEqual(2, analysis.max_depth)
+        self.assertIs(analysis, parse_script(Script.from_human('0x01 OP_IF OP_DUP OP_DUP OP_ELSE OP_DROP OP_ENDIF OP_ADD')).get_analysis())
+
+        invalid_scripts = [
+            ('OP_IF OP_1', 'Unbalanced IF/ELSE/ENDIF'),
+            ('OP_1 OP_ENDIF', 'Unbalanced IF/ELSE/ENDIF'),
+            ('OP_1 OP_2 OP_CAT', 'opcode OP_CAT is disabled'),
+            (' '.join(['OP_NOP'] * (MAX_SCRIPT_OPCODES + 1)), 'script has 202 opcodes; maximum allowed is 201'),
+        ]
+        for human, error in invalid_scripts:
+            analysis = parse_script(Script.from_human(human)).get_analysis()
+            self.assertFalse(analysis.is_valid())
+            self.assertEqual([error], analysis.errors)
+
+        analysis = parse_script(Script(CScript([b'\x01' * (MAX_SCRIPT_ELEMENT_SIZE + 1)]))).get_analysis()
+        self.assertEqual(MAX_SCRIPT_ELEMENT_SIZE + 1, analysis.max_push_size)
+        self.assertFalse(analysis.is_valid())
+
+        analysis = parse_script(Script('6a0501'.decode('hex'))).get_analysis()
+        self.assertFalse(analysis.is_valid())
+
     def test_script_from_human_to_human_and_hex(self):
         i = ScriptItem('0102010393', '0x02 0x03 OP_ADD')
         s = Script.from_human(i.human)
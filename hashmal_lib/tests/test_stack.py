@@ -1,10 +1,17 @@
+import random
 import unittest
 
 from bitcoin.core import CMutableTxIn, CMutableTxOut, CMutableOutPoint
-from bitcoin.core.scripteval import EvalScript
+from bitcoin.core._bignum import bn2vch
+from bitcoin.core.script import (CScript, OP_ADD, OP_CHECKSIG, OP_DUP, OP_IF, OP_ELSE, OP_ENDIF,
+        OP_NOP10, SignatureHash, SIGHASH_ALL)
+from bitcoin.core.scripteval import EvalScript, _CheckExec
+from bitcoin.wallet import CKey
 
+from hashmal_lib.core import chainparams, opcodes
 from hashmal_lib.core.script import Script, transform_human
-from hashmal_lib.core.stack import ScriptExecution
+from hashmal_lib.core.stack import (ScriptExecution, Stack, StackState, ExecutionData, ScriptNum,
+        ConditionStack, ExecutionContext, ExecutionProfile, get_dispatch_table, signature_cache)
 from hashmal_lib.core.transaction import Transaction
 
 class StackTest(unittest.TestCase):
@@ -23,6 +30,92 @@ class StackTest(unittest.TestCase):
 
         self.assertFalse(execution.script_verified)
 
+    def test_quiet_evaluate_script(self):
+        execution = ScriptExecution()
+        steps = execution.evaluate(self.script_simple_addition, quiet=True)
+        self.assertEqual(1, len(steps))
+        self.assertEqual(['\x05'], steps[-1].stack)
+        self.assertEqual('', steps[-1].log)
+        self.assertTrue(execution.script_passed)
+
+        steps = execution.evaluate(Script.from_human('0x02 OP_ADD'), quiet=True)
+        self.assertIsNotNone(execution.error)
+        self.assertFalse(execution.script_passed)
+
+    def test_quiet_evaluate_fails_fast(self):
+        my_script = Script.from_human('0x02 0x03 OP_ADD OP_IF')
+        execution = ScriptExecution()
+        steps = execution.evaluate(my_script, quiet=True)
+        self.assertEqual(0, len(steps))
+        self.assertIn('Unbalanced IF/ELSE/ENDIF', str(execution.error))
+        self.assertFalse(execution.script_passed)
+
+        # The full trace still runs up to the failure.
+        steps = execution.evaluate(my_script)
+        self.assertEqual(4, len(steps))
+        self.assertIsNotNone(execution.error)
+
+    def test_script_num(self):
+        for v in range(-1000, 1000) + [2**31 - 1, -2**31 + 1, 2**31, 2**39, -2**40]:
+            self.assertEqual(bn2vch(v), ScriptNum(v))
+            self.assertEqual(v, ScriptNum(v).value)
+
+        execution = ScriptExecution()
+        steps = execution.evaluate(Script.from_human('0x7f OP_1ADD OP_DUP OP_NEGATE'))
+        self.assertEqual(['\x80\x00', '\x80\x80'], steps[-1].stack)
+        self.assertIsInstance(steps[-1].stack[-1], ScriptNum)
+
+        # Results longer than 4 bytes can be pushed, but not used as numbers.
+        _ = execution.evaluate(Script.from_human('0xffffff7f OP_DUP OP_ADD'), quiet=True)
+        self.assertIsNone(execution.error)
+        _ = execution.evaluate(Script.from_human('0xffffff7f OP_DUP OP_ADD OP_1ADD'), quiet=True)
+        self.assertIn('overflow', str(execution.error))
+
+    def test_condition_stack(self):
+        random.seed(0)
+        conditions = ConditionStack()
+        expected = []
+        for _ in range(5000):
+            action = random.randint(0, 2)
+            if action == 0 or not expected:
+                value = random.random() < 0.8
+                conditions.append(value)
+                expected.append(value)
+            elif action == 1:
+                self.assertEqual(expected.pop(), conditions.pop())
+            else:
+                expected[-1] = not expected[-1]
+                self.assertEqual(expected[-1], conditions.toggle_top())
+            self.assertEqual(_CheckExec(expected), conditions.all_true())
+            self.assertEqual(len(expected), len(conditions))
+        self.assertEqual(expected, list(conditions))
+
+    def test_nested_conditions_stress(self):
+        # MAX_SCRIPT_OPCODES limits the nesting of a whole script,
+        # so nested IFs are evaluated through the opcode handlers.
+        # Scaling with depth is measured by the benchmarks.
+        depth = 16000
+        ctx = ExecutionContext()
+        table = get_dispatch_table()
+        for i in range(depth):
+            ctx.fExec = ctx.vfExec.all_true()
+            if ctx.fExec:
+                ctx.stack.append('' if i == depth // 2 else '\x01')
+            table[OP_IF](ctx, OP_IF)
+        self.assertEqual(depth, len(ctx.vfExec))
+        self.assertEqual(depth // 2, ctx.vfExec.first_false)
+        self.assertFalse(ctx.vfExec.all_true())
+        self.assertEqual([], ctx.stack)
+
+        for i in range(depth):
+            ctx.fExec = ctx.vfExec.all_true()
+            table[OP_ELSE](ctx, OP_ELSE)
+            # Only the ELSE of the false IF is executed.
+            self.assertEqual(len(ctx.vfExec) == depth // 2 + 1, ctx.vfExec.all_true())
+            table[OP_ENDIF](ctx, OP_ENDIF)
+        self.assertEqual(0, len(ctx.vfExec))
+        self.assertIsNone(ctx.vfExec.first_false)
+
     def test_python_bitcoinlib_evaluate_script(self):
         stack = []
         EvalScript(stack, self.script_simple_addition, None, 0)
@@ -55,6 +148,127 @@ class StackTest(unittest.TestCase):
             for i, L in enumerate(expected_states):
                 self.assertEqual(L, steps[i].stack)
 
+    def test_step_history(self):
+        # Long enough to span several checkpoints.
+        my_script = Script.from_human(' '.join(['0x01 OP_DUP OP_ADD OP_DUP OP_2DUP OP_DROP OP_SWAP OP_NIP'] * 20))
+        expected_states = []
+        for state, last_op, log in Stack(my_script):
+            expected_states.append(StackState(list(state), last_op, log))
+
+        steps = ScriptExecution().evaluate(my_script)
+        self.assertEqual(len(expected_states), len(steps))
+        self.assertEqual(expected_states, list(steps))
+        for i in [0, 1, 31, 32, 33, 95, -1, -2]:
+            self.assertEqual(expected_states[i], steps[i])
+        self.assertEqual(expected_states[40:45], steps[40:45])
+        self.assertEqual([len(i.stack) for i in expected_states], [steps.stack_size(i) for i in range(len(steps))])
+        self.assertRaises(IndexError, steps.__getitem__, len(expected_states))
+
+    def test_incremental_evaluate(self):
+        prefix = ' '.join(['0x01 OP_DUP OP_ADD OP_IF 0x02 OP_ELSE 0x03 OP_ENDIF OP_TOALTSTACK OP_1 OP_FROMALTSTACK OP_DROP'] * 10)
+        execution = ScriptExecution()
+        _ = execution.evaluate(Script.from_human(prefix + ' OP_1 OP_2 OP_ADD'))
+        self.assertEqual(0, execution.first_changed_step)
+
+        my_script = Script.from_human(prefix + ' OP_4 OP_DUP OP_NOTIF OP_0 OP_ENDIF')
+        steps = execution.evaluate(my_script)
+        self.assertTrue(execution.first_changed_step > 0)
+        fresh = ScriptExecution()
+        expected_steps = fresh.evaluate(my_script)
+        self.assertEqual(list(expected_steps), list(steps))
+        self.assertEqual(fresh.script_passed, execution.script_passed)
+
+        # A changed context evaluates from the start.
+        _ = execution.evaluate(my_script, execution_data=ExecutionData(1, 1))
+        self.assertEqual(0, execution.first_changed_step)
+
+        # Nothing after a signature check can be resumed from.
+        _ = execution.evaluate(Script.from_human('OP_0 OP_IF OP_CHECKSIG OP_ENDIF ' + prefix))
+        _ = execution.evaluate(Script.from_human('OP_0 OP_IF OP_CHECKSIG OP_ENDIF ' + prefix + ' OP_1'))
+        self.assertEqual(0, execution.first_changed_step)
+
+        # Scripts that become too large fail without any steps.
+        _ = execution.evaluate(Script.from_human(prefix))
+        steps = execution.evaluate(Script.from_human(prefix + ' 0x' + 'ff' * 520 * 20))
+        self.assertEqual(0, execution.first_changed_step)
+        self.assertEqual(0, len(steps))
+        self.assertIn('script too large', str(execution.error))
+
+    def test_execution_profile(self):
+        profile = ExecutionProfile()
+        execution = ScriptExecution(profile)
+        my_script = Script.from_human('0x02 0x03 OP_ADD OP_DUP OP_ADD OP_2 OP_3 OP_4 OP_3 OP_CHECKMULTISIG')
+        for quiet in [False, True]:
+            _ = execution.evaluate(my_script, quiet=quiet)
+            self.assertIsNotNone(execution.error)
+
+        self.assertEqual(2, profile.evaluations)
+        self.assertEqual(4, profile.get(OP_ADD).count)
+        self.assertEqual(2, profile.get(OP_DUP).count)
+        self.assertEqual(0, profile.get(OP_CHECKSIG).count)
+        self.assertEqual(5, profile.peak_depth)
+        self.assertEqual(5, profile.peak_bytes)
+        self.assertEqual('OP_ADD', profile.get(OP_ADD).name)
+        self.assertEqual(set(['PUSHDATA', 'OP_ADD', 'OP_DUP', 'OP_2', 'OP_3', 'OP_4']), set(i.name for i in profile.rows()))
+
+        other = ExecutionProfile()
+        _ = ScriptExecution(other).evaluate(Script.from_human('0x80 OP_DUP'))
+        profile.merge(other)
+        self.assertEqual(3, profile.evaluations)
+        self.assertEqual(3, profile.get(OP_DUP).count)
+
+    def test_opcode_override_dispatch(self):
+        def op_double(stack, txTo, inIdx, flags, execution_data, err_raiser):
+            stack.append(stack.pop() * 2)
+            return (stack, 0xb9, 'Doubled.')
+
+        my_script = Script('\x01\x05\xb9')
+        try:
+            opcodes.set_overridden_opcodes([(0xb9, 'OP_DOUBLE', op_double)])
+            steps = ScriptExecution().evaluate(my_script)
+            self.assertEqual(['\x05\x05'], steps[-1].stack)
+            self.assertEqual('Doubled.', steps[-1].log)
+        finally:
+            chainparams.set_to_preset('Bitcoin')
+
+        steps = ScriptExecution().evaluate(my_script)
+        self.assertEqual(['\x05'], steps[-1].stack)
+        self.assertEqual('(NOP)', steps[-1].log)
+
+    def test_opcode_override_new_stack(self):
+        # Overrides can return a new stack instead of changing the stack in place.
+        def op_reverse(stack, txTo, inIdx, flags, execution_data, err_raiser):
+            return (stack[::-1], OP_NOP10, 'Reversed.')
+
+        my_script = Script('\x01\x05\x01\x06\xb9\x76')
+        try:
+            opcodes.set_overridden_opcodes([(0xb9, 'OP_REVERSE', op_reverse)])
+            steps = ScriptExecution().evaluate(my_script)
+            self.assertEqual(['\x06', '\x05'], steps[2].stack)
+            self.assertEqual(OP_NOP10, steps[2].last_op)
+            self.assertEqual('Reversed.', steps[2].log)
+            self.assertEqual(['\x06', '\x05', '\x05'], steps[-1].stack)
+        finally:
+            chainparams.set_to_preset('Bitcoin')
+
+    def test_signature_cache(self):
+        key = CKey(b'\x01' * 32)
+        script_pubkey = Script(CScript([key.pub, OP_CHECKSIG]))
+        tx = build_spending_tx(Script(), build_crediting_tx(script_pubkey))
+        sighash = SignatureHash(script_pubkey, tx, 0, SIGHASH_ALL)
+        tx.vin[0].scriptSig = Script(CScript([key.sign(sighash) + b'\x01']))
+
+        signature_cache.clear()
+        execution = ScriptExecution()
+        _ = execution.evaluate(script_pubkey, txTo=tx, inIdx=0)
+        self.assertTrue(execution.script_verified)
+        self.assertEqual(1, len(signature_cache))
+        self.assertEqual(0, signature_cache.hits)
+
+        _ = execution.evaluate(script_pubkey, txTo=tx, inIdx=0)
+        self.assertTrue(execution.script_verified)
+        self.assertEqual(1, signature_cache.hits)
+
     def test_p2sh_script_verification(self):
         # P2SH tx from Bitcoin Core tests.
         rawtx = '01000000010001000000000000000000000000000000000000000000000000000000000000000000006e493046022100c66c9cdf4c43609586d15424c54707156e316d88b0a1534c9e6b0d4f311406310221009c0fe51dbc9c4ab7cc25d3fdbeccf6679fe6827f08edf2b4a9f16ee3eb0e438a0123210338e8034509af564c62644c07691942e0c056752008a173c89f60ab2a88ac2ebfacffffffff010000000000000000015100000000'
@@ -97,6 +311,9 @@ class StackTest(unittest.TestCase):
             _ = execution.evaluate(script_pubkey, txTo=tx, inIdx=0)
             self.assertTrue(execution.script_passed)
             self.assertTrue(execution.script_verified)
+            _ = execution.evaluate(script_pubkey, txTo=tx, inIdx=0, quiet=True)
+            self.assertTrue(execution.script_passed)
+            self.assertTrue(execution.script_verified)
 
     def test_invalid_flow_control(self):
         invalid_tests = (
@@ -124,6 +341,9 @@ class StackTest(unittest.TestCase):
             _ = execution.evaluate(script_pubkey, txTo=tx, inIdx=0)
             self.assertFalse(execution.script_passed)
             self.assertFalse(execution.script_verified)
+            _ = execution.evaluate(script_pubkey, txTo=tx, inIdx=0, quiet=True)
+            self.assertFalse(execution.script_passed)
+            self.assertFalse(execution.script_verified)
 
 
 def build_spending_tx(script_sig, credit_tx):
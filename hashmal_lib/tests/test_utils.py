@@ -1,3 +1,4 @@
+import threading
 import unittest
 
 from hashmal_lib.core import utils
@@ -35,3 +36,32 @@ class UtilsTest(unittest.TestCase):
         )
         for value, expected in push_tests:
             self.assertEqual(expected, utils.push_script(value))
+
+    def test_lru_cache_threads(self):
+        cache = utils.LRUCache(max_size=50)
+        def run(offset):
+            for i in range(5000):
+                cache.put((i + offset) % 200, i)
+                cache.get((i * 7 + offset) % 200)
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(50, len(cache))
+        self.assertEqual(20000, cache.hits + cache.misses)
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        # 'b' is now the least recently used item.
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(1, cache.misses)
+        self.assertAlmostEqual(2.0 / 3, cache.stats()['hit_rate'])
@@ -0,0 +1,160 @@
+import threading
+import unittest
+
+from bitcoin.core import CMutableTxIn, CMutableTxOut, CMutableOutPoint, b2lx
+from bitcoin.core.script import CScript, OP_CHECKSIG, OP_EQUAL, SIGHASH_ALL
+from bitcoin.wallet import CKey
+
+from hashmal_lib.core import chainparams, verify
+from hashmal_lib.core.block import Block
+from hashmal_lib.core.transaction import Transaction
+
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        super(VerifyTest, self).setUp()
+        chainparams.set_to_preset('Bitcoin')
+        self.key = key = CKey(b'\x01' * 32)
+        self.script_pubkey = CScript([key.pub, OP_CHECKSIG])
+
+        prev_tx = Transaction()
+        prev_tx.vin = [CMutableTxIn()]
+        prev_tx.vout = [CMutableTxOut(100000, self.script_pubkey) for _ in range(20)]
+        self.prev_tx = prev_tx
+        self.prev_txs = {b2lx(prev_tx.GetHash()): prev_tx.as_hex()}
+
+        tx = Transaction()
+        tx.vin = [CMutableTxIn(CMutableOutPoint(prev_tx.GetHash(), i)) for i in range(20)]
+        tx.vout = [CMutableTxOut(1000, CScript())]
+        for i in range(len(tx.vin)):
+            sighash = chainparams.signature_hash(self.script_pubkey, tx, i, SIGHASH_ALL)
+            tx.vin[i].scriptSig = CScript([key.sign(sighash) + b'\x01'])
+        # Invalidate the signature of input 3.
+        tx.vin[3].scriptSig = tx.vin[2].scriptSig
+        self.tx = tx
+
+    def test_fetch_prevout_scripts(self):
+        fetched = []
+        def get_raw_tx(txid):
+            fetched.append(txid)
+            return self.prev_txs[txid]
+
+        scripts, errors = verify.fetch_prevout_scripts(self.tx, get_raw_tx)
+        self.assertEqual(1, len(fetched))
+        self.assertEqual({}, errors)
+        self.assertEqual(range(20), sorted(scripts.keys()))
+        self.assertEqual(self.script_pubkey, scripts[0])
+
+        scripts, errors = verify.fetch_prevout_scripts(self.tx, lambda txid: None)
+        self.assertEqual({}, scripts)
+        self.assertEqual(range(20), sorted(errors.keys()))
+
+        # Nothing is fetched after cancelling.
+        del fetched[:]
+        scripts, errors = verify.fetch_prevout_scripts(self.tx, get_raw_tx, lambda: True)
+        self.assertEqual([], fetched)
+        self.assertEqual({}, scripts)
+        self.assertEqual(['Cancelled.'] * 20, errors.values())
+
+    def test_verify_inputs(self):
+        scripts = dict((i, self.script_pubkey) for i in range(len(self.tx.vin)))
+        for processes in [1, 2]:
+            results = list(verify.verify_inputs(self.tx.serialize(), scripts, processes=processes))
+            self.assertEqual(range(20), sorted(i[0] for i in results))
+            failed = [i[0] for i in results if not i[1]]
+            self.assertEqual([3], failed)
+
+    def test_verify_block(self):
+        # Spends an output of self.tx in the same block.
+        tx2 = Transaction()
+        tx2.vin = [CMutableTxIn(CMutableOutPoint(self.tx.GetHash(), 0))]
+        tx2.vout = [CMutableTxOut(500, CScript())]
+        tx2.vin[0].scriptSig = CScript([b'\x01'])
+        self.tx.vout[0].scriptPubKey = CScript([b'\x01', OP_EQUAL])
+        # Refresh signatures since an output changed.
+        for i in range(len(self.tx.vin)):
+            sighash = chainparams.signature_hash(self.script_pubkey, self.tx, i, SIGHASH_ALL)
+            self.tx.vin[i].scriptSig = CScript([self.key.sign(sighash) + b'\x01'])
+        tx2.vin[0].prevout = CMutableOutPoint(self.tx.GetHash(), 0)
+
+        coinbase = Transaction()
+        coinbase.vin = [CMutableTxIn(CMutableOutPoint(), CScript([b'\x00\x00']))]
+        coinbase.vout = [CMutableTxOut(5000000000, CScript())]
+        blk = Block(vtx=[coinbase, self.tx, tx2])
+
+        utxos = dict(((self.prev_tx.GetHash(), i), txout) for i, txout in enumerate(self.prev_tx.vout))
+        provider = verify.SnapshotUTXOProvider(utxos)
+        for processes in [1, 2]:
+            verifier = verify.BlockVerifier(provider, processes=processes)
+            results = verifier.verify(blk)
+            self.assertEqual(21, len(results))
+            self.assertEqual(21, verifier.num_inputs)
+            self.assertEqual(20, verifier.num_sigops)
+            self.assertTrue(all(i[2] for i in results))
+
+        # Missing prevouts.
+        verifier = verify.BlockVerifier(verify.SnapshotUTXOProvider({}), processes=1)
+        results = verifier.verify(blk)
+        self.assertEqual([(2, 0, True)], [i[:3] for i in results if i[2]])
+
+    def test_shared_pool(self):
+        scripts = dict((i, self.script_pubkey) for i in range(len(self.tx.vin)))
+        self.assertIsNotNone(verify.start_pool(2))
+        try:
+            # The shared pool is used from threads other than the main thread.
+            results = []
+            def run():
+                results.extend(verify.verify_inputs(self.tx.serialize(), scripts, processes=2))
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+            self.assertEqual(range(20), sorted(i[0] for i in results))
+            self.assertEqual([3], [i[0] for i in results if not i[1]])
+            # Closing the generator early drops the inputs that were not submitted,
+            # and does not stop the shared pool.
+            pool = verify.start_pool()
+            iterator = verify.verify_inputs(self.tx.serialize(), scripts, processes=2)
+            next(iterator)
+            iterator.close()
+            self.assertTrue(len(pool._cache) <= 4)
+            self.assertEqual(20, len(list(verify.verify_inputs(self.tx.serialize(), scripts, processes=2))))
+
+            # Presets that changed after the workers were forked are verified in-process.
+            self.assertIs(pool, verify._get_pool(2, 'Bitcoin')[0])
+            preset = chainparams.presets['Bitcoin']
+            preset.opcode_overrides.append((0xb9, 'OP_NOP10', None))
+            try:
+                self.assertEqual((None, 0, False), verify._get_pool(2, 'Bitcoin'))
+            finally:
+                preset.opcode_overrides.pop()
+        finally:
+            verify.stop_pool()
+
+    def test_bounded_submission(self):
+        submitted = []
+        class Result(object):
+            def __init__(self, value):
+                self.value = value
+            def get(self):
+                return self.value
+        class Pool(object):
+            def apply_async(self, func, args):
+                submitted.append(args[0])
+                return Result(args[0])
+        iterator = verify._iter_pool_results(Pool(), 2, range(100))
+        self.assertEqual(0, next(iterator))
+        iterator.close()
+        # Two tasks per worker are submitted at a time.
+        self.assertEqual(range(4), submitted)
+
+    def test_no_fork_from_thread(self):
+        scripts = dict((i, self.script_pubkey) for i in range(len(self.tx.vin)))
+        pools = []
+        def run():
+            pools.append(verify._get_pool(2, 'Bitcoin'))
+            pools.append(list(verify.verify_inputs(self.tx.serialize(), scripts, processes=2)))
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        # Without the shared pool, threads verify in-process.
+        self.assertEqual((None, 0, False), pools[0])
+        self.assertEqual([3], [i[0] for i in pools[1] if not i[1]])
@@ -131,7 +131,7 @@ class BlockTxsWidget(QWidget):
         self.clear()
         if not isinstance(block, Block):
             return
-        txids = [b2lx(i.GetHash()) for i in block.vtx]
+        txids = [b2lx(i) for i in block.get_txids()]
         items = map(lambda x: QStandardItem(x), txids)
         for item in items:
             item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
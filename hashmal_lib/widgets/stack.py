@@ -3,7 +3,7 @@ from PyQt4.QtCore import *
 
 from hashmal_lib.core import opcodes
 from hashmal_lib.core.script import Script
-from hashmal_lib.core.utils import format_hex_string
+from hashmal_lib.core.utils import format_hex_string, LRUCache
 from hashmal_lib.core.stack import ScriptExecution
 
 
@@ -42,41 +42,85 @@ class ScriptExecutionItem(object):
         return 0
 
 class TopLevelScriptItem(ScriptExecutionItem):
-    """Tree View item for script execution steps."""
-    def __init__(self, data, parent=None):
-        super(TopLevelScriptItem, self).__init__(data, parent)
-        self.stack_data = Script(self.item_data[2]).get_human()
-        # Convert log data representations to human-readable ones.
-        log_data = self.item_data[3].split()
-        for i, word in enumerate(log_data):
-            # Try to put the data in human-readable form.
+    """Tree View item for script execution steps.
+
+    Human-readable data and child items are built when first needed.
+    """
+    def __init__(self, step_number, model, parent=None):
+        super(TopLevelScriptItem, self).__init__((step_number, None, None, None), parent)
+        self.step_number = step_number
+        self.model = model
+        self.children_fetched = False
+        self.op_name = None
+        self.stack_data = None
+        self.log_data = None
+
+    def step(self):
+        return self.model.execution.steps[self.step_number]
+
+    def stack_size(self):
+        return self.model.execution.steps.stack_size(self.step_number)
+
+    def fetch_children(self):
+        """Create items for the stack at this step."""
+        step = self.step()
+        human = self.model.render_stack(step.stack)
+        sub_level_item_data = []
+        for i, data in enumerate(step.stack):
+            stack_data = data
             try:
-                hex_word = format_hex_string(word, with_prefix=False)
-                if all(ord(c) < 128 and ord(c) > 31 for c in hex_word.decode('hex')):
-                    log_data[i] = ''.join(['"', hex_word.decode('hex'), '"'])
+                stack_data = stack_data.encode('hex')
             except Exception:
-                pass
-        self.log_data = ' '.join(log_data)
+                stack_data = str(stack_data)
+            sub_level_item_data.append([i, '', stack_data, self.model.variable_for(human[i])])
+        # Reverse items for a more visually-accurate stack.
+        sub_level_item_data.reverse()
+        for row, sub in enumerate(sub_level_item_data):
+            self.appendChild(SubLevelScriptItem(sub, self, row))
+        self.children_fetched = True
 
-        self.op_name = opcodes.opcode_names.get(self.item_data[1], 'PUSHDATA')
+    def row(self):
+        return self.step_number
 
     def data(self, column, role = Qt.DisplayRole):
-        item_data = super(TopLevelScriptItem, self).data(column, role)
         if column == 1:
+            if self.op_name is None:
+                self.op_name = opcodes.opcode_names.get(self.model.execution.steps.ops[self.step_number], 'PUSHDATA')
             return self.op_name
         elif column == 2:
+            if self.stack_data is None:
+                self.stack_data = ' '.join(self.model.render_stack(self.step().stack))
             return self.stack_data
         elif column == 3:
+            if self.log_data is None:
+                self.log_data = self.render_log(self.model.execution.steps.logs[self.step_number])
             return self.log_data
-        return item_data
+        return super(TopLevelScriptItem, self).data(column, role)
+
+    def render_log(self, log):
+        """Convert log data representations to human-readable ones."""
+        log_data = log.split()
+        for i, word in enumerate(log_data):
+            # Try to put the data in human-readable form.
+            try:
+                hex_word = format_hex_string(word, with_prefix=False)
+                if all(ord(c) < 128 and ord(c) > 31 for c in hex_word.decode('hex')):
+                    log_data[i] = ''.join(['"', hex_word.decode('hex'), '"'])
+            except Exception:
+                pass
+        return ' '.join(log_data)
 
 class SubLevelScriptItem(ScriptExecutionItem):
     """Tree View item for the state of a script execution step."""
-    def __init__(self, data, parent=None):
+    def __init__(self, data, parent=None, row=0):
         super(SubLevelScriptItem, self).__init__(data, parent)
+        self.row_number = row
         self.op_data = ''.join(['    ', self.item_data[2]])
         self.log_data = ''.join(['    ', self.item_data[3]])
 
+    def row(self):
+        return self.row_number
+
     def data(self, column, role = Qt.DisplayRole):
         if column == 2 and role == Qt.DisplayRole:
             return self.op_data
@@ -85,11 +129,22 @@ class SubLevelScriptItem(ScriptExecutionItem):
         return super(SubLevelScriptItem, self).data(column, role)
 
 class ScriptExecutionModel(QAbstractItemModel):
-    """Model of a script's execution."""
+    """Model of a script's execution.
+
+    Items for steps are created in batches as the view needs them,
+    and the items for a step's stack are created when it is expanded.
+    """
+    # Number of steps to create items for at a time.
+    fetch_batch_size = 256
+
     def __init__(self, execution, parent=None):
         super(ScriptExecutionModel, self).__init__(parent)
         self.execution = execution
         self.plugin_handler = None
+        # Human-readable stacks, keyed by stack items.
+        self.render_cache = LRUCache(max_size=256)
+        # Variable names, keyed by human-readable values.
+        self.variable_cache = {}
         self.rootItem = ScriptExecutionItem(('Step', 'Op', 'Stack', 'Log'))
         self.header_tooltips = ['Step Number', 'Operation', 'Stack State', 'Description']
         self.setup_data(self.execution, self.rootItem)
@@ -106,6 +161,41 @@ class ScriptExecutionModel(QAbstractItemModel):
             return parent.internalPointer().childCount()
         return self.rootItem.childCount()
 
+    def hasChildren(self, parent = QModelIndex()):
+        if not parent.isValid():
+            return len(self.execution.steps) > 0
+        item = parent.internalPointer()
+        if parent.column() > 0 or not isinstance(item, TopLevelScriptItem):
+            return False
+        return item.stack_size() > 0
+
+    def canFetchMore(self, parent):
+        if not parent.isValid():
+            return self.rootItem.childCount() < len(self.execution.steps)
+        item = parent.internalPointer()
+        return isinstance(item, TopLevelScriptItem) and not item.children_fetched
+
+    def fetchMore(self, parent):
+        if not parent.isValid():
+            start = self.rootItem.childCount()
+            end = min(len(self.execution.steps), start + self.fetch_batch_size)
+            if end <= start:
+                return
+            self.beginInsertRows(QModelIndex(), start, end - 1)
+            self.add_steps(self.rootItem, start, end)
+            self.endInsertRows()
+            return
+
+        item = parent.internalPointer()
+        if not isinstance(item, TopLevelScriptItem) or item.children_fetched:
+            return
+        size = item.stack_size()
+        if size:
+            self.beginInsertRows(parent, 0, size - 1)
+        item.fetch_children()
+        if size:
+            self.endInsertRows()
+
     def index(self, row, column, parent = QModelIndex()):
         if not self.hasIndex(row, column, parent):
             return QModelIndex()
@@ -156,41 +246,56 @@ class ScriptExecutionModel(QAbstractItemModel):
     def flags(self, index):
         return Qt.ItemIsEnabled | Qt.ItemIsSelectable
 
+    def render_stack(self, stack):
+        """Get the human-readable form of each item in stack."""
+        key = tuple(stack)
+        human = self.render_cache.get(key)
+        if human is None:
+            human = tuple(Script(stack).get_human().split())
+            self.render_cache.put(key, human)
+        return human
+
+    def variable_for(self, human):
+        """Get the variable name to display for a human-readable value."""
+        if not self.plugin_handler:
+            return human
+        if human not in self.variable_cache:
+            key = self.plugin_handler.get_plugin('Variables').ui.key_for_value(human, strict=False)
+            self.variable_cache[human] = '$' + key if key else human
+        return self.variable_cache[human]
+
     def setup_data(self, execution, parent):
         self.beginResetModel()
-        for count, step in enumerate(execution.steps):
-            step_item = TopLevelScriptItem((count, step.last_op, step.stack, step.log), parent)
-            # Loop through stack items.
-            scr = Script(step.stack).get_human().split()
-            sub_level_item_data = []
-            for i, data in enumerate(step.stack):
-                human = scr[i]
-                # Variable name
-                if self.plugin_handler:
-                    key = self.plugin_handler.get_plugin('Variables').ui.key_for_value(human, strict=False)
-                    if key:
-                        human = '$' + key
-
-                stack_data = data
-                try:
-                    stack_data = stack_data.encode('hex')
-                except Exception:
-                    stack_data = str(stack_data)
-                sub_level_item_data.append([i, '', stack_data, human])
-            # Reverse items for a more visually-accurate stack.
-            sub_level_item_data.reverse()
-            for sub in sub_level_item_data:
-                data_item = SubLevelScriptItem(sub, step_item)
-                step_item.appendChild(data_item)
-            parent.appendChild(step_item)
+        self.variable_cache.clear()
+        self.add_steps(parent, 0, min(len(execution.steps), self.fetch_batch_size))
         self.endResetModel()
 
+    def add_steps(self, parent, start, end):
+        """Add items for steps from start to end."""
+        for count in xrange(start, end):
+            parent.appendChild(TopLevelScriptItem(count, self, parent))
+
     def evaluate(self, execution=None):
+        # Only the steps that were re-evaluated need to be updated.
+        first_changed_step = self.execution.first_changed_step
+        if (execution is None or execution is self.execution) and 0 < first_changed_step <= self.rootItem.childCount():
+            self.update_data(first_changed_step)
+            return
         if execution:
             self.execution = execution
         self.rootItem = ScriptExecutionItem(('Step', 'Op', 'Stack', 'Log'))
         self.setup_data(self.execution, self.rootItem)
 
+    def update_data(self, start):
+        """Replace the items for steps from start onwards."""
+        self.variable_cache.clear()
+        old_count = self.rootItem.childCount()
+        if old_count > start:
+            self.beginRemoveRows(QModelIndex(), start, old_count - 1)
+            del self.rootItem.children[start:]
+            self.endRemoveRows()
+        self.fetchMore(QModelIndex())
+
     def clear(self):
         self.evaluate(ScriptExecution())
 
@@ -276,6 +381,7 @@ class ScriptExecutionWidget(QWidget):
         else:
             self.error_edit.clear()
             self.error_edit.hide()
+        # Select the last step that has an item, rather than creating items for every step.
         last_item = self.model.index(self.model.rootItem.childCount() - 1, 0)
         self.view.selectionModel().select(last_item, QItemSelectionModel.SelectCurrent | QItemSelectionModel.Rows)
 